@@ -0,0 +1,228 @@
+"""An in-process Python API for all MEDS-DEV stages.
+
+Each stage's command line tool (`meds-dev-dataset`, `meds-dev-task`, `meds-dev-model`, `meds-dev-evaluation`,
+and `meds-dev-results`) is a thin Hydra wrapper around the `run` function of the stage's `__main__` module.
+The functions here compose the same configurations from keyword arguments, loading each stage's
+configuration file only once per process, and call `run` directly. Orchestrators and notebooks can then drive
+many stages without paying for an interpreter and Hydra startup per stage. Commands that stages run in their
+own environments (e.g., model commands) are still run as subprocesses, and Hydra's per-run log files are not
+written; logs go to the loggers of the calling process.
+"""
+
+import functools
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from omegaconf import DictConfig, OmegaConf
+from omegaconf.errors import ConfigKeyError
+
+from .datasets import CFG_YAML as DATASET_CFG_YAML
+from .datasets.__main__ import run as run_dataset_stage
+from .evaluation import CFG_YAML as EVALUATION_CFG_YAML
+from .evaluation.__main__ import run as run_evaluation_stage
+from .models import CFG_YAML as MODEL_CFG_YAML
+from .models.__main__ import run as run_model_stage
+from .results import CFG_YAML as RESULTS_CFG_YAML
+from .results.__main__ import run as run_results_stage
+from .tasks import CFG_YAML as TASK_CFG_YAML
+from .tasks.__main__ import run as run_task_stage
+
+STAGES = {
+    "dataset": (DATASET_CFG_YAML, run_dataset_stage, "output_dir"),
+    "task": (TASK_CFG_YAML, run_task_stage, "output_dir"),
+    "model": (MODEL_CFG_YAML, run_model_stage, "output_dir"),
+    "evaluation": (EVALUATION_CFG_YAML, run_evaluation_stage, "output_dir"),
+    "results": (RESULTS_CFG_YAML, run_results_stage, "warehouse_dir"),
+}
+
+
+@dataclass
+class StageResult:
+    """The outcome of a stage run through the API.
+
+    Attributes:
+        stage: The stage's name (one of `STAGES`).
+        config: The stage's composed configuration.
+        output_dir: The stage's output directory.
+        seconds: The stage's wall time, in seconds.
+        artifacts: The (non-hidden) files in `output_dir` after the stage ran.
+        value: What the stage returned, e.g., the evaluation results or the leaderboard.
+    """
+
+    stage: str
+    config: DictConfig
+    output_dir: Path
+    seconds: float
+    artifacts: list[Path]
+    value: Any = None
+
+
+@functools.cache
+def _base_config(stage: str) -> DictConfig:
+    cfg = OmegaConf.load(str(STAGES[stage][0]))
+    return OmegaConf.masked_copy(cfg, [k for k in cfg if k not in ("defaults", "hydra")])
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list | tuple):
+        return [_plain(v) for v in value]
+    if isinstance(value, Path):
+        return str(value)
+    return value
+
+
+def compose_config(stage: str, **overrides) -> DictConfig:
+    """Returns the configuration of a stage, as its command line tool would compose it from `overrides`.
+
+    Overrides are keyword arguments, with nested options given as dictionaries and paths as `Path`s or
+    strings. As on the command line, options not in the stage's configuration are rejected.
+
+    Raises:
+        ValueError: If the stage is unknown or an override is not an option of the stage.
+
+    Examples:
+        >>> cfg = compose_config("evaluation", predictions_dir=Path("preds"), bootstrap={"enabled": True})
+        >>> cfg.predictions_dir, cfg.bootstrap.enabled, cfg.bootstrap.n_replicates
+        ('preds', True, 1000)
+        >>> cfg = compose_config("model", model="random_predictor", output_dir="out", mode="predict")
+        >>> cfg.venv_dir
+        'out/.venv'
+        >>> compose_config("evaluation", n_replicates=10)
+        Traceback (most recent call last):
+            ...
+        ValueError: n_replicates is not an option of the evaluation stage.
+        >>> compose_config("evaluation", bootstrap={"replicates": 10})
+        Traceback (most recent call last):
+            ...
+        ValueError: bootstrap.replicates is not an option of the evaluation stage.
+        >>> compose_config("training")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown stage training; expected one of dataset, task, model, evaluation, results.
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage {stage}; expected one of {', '.join(STAGES)}.")
+
+    cfg = _base_config(stage).copy()
+    OmegaConf.set_struct(cfg, True)
+    try:
+        return OmegaConf.merge(cfg, _plain(overrides))
+    except ConfigKeyError as e:
+        raise ValueError(f"{e.full_key} is not an option of the {stage} stage.") from e
+
+
+def stage_artifacts(output_dir: Path) -> list[Path]:
+    """Returns the files in a stage's output directory, other than hidden files and directories.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for fn in (".done", ".venv/bin/python", "predictions/held_out/0.parquet", "results.json"):
+        ...         (root / fn).parent.mkdir(parents=True, exist_ok=True)
+        ...         (root / fn).touch()
+        ...     print([str(fp.relative_to(root)) for fp in stage_artifacts(root)])
+        ['results.json', 'predictions/held_out/0.parquet']
+    """
+    artifacts = []
+    for root, dirs, files in os.walk(output_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        artifacts.extend(Path(root) / fn for fn in sorted(files) if not fn.startswith("."))
+    return artifacts
+
+
+def run_stage(stage: str, **overrides) -> StageResult:
+    """Runs a stage in-process with the configuration composed from `overrides`; see `compose_config`."""
+    cfg = compose_config(stage, **overrides)
+    _, run, output_key = STAGES[stage]
+
+    start = time.perf_counter()
+    value = run(cfg)
+    seconds = time.perf_counter() - start
+
+    output_dir = Path(cfg[output_key])
+    return StageResult(stage, cfg, output_dir, seconds, stage_artifacts(output_dir), value)
+
+
+def build_dataset(dataset: str, output_dir: Path, demo: bool = False, **overrides) -> StageResult:
+    """Builds a dataset, as `meds-dev-dataset` would.
+
+    The stage's value is the refresh record, if the dataset was refreshed from a `delta_dir`.
+    """
+    return run_stage("dataset", dataset=dataset, output_dir=output_dir, demo=demo, **overrides)
+
+
+def extract_task(task: str, dataset: str, dataset_dir: Path, output_dir: Path, **overrides) -> StageResult:
+    """Extracts a task's labels from a dataset, as `meds-dev-task` would."""
+    return run_stage(
+        "task", task=task, dataset=dataset, dataset_dir=dataset_dir, output_dir=output_dir, **overrides
+    )
+
+
+def run_model(
+    model: str,
+    dataset_dir: Path,
+    output_dir: Path,
+    mode: str,
+    dataset_type: str = "supervised",
+    labels_dir: Path | None = None,
+    **overrides,
+) -> StageResult:
+    """Runs a model's stages, as `meds-dev-model` would."""
+    return run_stage(
+        "model",
+        model=model,
+        dataset_dir=dataset_dir,
+        output_dir=output_dir,
+        mode=mode,
+        dataset_type=dataset_type,
+        labels_dir=labels_dir,
+        **overrides,
+    )
+
+
+def evaluate(
+    output_dir: Path, predictions_dir: Path | None = None, in_process: bool = True, **overrides
+) -> StageResult:
+    """Evaluates predictions, as `meds-dev-evaluation` would, but in-process by default.
+
+    For batches, pass `predictions_dirs` and/or `manifest_fp` rather than `predictions_dir`. The stage's value
+    is the evaluation results, or the consolidated results table of a batch.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> import polars as pl
+        >>> from .predictions import write_prediction_shard
+        >>> predictions = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3, 4],
+        ...     "prediction_time": [datetime(2021, 1, 1)] * 4,
+        ...     "boolean_value": [False, True, False, True],
+        ...     "predicted_boolean_value": [False, True, True, True],
+        ...     "predicted_boolean_probability": [0.1, 0.9, 0.6, 0.8],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     write_prediction_shard(predictions, root / "predict" / "predictions" / "0.parquet")
+        ...     result = evaluate(root / "eval", root / "predict")
+        ...     print([str(fp.relative_to(root)) for fp in result.artifacts])
+        ['eval/results.json']
+        >>> result.stage, result.seconds > 0, result.value["samples_equally_weighted"]["roc_auc_score"]
+        ('evaluation', True, 1.0)
+    """
+    if predictions_dir is not None:
+        overrides["predictions_dir"] = predictions_dir
+    return run_stage("evaluation", output_dir=output_dir, in_process=in_process, **overrides)
+
+
+def compile_results(warehouse_dir: Path, **overrides) -> StageResult:
+    """Updates the results warehouse and queries its leaderboard, as `meds-dev-results` would.
+
+    The stage's value is the leaderboard.
+    """
+    return run_stage("results", warehouse_dir=warehouse_dir, **overrides)
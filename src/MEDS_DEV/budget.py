@@ -0,0 +1,241 @@
+"""Compute budgets for model stages: measuring the compute a command consumes, and stopping it at a limit.
+
+Commands are run in their own process group, which is polled for its wall time, CPU time, and resident memory
+(summed over all of its processes). If a stage exceeds any of its budget limits, the whole process group is
+asked to terminate (with `SIGTERM`, then `SIGKILL` after a grace period), the stage is not marked as done, and
+`BudgetExceeded` is raised; re-running the stage resumes it, for models that checkpoint their progress.
+
+The compute consumed by each stage, accumulated over all of its (interrupted, failed, or successful) runs, is
+recorded in `.usage.json` in the stage's output directory, so that models can be compared at equal compute,
+and budgets apply to the total compute spent on a stage rather than to each attempt.
+"""
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from omegaconf import DictConfig
+
+logger = logging.getLogger(__name__)
+
+USAGE_FILE = ".usage.json"
+
+# The budget limits: wall time in seconds, CPU time in CPU-hours, and peak memory (RSS) in MiB.
+BUDGET_KEYS = ("wall_time", "cpu_hours", "peak_memory")
+
+POLL_SECONDS = 1.0
+TERMINATION_GRACE_SECONDS = 60.0
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised when a command is stopped for exceeding its compute budget.
+
+    Attributes:
+        usage: The compute consumed by the stage, over all of its runs, as recorded in `.usage.json`.
+    """
+
+    def __init__(self, message: str, usage: dict):
+        super().__init__(message)
+        self.usage = usage
+
+
+def stage_budget(cfg: DictConfig, overrides: dict | None, run_mode: str) -> dict[str, float]:
+    """Returns the budget limits of a model stage with the given run mode.
+
+    Models may declare budgets per run mode under the `budget` key of their `model.yaml` (passed here as
+    `overrides`), e.g., `budget: {train: {wall_time: 86400}}`, and the limits set in `cfg.budget` apply to
+    every stage and take precedence over the model's.
+
+    Raises:
+        ValueError: If a budget has unknown limits.
+
+    Examples:
+        >>> cfg = DictConfig({"budget": {"wall_time": None, "cpu_hours": 2, "peak_memory": None}})
+        >>> stage_budget(cfg, {"train": {"wall_time": 60, "cpu_hours": 8}}, "train")
+        {'wall_time': 60.0, 'cpu_hours': 2.0}
+        >>> stage_budget(cfg, {"train": {"wall_time": 60}}, "predict")
+        {'cpu_hours': 2.0}
+        >>> stage_budget(DictConfig({}), None, "train")
+        {}
+        >>> stage_budget(DictConfig({}), {"train": {"gpu_hours": 1}}, "train")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown budget limits: ['gpu_hours']. Options are ('wall_time', ...)
+    """
+    model_budget = (overrides or {}).get(str(run_mode), None) or {}
+    cli_budget = cfg.get("budget", None) or {}
+    if unknown := sorted((set(model_budget) | set(cli_budget)) - set(BUDGET_KEYS)):
+        raise ValueError(f"Unknown budget limits: {unknown}. Options are {BUDGET_KEYS}")
+
+    budget = {}
+    for key in BUDGET_KEYS:
+        if cli_budget.get(key, None) is not None:
+            budget[key] = float(cli_budget[key])
+        elif model_budget.get(key, None) is not None:
+            budget[key] = float(model_budget[key])
+    return budget
+
+
+def read_usage(output_dir: Path) -> dict:
+    """Returns the compute recorded for the stage in `output_dir`, or zero usage if none is recorded.
+
+    Examples:
+        >>> read_usage(Path("/nonexistent"))
+        {'wall_time': 0.0, 'cpu_hours': 0.0, 'peak_memory': 0.0, 'n_runs': 0, 'status': None}
+    """
+    usage_fp = Path(output_dir) / USAGE_FILE
+    if usage_fp.is_file():
+        return json.loads(usage_fp.read_text())
+    return {"wall_time": 0.0, "cpu_hours": 0.0, "peak_memory": 0.0, "n_runs": 0, "status": None}
+
+
+def record_usage(
+    output_dir: Path, prior: dict, wall_time: float, cpu_hours: float, peak_rss: int, status: str
+) -> dict:
+    """Adds the compute of one run of a stage to its `prior` usage and records the total in `.usage.json`.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     out = Path(tmp_dir)
+        ...     _ = record_usage(out, read_usage(out), 10.0, 0.5, 2 * 1024**3, "failed")
+        ...     usage = record_usage(out, read_usage(out), 5.0, 0.25, 1024**3, "completed")
+        >>> usage
+        {'wall_time': 15.0, 'cpu_hours': 0.75, 'peak_memory': 2048.0, 'n_runs': 2, 'status': 'completed'}
+    """
+    usage = {
+        "wall_time": prior["wall_time"] + wall_time,
+        "cpu_hours": prior["cpu_hours"] + cpu_hours,
+        "peak_memory": max(prior["peak_memory"], peak_rss / 1024**2),
+        "n_runs": prior["n_runs"] + 1,
+        "status": status,
+    }
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / USAGE_FILE).write_text(json.dumps(usage, indent=2))
+    return usage
+
+
+def _process_group_usage(pgid: int) -> tuple[float, int]:
+    """Returns the total CPU seconds (including reaped children) and resident bytes of a process group."""
+    cpu_ticks, rss_pages = 0, 0
+    for stat_fp in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat_fp.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # Fields are numbered from the process state, which is field 3 of /proc/[pid]/stat.
+        if int(fields[2]) != pgid:
+            continue
+        cpu_ticks += sum(int(f) for f in fields[11:15])
+        rss_pages += int(fields[21])
+    return cpu_ticks / _CLOCK_TICKS, rss_pages * _PAGE_SIZE
+
+
+def _exceeded(usage: dict, budget: dict) -> str | None:
+    for key in BUDGET_KEYS:
+        if key in budget and usage[key] > budget[key]:
+            return key
+    return None
+
+
+def run_with_budget(
+    cmd: str | list[str],
+    output_dir: Path,
+    budget: dict[str, float] | None = None,
+    poll_seconds: float = POLL_SECONDS,
+    grace_seconds: float = TERMINATION_GRACE_SECONDS,
+    **popen_kwargs,
+) -> subprocess.CompletedProcess:
+    """Runs a command, recording its compute in `output_dir` and stopping it if it exceeds its budget.
+
+    Args:
+        cmd: The command, as for `subprocess.Popen`.
+        output_dir: The stage's output directory, in which `.usage.json` is (cumulatively) recorded.
+        budget: The stage's budget limits (see `stage_budget`), or `None` for no limits.
+        poll_seconds: How often to measure the command's usage.
+        grace_seconds: How long to wait for the command to terminate before killing it.
+        popen_kwargs: Other arguments to `subprocess.Popen`. Output is always captured.
+
+    Returns:
+        The completed process, with its captured output.
+
+    Raises:
+        BudgetExceeded: If the command was stopped for exceeding its budget.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     out = run_with_budget("echo hi", Path(tmp_dir), shell=True)
+        ...     usage = read_usage(Path(tmp_dir))
+        >>> out.returncode, out.stdout
+        (0, b'hi\\n')
+        >>> usage["n_runs"], usage["status"], usage["wall_time"] < 5
+        (1, 'completed', True)
+
+    Stages that exceed their budget are stopped, and their usage accumulates over re-runs:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     for _ in range(2):
+        ...         try:
+        ...             run_with_budget("sleep 30", Path(tmp_dir), {"wall_time": 0.3}, 0.05, 1, shell=True)
+        ...         except BudgetExceeded as e:
+        ...             print(e)
+        ...     usage = read_usage(Path(tmp_dir))
+        Stopped command sleep 30 after exceeding its wall_time budget of 0.3.
+        Stopped command sleep 30 after exceeding its wall_time budget of 0.3.
+        >>> usage["n_runs"], usage["status"], 0.3 < usage["wall_time"] < 5
+        (2, 'budget_exceeded:wall_time', True)
+    """
+    output_dir = Path(output_dir)
+    budget = budget or {}
+    prior = read_usage(output_dir)
+
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        st = time.monotonic()
+        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, start_new_session=True, **popen_kwargs)
+
+        cpu_seconds, peak_rss, exceeded, stop_time = 0.0, 0, None, None
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                cpu_seconds = max(cpu_seconds, rusage.ru_utime + rusage.ru_stime)
+                peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+                break
+
+            group_cpu, group_rss = _process_group_usage(proc.pid)
+            cpu_seconds, peak_rss = max(cpu_seconds, group_cpu), max(peak_rss, group_rss)
+            usage = {
+                "wall_time": prior["wall_time"] + time.monotonic() - st,
+                "cpu_hours": prior["cpu_hours"] + cpu_seconds / 3600,
+                "peak_memory": max(prior["peak_memory"], peak_rss / 1024**2),
+            }
+            if exceeded is None and (exceeded := _exceeded(usage, budget)) is not None:
+                logger.warning(f"Stopping command {cmd}: {exceeded} budget {budget[exceeded]} exceeded.")
+                os.killpg(proc.pid, signal.SIGTERM)
+                stop_time = time.monotonic()
+            elif stop_time is not None and time.monotonic() - stop_time > grace_seconds:
+                os.killpg(proc.pid, signal.SIGKILL)
+            time.sleep(poll_seconds)
+
+        if exceeded is not None:
+            status = f"budget_exceeded:{exceeded}"
+        else:
+            status = "completed" if proc.returncode == 0 else "failed"
+        usage = record_usage(output_dir, prior, time.monotonic() - st, cpu_seconds / 3600, peak_rss, status)
+
+        stdout.seek(0)
+        stderr.seek(0)
+        out = subprocess.CompletedProcess(cmd, proc.returncode, stdout.read(), stderr.read())
+
+    if exceeded is not None:
+        raise BudgetExceeded(
+            f"Stopped command {cmd} after exceeding its {exceeded} budget of {budget[exceeded]}.", usage
+        )
+    return out
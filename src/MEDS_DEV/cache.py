@@ -0,0 +1,208 @@
+"""Shared, content-keyed caches of intermediate artifacts that can be re-used across runs.
+
+Caches are directories under a cache root, keyed by a fingerprint of everything their contents depend on
+(e.g., the dataset they were built from and the command that built them). Each cache is built at most once:
+builds are serialized across threads and processes via a file lock, and a cache is only considered built (and
+safe to read) once its `.done` file exists. Built caches are made read-only, as they may be in use by many
+concurrent runs.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from collections.abc import Callable, Generator
+from pathlib import Path
+
+import meds
+
+from .utils import run_in_env
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts) -> str:
+    """Returns a short, stable hash of the given JSON-serializable parts.
+
+    Examples:
+        >>> fingerprint("a", 1, None)
+        '30780d0daa72bce5'
+        >>> fingerprint("a", 1, None) == fingerprint("a", 1, "None")
+        False
+    """
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()[:16]
+
+
+def dataset_fingerprint(dataset_dir: Path | str) -> str:
+    """Returns a fingerprint identifying the current contents of a MEDS dataset.
+
+    The fingerprint is computed from the relative path, size, and modification time of every file in the data
+    and metadata directories of the dataset, so it is cheap to compute even for very large datasets, changes
+    whenever any file is rewritten (e.g., by an incremental refresh), and does not depend on where the dataset
+    is stored.
+
+    Args:
+        dataset_dir: The root directory of the MEDS dataset.
+
+    Returns:
+        A short hexadecimal fingerprint string.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     dataset_dir = Path(tmp_dir)
+        ...     (dataset_dir / "data").mkdir()
+        ...     shard_fp = dataset_dir / "data" / "0.parquet"
+        ...     _ = shard_fp.write_text("shard")
+        ...     fp1 = dataset_fingerprint(dataset_dir)
+        ...     (dataset_dir / "README.md").touch() # Files outside data and metadata are ignored.
+        ...     fp2 = dataset_fingerprint(dataset_dir)
+        ...     _ = shard_fp.write_text("a new shard")
+        ...     fp3 = dataset_fingerprint(dataset_dir)
+        >>> fp1 == fp2
+        True
+        >>> fp1 == fp3
+        False
+    """
+    return fingerprint(_dataset_files(dataset_dir))
+
+
+def dataset_size(dataset_dir: Path | str) -> int:
+    """Returns the total size, in bytes, of the data and metadata files of a MEDS dataset.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     dataset_dir = Path(tmp_dir)
+        ...     (dataset_dir / "data" / "train").mkdir(parents=True)
+        ...     _ = (dataset_dir / "data" / "train" / "0.parquet").write_text("shard")
+        ...     _ = (dataset_dir / "README.md").write_text("not data")
+        ...     print(dataset_size(dataset_dir), dataset_size(dataset_dir / "missing"))
+        5 0
+    """
+    return sum(size for _, size, _ in _dataset_files(dataset_dir))
+
+
+def _dataset_files(dataset_dir: Path | str) -> list[tuple[str, int, int]]:
+    dataset_dir = Path(dataset_dir)
+
+    files = []
+    for subdir in (meds.data_subdirectory, Path(meds.subject_splits_filepath).parent):
+        for fp in sorted((dataset_dir / subdir).rglob("*")):
+            if fp.is_file():
+                stat = fp.stat()
+                files.append((fp.relative_to(dataset_dir).as_posix(), stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+@contextlib.contextmanager
+def file_lock(lock_fp: Path) -> Generator[None]:
+    """Holds an exclusive lock on the given lock file, blocking until it is available.
+
+    The lock is an advisory `flock` lock, so it excludes other threads and processes (on the same host, or
+    across hosts on file systems supporting `flock`) that lock the same file.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     with file_lock(Path(tmp_dir) / "a.lock"):
+        ...         print("locked")
+        locked
+    """
+    lock_fp = Path(lock_fp)
+    lock_fp.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_fp, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def make_read_only(root: Path):
+    """Removes write permissions from all files under `root`.
+
+    Directories are left writable, so that read-only caches can still be deleted (e.g., via `shutil.rmtree`)
+    by their owner without first restoring permissions.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     fp = Path(tmp_dir) / "a" / "b.txt"
+        ...     fp.parent.mkdir()
+        ...     fp.touch()
+        ...     make_read_only(Path(tmp_dir))
+        ...     print(oct(fp.stat().st_mode & 0o222), oct(fp.parent.stat().st_mode & 0o200))
+        0o0 0o200
+    """
+    for fp in Path(root).rglob("*"):
+        if fp.is_file() and not fp.is_symlink():
+            fp.chmod(fp.stat().st_mode & ~0o222)
+
+
+def is_built(cache_dir: Path) -> bool:
+    return (Path(cache_dir) / ".done").is_file()
+
+
+def build_cache(
+    cmd: str,
+    cache_dir: Path,
+    env: dict[str, str] | None = None,
+    executor: Callable[..., subprocess.CompletedProcess] | None = None,
+    requests: dict[str, int] | None = None,
+) -> Path:
+    """Builds a cache directory by running a command, unless it has already been built.
+
+    Concurrent calls for the same cache directory (from any thread or process) block until the first finishes,
+    after which the cache is re-used. If a prior build was interrupted, its partial outputs are removed before
+    the cache is rebuilt. Once built, all files in the cache are made read-only.
+
+    Args:
+        cmd: The command that writes the cache contents to `cache_dir`.
+        cache_dir: The cache directory.
+        env: The environment in which to run the command.
+        executor: The executor to run the command with (see `MEDS_DEV.executors`), if not locally.
+        requests: The resource requests of the command, for the executor.
+
+    Returns:
+        The (built) cache directory.
+
+    Examples:
+        >>> import tempfile
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     cache_dir = Path(tmp_dir) / "cache" / "abc"
+        ...     cmd = f"echo built >> {tmp_dir}/count.txt && touch {cache_dir}/out.txt"
+        ...     with ThreadPoolExecutor(4) as pool:
+        ...         _ = list(pool.map(lambda _: build_cache(cmd, cache_dir), range(4)))
+        ...     print((Path(tmp_dir) / "count.txt").read_text().strip())
+        ...     print(sorted(p.name for p in cache_dir.iterdir()))
+        ...     print(oct((cache_dir / "out.txt").stat().st_mode & 0o222))
+        built
+        ['.done', '.usage.json', 'cmd.sh', 'out.txt']
+        0o0
+    """
+    cache_dir = Path(cache_dir)
+    if is_built(cache_dir):
+        logger.info(f"Re-using cache {cache_dir}.")
+        return cache_dir
+
+    with file_lock(cache_dir.with_name(f"{cache_dir.name}.lock")):
+        if is_built(cache_dir):
+            logger.info(f"Re-using cache {cache_dir}, built concurrently.")
+            return cache_dir
+
+        if cache_dir.exists():
+            logger.warning(f"Removing incomplete cache {cache_dir} from an interrupted build.")
+            shutil.rmtree(cache_dir)
+
+        logger.info(f"Building cache {cache_dir}.")
+        env = env if env is not None else os.environ.copy()
+        run_in_env(cmd, cache_dir, env=env, executor=executor, requests=requests)
+        make_read_only(cache_dir)
+
+    return cache_dir
@@ -7,28 +7,82 @@ logger = logging.getLogger(__name__)
 import hydra
 from omegaconf import DictConfig
 
+from ..executors import make_executor, stage_requests
+from ..plan import TO_RUN, Plan, PlanNode, done_status
 from ..utils import run_in_env, temp_env
 from . import CFG_YAML, DATASETS
+from .incremental import refresh_dataset
 
 
-@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
-def main(cfg: DictConfig):
+def check_refresh(cfg: DictConfig):
+    """Raises an error if the dataset in `cfg.output_dir` can not be refreshed from `cfg.delta_dir`."""
+    if cfg.get("do_overwrite", False):
+        raise ValueError("Cannot set do_overwrite=True when refreshing incrementally with a delta_dir.")
+    output_dir = Path(cfg.output_dir)
+    if not (output_dir / ".done").is_file():
+        raise FileNotFoundError(
+            f"Output directory {output_dir} does not contain a completed build to refresh. Build the "
+            "full dataset first, without delta_dir."
+        )
+
+
+def plan(cfg: DictConfig) -> Plan:
+    """Returns the plan of a dataset build: whether `run` would build, refresh, or skip the dataset."""
+    output_dir = Path(cfg.output_dir)
+    result = Plan(f"meds-dev-dataset {cfg.dataset}")
+
+    if cfg.get("delta_dir", None):
+        check_refresh(cfg)
+        reason = f"incremental refresh from {cfg.delta_dir}"
+        result.nodes.append(PlanNode(f"refresh/{cfg.dataset}", None, output_dir, TO_RUN, reason))
+        return result
+
+    commands = DATASETS[cfg.dataset]["metadata"]["commands"]
+    build_cmd = commands["build_demo"] if cfg.demo else commands["build_full"]
+    build_cmd = build_cmd.format(
+        output_dir=cfg.output_dir, temp_dir=cfg.get("temp_dir", None) or "{temp_dir}"
+    )
+    status, reason = done_status(output_dir, cfg.get("do_overwrite", False))
+    result.nodes.append(PlanNode(f"build/{cfg.dataset}", build_cmd, output_dir, status, reason))
+    return result
+
+
+def run(cfg: DictConfig) -> dict | Plan | None:
+    """Builds (or incrementally refreshes) a dataset, as configured by `_build_dataset.yaml`.
+
+    Returns:
+        The refresh record, if the dataset was refreshed from a `delta_dir`, or the plan of the build (see
+        `plan`), rather than running it, if `cfg.plan` is set.
+    """
     if cfg.dataset not in DATASETS:
         raise ValueError(
             f"Dataset {cfg.dataset} not currently configured! Available datasets: {DATASETS.keys()}"
         )
+    if cfg.get("plan", False):
+        return plan(cfg)
 
     commands = DATASETS[cfg.dataset]["metadata"]["commands"]
     requirements = DATASETS[cfg.dataset]["requirements"]
 
     output_dir = Path(cfg.output_dir)
+    done_fp = output_dir / ".done"
+
+    if cfg.get("delta_dir", None):
+        check_refresh(cfg)
+
+        refresh = refresh_dataset(output_dir, Path(cfg.delta_dir), cfg.get("max_subjects_per_shard", None))
+        logger.info(
+            f"Refresh {refresh['refresh_id']} of {cfg.dataset} from {cfg.delta_dir} updated "
+            f"{len(refresh['shards'])} shards for {refresh['n_subjects']} subjects: {refresh['shards']}"
+        )
+        return refresh
+
     if cfg.get("do_overwrite", False) and output_dir.exists():  # pragma: no cover
         logger.info(f"Removing existing output directory: {output_dir}")
         shutil.rmtree(output_dir)
 
         output_dir.mkdir(parents=True, exist_ok=False)
 
-    done_fp = output_dir / ".done"
     if done_fp.is_file():  # pragma: no cover
         logger.info(f"Output directory {output_dir} already exists and is marked as done.")
         return
@@ -39,5 +93,20 @@ def main(cfg: DictConfig):
         build_cmd = build_cmd.format(output_dir=cfg.output_dir, temp_dir=str(build_temp_dir.resolve()))
 
         logger.info(f"Considering running build command: {build_cmd}")
-        run_in_env(build_cmd, cfg.output_dir, env=env, do_overwrite=cfg.do_overwrite, cwd=build_temp_dir)
+        run_in_env(
+            build_cmd,
+            cfg.output_dir,
+            env=env,
+            do_overwrite=cfg.do_overwrite,
+            cwd=build_temp_dir,
+            executor=make_executor(cfg),
+            requests=stage_requests(cfg, DATASETS[cfg.dataset]["metadata"].get("requests", None), "build"),
+        )
         logger.info(f"Build {cfg.dataset} command {build_cmd} completed successfully.")
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    result = run(cfg)
+    if cfg.get("plan", False):
+        print(result)
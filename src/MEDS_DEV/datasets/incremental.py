@@ -0,0 +1,505 @@
+"""Utilities for incrementally refreshing a previously built MEDS-DEV dataset with a delta of new data.
+
+A refresh takes a MEDS-formatted cohort containing only the new data (the "delta") and merges it into an
+existing, fully built cohort. Only the data shards that contain subjects appearing in the delta are rewritten;
+subjects that are entirely new are assigned a split deterministically and written to new shards. Each refresh
+records, per shard, the identifier of the refresh that last modified it, so that downstream task labels can
+determine which of their shards are stale and must be re-extracted.
+
+Before any data is changed, the plan of a refresh (which subjects are merged into which existing shards, and
+the splits and shards of new subjects) is written to a journal, from which an interrupted refresh is resumed
+when it is re-run. Every step of the plan is idempotent, so replaying it completes the refresh exactly.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import meds
+import polars as pl
+
+from ..utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+SHARD_VERSIONS_FN = ".shard_versions.json"
+REFRESH_JOURNAL_FN = ".refresh_journal.json"
+BASE_VERSION = "base"
+
+
+def list_shards(data_dir: Path) -> dict[str, Path]:
+    """Lists the data shards in a MEDS data directory, keyed by their shard name.
+
+    The shard name is the path of the shard file relative to the data directory, without the `.parquet`
+    suffix, which matches the shard prefixes used by `expand_shards` and ACES.
+
+    Args:
+        data_dir: The `data` directory of a MEDS cohort.
+
+    Returns:
+        A dictionary mapping shard names to shard file paths, sorted by shard name.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     data_dir = Path(tmp_dir)
+        ...     for fp in ["train/1.parquet", "train/0.parquet", "held_out/0.parquet", "README.md"]:
+        ...         (data_dir / fp).parent.mkdir(parents=True, exist_ok=True)
+        ...         (data_dir / fp).touch()
+        ...     list(list_shards(data_dir))
+        ['held_out/0', 'train/0', 'train/1']
+    """
+    shards = {fp.relative_to(data_dir).with_suffix("").as_posix(): fp for fp in data_dir.rglob("*.parquet")}
+    return dict(sorted(shards.items()))
+
+
+def shard_subjects(data_dir: Path) -> pl.DataFrame:
+    """Returns the (unique) subjects present in each shard of a MEDS data directory.
+
+    Args:
+        data_dir: The `data` directory of a MEDS cohort.
+
+    Returns:
+        A dataframe with the columns `subject_id` and `shard`, sorted by subject ID.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     data_dir = Path(tmp_dir)
+        ...     (data_dir / "train").mkdir()
+        ...     pl.DataFrame({"subject_id": [3, 1, 1]}).write_parquet(data_dir / "train/0.parquet")
+        ...     pl.DataFrame({"subject_id": [2]}).write_parquet(data_dir / "train/1.parquet")
+        ...     shard_subjects(data_dir).rows()
+        [(1, 'train/0'), (2, 'train/1'), (3, 'train/0')]
+    """
+    per_shard = [
+        pl.scan_parquet(fp)
+        .select(pl.col(meds.subject_id_field).cast(pl.Int64))
+        .unique()
+        .with_columns(pl.lit(shard).alias("shard"))
+        for shard, fp in list_shards(data_dir).items()
+    ]
+    if not per_shard:
+        return pl.DataFrame(schema={meds.subject_id_field: pl.Int64, "shard": pl.Utf8})
+    return pl.concat(per_shard).collect().sort(meds.subject_id_field)
+
+
+def stable_uniform(subject_id: int) -> float:
+    """Maps a subject ID to a float in [0, 1) that does not depend on process, platform, or input order.
+
+    Examples:
+        >>> stable_uniform(1)
+        0.42002...
+        >>> stable_uniform(1) == stable_uniform(1)
+        True
+    """
+    digest = hashlib.sha256(str(subject_id).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def assign_splits(subject_ids: list[int], splits: pl.DataFrame) -> pl.DataFrame:
+    """Assigns new subjects to splits deterministically, in proportion to the existing split sizes.
+
+    Args:
+        subject_ids: The IDs of the new subjects to assign.
+        splits: The existing `subject_splits` dataframe of the cohort.
+
+    Returns:
+        A dataframe with the columns `subject_id` and `split` for the new subjects, sorted by subject ID. The
+        assigned split of each subject depends only on its ID and the existing split proportions.
+
+    Examples:
+        >>> splits = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3, 4],
+        ...     "split": ["train", "train", "train", "held_out"],
+        ... })
+        >>> assign_splits([10, 12, 11, 13], splits).rows()
+        [(10, 'train'), (11, 'train'), (12, 'train'), (13, 'held_out')]
+        >>> assign_splits([], splits).shape
+        (0, 2)
+    """
+    counts = splits.group_by("split").len().sort("split")
+    total = counts["len"].sum()
+
+    boundaries = []
+    cumulative = 0
+    for split, n in counts.iter_rows():
+        cumulative += n
+        boundaries.append((cumulative / total, split))
+
+    def split_for(subject_id: int) -> str:
+        u = stable_uniform(subject_id)
+        for boundary, split in boundaries:
+            if u < boundary:
+                return split
+        return boundaries[-1][1]
+
+    subject_ids = sorted(subject_ids)
+    return pl.DataFrame(
+        {meds.subject_id_field: subject_ids, "split": [split_for(s) for s in subject_ids]},
+        schema={meds.subject_id_field: pl.Int64, "split": pl.Utf8},
+    )
+
+
+def plan_new_shards(
+    new_splits: pl.DataFrame, existing: pl.DataFrame, splits: pl.DataFrame, max_subjects_per_shard: int
+) -> dict[str, list[int]]:
+    """Plans which new shards the new subjects should be written to.
+
+    New shards are placed alongside the existing shards of the same split (e.g., `train/3` after `train/2`)
+    and are filled up to `max_subjects_per_shard` subjects each, in subject ID order.
+
+    Args:
+        new_splits: The split assignment of the new subjects, as returned by `assign_splits`.
+        existing: The existing subject to shard mapping, as returned by `shard_subjects`.
+        splits: The existing `subject_splits` dataframe of the cohort.
+        max_subjects_per_shard: The maximum number of subjects to put in each new shard.
+
+    Returns:
+        A dictionary mapping new shard names to the subjects they should contain.
+
+    Examples:
+        >>> existing = pl.DataFrame({"subject_id": [1, 2, 3], "shard": ["train/0", "train/1", "held_out/0"]})
+        >>> splits = pl.DataFrame({"subject_id": [1, 2, 3], "split": ["train", "train", "held_out"]})
+        >>> new_splits = pl.DataFrame({
+        ...     "subject_id": [5, 6, 7, 8],
+        ...     "split": ["train", "tuning", "train", "train"],
+        ... })
+        >>> plan_new_shards(new_splits, existing, splits, max_subjects_per_shard=2)
+        {'train/2': [5, 7], 'train/3': [8], 'tuning/0': [6]}
+    """
+    split_shards = existing.join(splits, on=meds.subject_id_field, how="inner").select("split", "shard")
+
+    new_shards = {}
+    new_by_split = new_splits.group_by("split", maintain_order=True).agg(meds.subject_id_field)
+    for split, subjects in new_by_split.rows():
+        shards = split_shards.filter(pl.col("split") == split)["shard"].unique().to_list()
+        parents = sorted({Path(s).parent.as_posix() for s in shards})
+        parent = Path(parents[0]) if len(parents) == 1 else Path(split)
+
+        used = [Path(s).name for s in shards if Path(s).parent == parent]
+        next_idx = max((int(n) + 1 for n in used if n.isdigit()), default=0)
+
+        subjects = sorted(subjects)
+        for start in range(0, len(subjects), max_subjects_per_shard):
+            name = (parent / str(next_idx)).as_posix()
+            new_shards[name] = subjects[start : start + max_subjects_per_shard]
+            next_idx += 1
+
+    return dict(sorted(new_shards.items()))
+
+
+def merge_events(existing: pl.DataFrame | None, delta: pl.DataFrame) -> pl.DataFrame:
+    """Merges the existing events of a shard with delta events, dropping delta events already in the shard.
+
+    Only delta events that exactly match an existing event are dropped (e.g., when an extract that overlaps
+    the last one is applied), so repeated events within the existing data or within the delta are kept.
+
+    The output is sorted by subject and time (with static, null-time events first), with ties kept in their
+    input order, existing events first. This makes the output a deterministic function of the inputs.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> existing = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2, 2],
+        ...     "time": [None, datetime(2020, 1, 2), datetime(2020, 1, 1), datetime(2020, 1, 1)],
+        ...     "code": ["SEX//F", "A", "B", "B"],
+        ... })
+        >>> delta = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "time": [None, datetime(2020, 1, 1), datetime(2020, 1, 1)],
+        ...     "code": ["SEX//F", "C", "B"],
+        ... })
+        >>> for row in merge_events(existing, delta).rows():
+        ...     print(row)
+        (1, None, 'SEX//F')
+        (1, datetime.datetime(2020, 1, 1, 0, 0), 'C')
+        (1, datetime.datetime(2020, 1, 2, 0, 0), 'A')
+        (2, datetime.datetime(2020, 1, 1, 0, 0), 'B')
+        (2, datetime.datetime(2020, 1, 1, 0, 0), 'B')
+        >>> merge_events(None, delta).shape
+        (3, 3)
+    """
+    if existing is None:
+        events = delta
+    else:
+        aligned = pl.concat([existing, delta], how="diagonal_relaxed")
+        existing, delta = aligned.head(len(existing)), aligned.tail(len(delta))
+        delta = delta.join(existing.unique(), on=aligned.columns, how="anti", join_nulls=True)
+        events = pl.concat([existing, delta])
+    return events.sort([meds.subject_id_field, meds.time_field], nulls_last=False, maintain_order=True)
+
+
+def write_atomic(df: pl.DataFrame, fp: Path):
+    """Writes a parquet file via a temporary file, so that readers never observe a partially written file."""
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_name(f".{fp.name}.tmp")
+    df.write_parquet(tmp_fp, use_pyarrow=True)
+    os.replace(tmp_fp, fp)
+
+
+def read_shard_versions(dir_path: Path) -> dict:
+    """Reads the shard version record of a dataset or labels directory.
+
+    Directories that were never refreshed have no record, in which case all their shards are considered to be
+    at the `BASE_VERSION`.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     read_shard_versions(Path(tmp_dir))
+        {'refreshes': [], 'shards': {}}
+    """
+    fp = Path(dir_path) / SHARD_VERSIONS_FN
+    if not fp.is_file():
+        return {"refreshes": [], "shards": {}}
+    return json.loads(fp.read_text())
+
+
+def write_shard_versions(dir_path: Path, versions: dict):
+    fp = Path(dir_path) / SHARD_VERSIONS_FN
+    tmp_fp = fp.with_name(f"{fp.name}.tmp")
+    tmp_fp.write_text(json.dumps(versions, indent=2, sort_keys=True))
+    os.replace(tmp_fp, fp)
+
+
+def refresh_id(delta_data_dir: Path) -> str:
+    """Computes a deterministic identifier for a delta from the contents of its data shards."""
+    h = hashlib.sha256()
+    for shard, fp in list_shards(delta_data_dir).items():
+        h.update(f"{shard}:{file_hash(fp)}".encode())
+    return h.hexdigest()[:16]
+
+
+def refresh_dataset(output_dir: Path, delta_dir: Path, max_subjects_per_shard: int | None = None) -> dict:
+    """Incrementally merges a MEDS-formatted delta cohort into a previously built MEDS cohort.
+
+    Args:
+        output_dir: The root directory of the previously built cohort. It is updated in place.
+        delta_dir: The root directory of a MEDS cohort containing only the new data.
+        max_subjects_per_shard: The maximum number of new subjects to write to each new shard. Defaults to the
+            largest number of subjects in any existing shard.
+
+    Returns:
+        A dictionary describing the refresh, with the keys `refresh_id`, `shards` (the names of the modified
+        or created shards), and `n_subjects` (the number of subjects whose data changed). If this delta has
+        already been applied, `shards` is empty.
+
+    Raises:
+        FileNotFoundError: If either cohort is missing its data directory or the existing cohort is missing
+            its subject splits.
+        RuntimeError: If another refresh of the cohort was interrupted and has not yet been completed.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> def write(root, fp, df):
+        ...     (root / fp).parent.mkdir(parents=True, exist_ok=True)
+        ...     df.write_parquet(root / fp)
+        >>> def events(subjects, day):
+        ...     return pl.DataFrame({
+        ...         "subject_id": subjects,
+        ...         "time": [datetime(2020, 1, day)] * len(subjects),
+        ...         "code": ["A"] * len(subjects),
+        ...     })
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     output_dir, delta_dir = Path(tmp_dir) / "out", Path(tmp_dir) / "delta"
+        ...     write(output_dir, "data/train/0.parquet", events([1, 2], 1))
+        ...     write(output_dir, "data/train/1.parquet", events([3], 1))
+        ...     write(output_dir, "data/held_out/0.parquet", events([4], 1))
+        ...     splits = pl.DataFrame({"subject_id": [1, 2, 3, 4], "split": ["train"] * 3 + ["held_out"]})
+        ...     write(output_dir, "metadata/subject_splits.parquet", splits)
+        ...     codes = pl.DataFrame({"code": ["A"], "description": ["a"]})
+        ...     write(output_dir, "metadata/codes.parquet", codes)
+        ...     write(delta_dir, "data/0.parquet", events([2, 10], 2).with_columns(code=pl.lit("B")))
+        ...     result = refresh_dataset(output_dir, delta_dir)
+        ...     print(result["shards"], result["n_subjects"])
+        ...     print(pl.read_parquet(output_dir / "data/train/0.parquet")["code"].to_list())
+        ...     print(pl.read_parquet(output_dir / "data/train/2.parquet").rows())
+        ...     print(pl.read_parquet(output_dir / "metadata/subject_splits.parquet").rows())
+        ...     print(pl.read_parquet(output_dir / "metadata/codes.parquet").rows())
+        ...     print(read_shard_versions(output_dir)["shards"] == {
+        ...         "held_out/0": "base", "train/0": result["refresh_id"], "train/1": "base",
+        ...         "train/2": result["refresh_id"],
+        ...     })
+        ...     print(refresh_dataset(output_dir, delta_dir)["shards"])
+        ['train/0', 'train/2'] 2
+        ['A', 'A', 'B']
+        [(10, datetime.datetime(2020, 1, 2, 0, 0), 'B')]
+        [(1, 'train'), (2, 'train'), (3, 'train'), (4, 'held_out'), (10, 'train')]
+        [('A', 'a'), ('B', None)]
+        True
+        []
+
+    A refresh interrupted after writing its new shards, but before adding their subjects to the splits, is
+    completed from its journal when it is re-run:
+
+        >>> from unittest.mock import patch
+        >>> def crash_on_splits(df, fp):
+        ...     if fp.name == "subject_splits.parquet":
+        ...         raise KeyboardInterrupt("crash")
+        ...     write_atomic(df, fp)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     output_dir, delta_dir = Path(tmp_dir) / "out", Path(tmp_dir) / "delta"
+        ...     write(output_dir, "data/train/0.parquet", events([1, 2], 1))
+        ...     write(output_dir, "metadata/subject_splits.parquet", splits.head(2))
+        ...     write(delta_dir, "data/0.parquet", events([2, 10], 2))
+        ...     with patch(f"{__name__}.write_atomic", crash_on_splits):
+        ...         try:
+        ...             _ = refresh_dataset(output_dir, delta_dir)
+        ...         except KeyboardInterrupt:
+        ...             pass
+        ...     print(pl.read_parquet(output_dir / "metadata/subject_splits.parquet").rows())
+        ...     print(refresh_dataset(output_dir, delta_dir)["shards"])
+        ...     print(pl.read_parquet(output_dir / "metadata/subject_splits.parquet").rows())
+        ...     print(pl.read_parquet(output_dir / "data/train/0.parquet").height)
+        ...     print((output_dir / REFRESH_JOURNAL_FN).exists())
+        [(1, 'train'), (2, 'train')]
+        ['train/0', 'train/1']
+        [(1, 'train'), (2, 'train'), (10, 'train')]
+        3
+        False
+    """
+    output_dir = Path(output_dir)
+    delta_dir = Path(delta_dir)
+    data_dir = output_dir / meds.data_subdirectory
+    delta_data_dir = delta_dir / meds.data_subdirectory
+    splits_fp = output_dir / meds.subject_splits_filepath
+
+    for d in (data_dir, delta_data_dir):
+        if not d.is_dir():
+            raise FileNotFoundError(f"Could not find MEDS data directory {d}.")
+    if not splits_fp.is_file():
+        raise FileNotFoundError(f"Could not find subject splits file {splits_fp}.")
+
+    rid = refresh_id(delta_data_dir)
+    versions = read_shard_versions(output_dir)
+    journal_fp = output_dir / REFRESH_JOURNAL_FN
+    journal = json.loads(journal_fp.read_text()) if journal_fp.is_file() else None
+
+    if rid in versions["refreshes"]:
+        logger.info(f"Delta {delta_dir} (refresh {rid}) has already been applied to {output_dir}.")
+        if journal is not None and journal["refresh_id"] == rid:
+            journal_fp.unlink()
+        return {"refresh_id": rid, "shards": [], "n_subjects": 0}
+    if journal is not None and journal["refresh_id"] != rid:
+        raise RuntimeError(
+            f"Refresh {journal['refresh_id']} of {output_dir} was interrupted; re-run it with its delta to "
+            "complete it before applying another."
+        )
+
+    delta = pl.concat(
+        [pl.scan_parquet(fp) for fp in list_shards(delta_data_dir).values()], how="diagonal_relaxed"
+    ).collect()
+    delta_subjects = delta[meds.subject_id_field].unique()
+    splits = pl.read_parquet(splits_fp, use_pyarrow=True)
+
+    if journal is None:
+        existing = shard_subjects(data_dir)
+        affected = existing.filter(pl.col(meds.subject_id_field).is_in(delta_subjects))
+        new_subjects = delta_subjects.filter(~delta_subjects.is_in(existing[meds.subject_id_field])).to_list()
+        new_splits = assign_splits(new_subjects, splits)
+
+        if max_subjects_per_shard is None:
+            max_subjects_per_shard = max(existing.group_by("shard").len()["len"].max() or 1, 1)
+
+        journal = {
+            "refresh_id": rid,
+            "affected": dict(affected.group_by("shard").agg(meds.subject_id_field).sort("shard").rows()),
+            "new_splits": new_splits.rows(),
+            "new_shards": plan_new_shards(new_splits, existing, splits, max_subjects_per_shard),
+        }
+        tmp_fp = journal_fp.with_name(f"{journal_fp.name}.tmp")
+        tmp_fp.write_text(json.dumps(journal, indent=2))
+        os.replace(tmp_fp, journal_fp)
+    else:
+        logger.info(f"Resuming the interrupted refresh {rid} of {output_dir} from {journal_fp}.")
+
+    new_splits = pl.DataFrame(
+        journal["new_splits"], schema={meds.subject_id_field: pl.Int64, "split": pl.Utf8}, orient="row"
+    )
+    logger.info(
+        f"Refresh {rid}: {len(delta_subjects)} subjects in delta; rewriting {len(journal['affected'])} "
+        f"existing shards and writing {len(journal['new_shards'])} new shards."
+    )
+
+    # Merging drops delta events already in a shard, so shards written before an interruption are unchanged
+    # when they are written again.
+    existing_shards = list_shards(data_dir)
+    changed = []
+    for shard, subjects in journal["affected"].items():
+        fp = existing_shards[shard]
+        shard_delta = delta.filter(pl.col(meds.subject_id_field).is_in(subjects))
+        write_atomic(merge_events(pl.read_parquet(fp, use_pyarrow=True), shard_delta), fp)
+        changed.append(shard)
+    for shard, subjects in journal["new_shards"].items():
+        fp = data_dir / f"{shard}.parquet"
+        shard_delta = delta.filter(pl.col(meds.subject_id_field).is_in(subjects))
+        existing_events = pl.read_parquet(fp, use_pyarrow=True) if fp.is_file() else None
+        write_atomic(merge_events(existing_events, shard_delta), fp)
+        changed.append(shard)
+
+    new_splits = new_splits.filter(~pl.col(meds.subject_id_field).is_in(splits[meds.subject_id_field]))
+    if len(new_splits):
+        write_atomic(pl.concat([splits, new_splits], how="vertical_relaxed"), splits_fp)
+
+    codes_fp = output_dir / meds.code_metadata_filepath
+    if codes_fp.is_file():
+        codes = pl.read_parquet(codes_fp, use_pyarrow=True)
+        delta_codes_fp = delta_dir / meds.code_metadata_filepath
+        if delta_codes_fp.is_file():
+            delta_codes = pl.read_parquet(delta_codes_fp, use_pyarrow=True)
+        else:
+            delta_codes = delta.select(pl.col(meds.code_field).unique())
+        new_codes = delta_codes.filter(~pl.col(meds.code_field).is_in(codes[meds.code_field])).sort(
+            meds.code_field
+        )
+        if len(new_codes):
+            write_atomic(pl.concat([codes, new_codes], how="diagonal_relaxed"), codes_fp)
+
+    for shard in existing_shards:
+        versions["shards"].setdefault(shard, BASE_VERSION)
+    for shard in changed:
+        versions["shards"][shard] = rid
+    versions["refreshes"].append(rid)
+    write_shard_versions(output_dir, versions)
+    journal_fp.unlink()
+
+    return {"refresh_id": rid, "shards": sorted(changed), "n_subjects": len(delta_subjects)}
+
+
+def stale_label_shards(dataset_dir: Path, labels_dir: Path) -> list[str]:
+    """Returns the label shards that are stale relative to the dataset they were extracted from.
+
+    A label shard is stale if the corresponding data shard was modified by a refresh after the labels were
+    extracted, or if the data shard was added by a refresh and has no labels yet.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     dataset_dir, labels_dir = Path(tmp_dir) / "data", Path(tmp_dir) / "labels"
+        ...     dataset_dir.mkdir()
+        ...     labels_dir.mkdir()
+        ...     print(stale_label_shards(dataset_dir, labels_dir))
+        ...     write_shard_versions(dataset_dir, {
+        ...         "refreshes": ["r1"], "shards": {"train/0": "r1", "train/1": "base", "train/2": "r1"}
+        ...     })
+        ...     print(stale_label_shards(dataset_dir, labels_dir))
+        ...     record_label_shard_versions(dataset_dir, labels_dir)
+        ...     print(stale_label_shards(dataset_dir, labels_dir))
+        []
+        ['train/0', 'train/2']
+        []
+    """
+    data_versions = read_shard_versions(dataset_dir)["shards"]
+    label_versions = read_shard_versions(labels_dir)["shards"]
+    return sorted(shard for shard, v in data_versions.items() if label_versions.get(shard, BASE_VERSION) != v)
+
+
+def record_label_shard_versions(dataset_dir: Path, labels_dir: Path):
+    """Records the dataset shard versions that a labels directory is now up to date with."""
+    data_versions = read_shard_versions(dataset_dir)
+    if data_versions["shards"]:
+        write_shard_versions(labels_dir, data_versions)
@@ -1,25 +1,203 @@
+import json
 import logging
+from pathlib import Path
 
 import hydra
-from omegaconf import DictConfig
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
 
+from ..budget import USAGE_FILE
+from ..plan import TO_RUN, Plan, PlanNode
+from ..predictions import prediction_files, predictions_glob, validate_prediction_files
 from ..utils import run_in_env
 from . import CFG_YAML
+from .batch import (
+    RESULTS_FN,
+    evaluate_batch,
+    evaluate_predictions_dir,
+    predictions_dir_key,
+    resolve_predictions_dirs,
+    run_names,
+)
+from .result_cache import (
+    cached_evaluation,
+    evaluation_key,
+    evaluation_status,
+    predictions_path_files,
+)
 
 logger = logging.getLogger(__name__)
 
 
-@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
-def main(cfg: DictConfig):
+def _options(cfg: DictConfig, key: str) -> dict | None:
+    """Returns the keyword arguments of an optional evaluation step, or `None` if it is disabled.
+
+    Examples:
+        >>> print(_options(DictConfig({"streaming": {"enabled": False, "exact": True}}), "streaming"))
+        None
+        >>> _options(DictConfig({"streaming": {"enabled": True, "exact": True, "n_bins": 10}}), "streaming")
+        {'exact': True, 'n_bins': 10}
+    """
+    options = cfg.get(key, None)
+    if not options or not options.get("enabled", False):
+        return None
+    return {k: v for k, v in OmegaConf.to_container(options, resolve=True).items() if k != "enabled"}
+
+
+def _cli_evaluation(cfg: DictConfig) -> tuple[str, list[Path], str]:
+    """Returns the `meds-evaluation-cli` command, the prediction files it evaluates, and its key."""
+    predictions_path = cfg.predictions_path
+    if predictions_path is None:
+        predictions_path = predictions_glob(cfg.predictions_dir)
+
     cmd_parts = [
         "meds-evaluation-cli",
-        f'predictions_path="{cfg.predictions_path}"',
+        f'predictions_path="{predictions_path}"',
         f'output_dir="{cfg.output_dir}"',
     ]
     cmd = " ".join(cmd_parts)
 
-    logger.info(f"Running MEDS-Evaluation: {cmd}")
+    files, root = predictions_path_files(predictions_path)
+    key = evaluation_key(files, root, {"engine": "meds-evaluation-cli"}, cfg.get("full_fingerprint", False))
+    return cmd, files, key
+
+
+def plan(cfg: DictConfig) -> Plan:
+    """Returns the plan of an evaluation: which prediction directories `run` would evaluate, or re-use.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> from MEDS_DEV.api import compose_config
+        >>> from MEDS_DEV.predictions import write_prediction_shard
+        >>> predictions = pl.DataFrame({
+        ...     "subject_id": [1, 2],
+        ...     "prediction_time": [datetime(2021, 1, 1)] * 2,
+        ...     "boolean_value": [False, True],
+        ...     "predicted_boolean_value": [False, True],
+        ...     "predicted_boolean_probability": [0.1, 0.9],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     write_prediction_shard(predictions, root / "A" / "predictions" / "0.parquet")
+        ...     write_prediction_shard(predictions, root / "B" / "predictions" / "0.parquet")
+        ...     (root / "C").mkdir()
+        ...     dirs = [root / "A", root / "B", root / "C"]
+        ...     cfg = compose_config("evaluation", predictions_dirs=dirs, output_dir=root / "eval", plan=True)
+        ...     first = compose_config(
+        ...         "evaluation", output_dir=root / "eval" / "A", predictions_dir=root / "A", in_process=True
+        ...     )
+        ...     _ = run(first)
+        ...     write_prediction_shard(predictions[:1], root / "A" / "predictions" / "0.parquet")
+        ...     print(str(run(cfg)).replace(tmp_dir, "..."))
+        Plan of meds-dev-evaluation: 3 nodes (0 cached, 1 stale, 2 to-run) (3 not estimated).
+        [stale] A: predictions or evaluation options changed
+            command: in-process evaluation of .../A
+            output_dir: .../eval/A
+        [to-run] B: not yet evaluated
+            command: in-process evaluation of .../B
+            output_dir: .../eval/B
+        [to-run] C: no predictions yet
+            command: in-process evaluation of .../C
+            output_dir: .../eval/C
+    """
+    cache_dir = Path(cfg.cache_dir) / "evaluations" if cfg.get("cache_dir", None) else None
+    full_fingerprint = cfg.get("full_fingerprint", False)
+    result = Plan("meds-dev-evaluation")
+
+    def add_node(name: str, command: str, output_dir: Path, files: list[Path], key: str):
+        if files:
+            status, reason = evaluation_status(output_dir, key, cache_dir, cfg.do_overwrite)
+        else:
+            status, reason = TO_RUN, "no predictions yet"
+        result.nodes.append(PlanNode(name, command, output_dir, status, reason))
+
+    options = {key: _options(cfg, key) for key in ("streaming", "bootstrap", "subgroups")}
+    if cfg.get("predictions_dirs", None) or cfg.get("manifest_fp", None):
+        predictions_dirs = resolve_predictions_dirs(cfg.predictions_dirs, cfg.manifest_fp)
+        runs = [(name, d, Path(cfg.output_dir) / name) for d, name in run_names(predictions_dirs).items()]
+    elif cfg.get("in_process", False) or any(v is not None for v in options.values()):
+        runs = [("evaluation", Path(cfg.predictions_dir), Path(cfg.output_dir))]
+    else:
+        cmd, files, key = _cli_evaluation(cfg)
+        add_node("evaluation", cmd, Path(cfg.output_dir), files, key)
+        return result
+
+    for name, predictions_dir, output_dir in runs:
+        key = predictions_dir_key(predictions_dir, **options, full_fingerprint=full_fingerprint)
+        command = f"in-process evaluation of {predictions_dir}"
+        add_node(name, command, output_dir, prediction_files(predictions_dir), key)
+    return result
 
-    run_in_env(cmd=cmd, output_dir=cfg.output_dir, do_overwrite=cfg.do_overwrite, run_as_script=False)
 
-    logger.info(f"Evaluation command {cmd} finished successfully.")
+def run(cfg: DictConfig) -> dict | pl.DataFrame | Plan:
+    """Evaluates predictions, as configured by `_evaluate_predictions.yaml`.
+
+    Returns:
+        The evaluation results, as written to `results.json`, or the consolidated results table of a batch. If
+        `cfg.plan` is set, the plan of the evaluation (see `plan`) is returned instead, without evaluating.
+    """
+    if cfg.get("plan", False):
+        return plan(cfg)
+
+    cache_dir = Path(cfg.cache_dir) / "evaluations" if cfg.get("cache_dir", None) else None
+    cache_kwargs = {"cache_dir": cache_dir, "full_fingerprint": cfg.get("full_fingerprint", False)}
+    validate = cfg.get("validate", True)
+
+    if cfg.get("predictions_dirs", None) or cfg.get("manifest_fp", None):
+        predictions_dirs = resolve_predictions_dirs(cfg.predictions_dirs, cfg.manifest_fp)
+        table = evaluate_batch(
+            predictions_dirs,
+            Path(cfg.output_dir),
+            num_workers=cfg.num_workers,
+            do_overwrite=cfg.do_overwrite,
+            streaming=_options(cfg, "streaming"),
+            bootstrap=_options(cfg, "bootstrap"),
+            subgroups=_options(cfg, "subgroups"),
+            validate=validate,
+            **cache_kwargs,
+        )
+        logger.info(
+            f"Batch evaluation of {len(predictions_dirs)} prediction directories finished successfully."
+        )
+        return table
+
+    options = {key: _options(cfg, key) for key in ("streaming", "bootstrap", "subgroups")}
+    if cfg.get("in_process", False) or any(v is not None for v in options.values()):
+        results = evaluate_predictions_dir(
+            cfg.predictions_dir,
+            Path(cfg.output_dir),
+            do_overwrite=cfg.do_overwrite,
+            **options,
+            validate=validate,
+            **cache_kwargs,
+        )
+        logger.info(f"In-process evaluation of {cfg.predictions_dir} finished successfully.")
+        return results
+
+    cmd, files, key = _cli_evaluation(cfg)
+
+    def evaluate():
+        if validate:
+            validate_prediction_files(files)
+        logger.info(f"Running MEDS-Evaluation: {cmd}")
+        run_in_env(cmd=cmd, output_dir=cfg.output_dir, run_as_script=False)
+
+    reused = cached_evaluation(
+        Path(cfg.output_dir),
+        key,
+        evaluate,
+        outputs=[RESULTS_FN, USAGE_FILE],
+        cache_dir=cache_dir,
+        do_overwrite=cfg.do_overwrite,
+    )
+    if not reused:
+        logger.info(f"Evaluation command {cmd} finished successfully.")
+    return json.loads((Path(cfg.output_dir) / RESULTS_FN).read_text())
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    result = run(cfg)
+    if cfg.get("plan", False):
+        print(result)
@@ -0,0 +1,390 @@
+"""Batch evaluation of many prediction directories in one long-lived process pool.
+
+Rather than starting one `meds-evaluation-cli` process per set of predictions (each paying for interpreter
+startup and for importing polars and scikit-learn), the prediction directories of a batch are evaluated
+in-process by a pool of worker processes, each of which evaluates many directories. Each directory's results
+are written to `results.json` in its own output directory, exactly as `meds-evaluation` would write them,
+and all results are consolidated into one `results.parquet` table.
+"""
+
+import glob
+import json
+import logging
+import multiprocessing
+import os
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import polars as pl
+from meds_evaluation.evaluate import evaluate_binary_classification
+
+from ..cache import dataset_fingerprint
+from ..predictions import (
+    prediction_files,
+    predictions_root,
+    scan_predictions,
+    validate_predictions,
+)
+from ..resources import available_cpus
+from .bootstrap import bootstrap_cis
+from .result_cache import cached_evaluation, evaluation_key
+from .streaming import evaluate_streaming
+from .subgroups import SUBGROUPS_FN, evaluate_subgroups
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FN = "results.json"
+TABLE_FN = "results.parquet"
+
+
+def resolve_predictions_dirs(
+    predictions_dirs: str | Iterable[str] | None = None, manifest_fp: Path | str | None = None
+) -> list[Path]:
+    """Returns the prediction directories of a batch, in a stable order and without duplicates.
+
+    Args:
+        predictions_dirs: A (recursive) glob pattern matching prediction directories, or a list of them.
+        manifest_fp: A text file listing one prediction directory per line. Blank lines and lines starting
+            with `#` are ignored.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for d in ("D1/t1/predict", "D1/t2/predict", "D2/t1/predict", "D2/t1/train"):
+        ...         (root / d).mkdir(parents=True)
+        ...     manifest_fp = root / "manifest.txt"
+        ...     _ = manifest_fp.write_text(f"# Extra runs\\n{root}/D2/t1/train\\n\\n{root}/D1/t1/predict\\n")
+        ...     dirs = resolve_predictions_dirs(f"{root}/**/predict", manifest_fp)
+        ...     print([str(d.relative_to(root)) for d in dirs])
+        ...     print(len(resolve_predictions_dirs([f"{root}/D1/t1/predict"])))
+        ['D1/t1/predict', 'D1/t2/predict', 'D2/t1/predict', 'D2/t1/train']
+        1
+    """
+    dirs = []
+    if isinstance(predictions_dirs, str):
+        dirs.extend(sorted(Path(p) for p in glob.glob(predictions_dirs, recursive=True) if Path(p).is_dir()))
+    elif predictions_dirs:
+        dirs.extend(Path(p) for p in predictions_dirs)
+
+    if manifest_fp:
+        for line in Path(manifest_fp).read_text().splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                dirs.append(Path(line))
+
+    return list(dict.fromkeys(dirs))
+
+
+def run_names(predictions_dirs: list[Path]) -> dict[Path, str]:
+    """Names each prediction directory by its path relative to the common root of all of them.
+
+    Examples:
+        >>> run_names([Path("exp/D1/t1/predict"), Path("exp/D2/t1/predict")])
+        {PosixPath('exp/D1/t1/predict'): 'D1/t1/predict', PosixPath('exp/D2/t1/predict'): 'D2/t1/predict'}
+        >>> run_names([Path("exp/D1/t1/predict")])
+        {PosixPath('exp/D1/t1/predict'): 'predict'}
+    """
+    if len(predictions_dirs) == 1:
+        return {predictions_dirs[0]: predictions_dirs[0].resolve().name}
+    root = Path(os.path.commonpath([d.resolve() for d in predictions_dirs]))
+    return {d: d.resolve().relative_to(root).as_posix() for d in predictions_dirs}
+
+
+def _evaluate(
+    predictions_dir: Path,
+    output_dir: Path,
+    samples_per_subject: int,
+    resampling_seed: int,
+    streaming: dict | None,
+    bootstrap: dict | None,
+    subgroups: dict | None,
+    validate: bool,
+):
+    if validate:
+        validate_predictions(predictions_dir)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if subgroups is not None:
+        tmp_fp = output_dir / f".{SUBGROUPS_FN}.tmp"
+        evaluate_subgroups(predictions_dir, **subgroups).write_parquet(tmp_fp)
+        os.replace(tmp_fp, output_dir / SUBGROUPS_FN)
+
+    if streaming is not None:
+        results = evaluate_streaming(predictions_dir, **streaming)
+    else:
+        predictions = scan_predictions(predictions_dir).collect()
+        results = evaluate_binary_classification(
+            predictions, samples_per_subject=samples_per_subject, resampling_seed=resampling_seed
+        )
+    if bootstrap is not None:
+        for weighting, cis in bootstrap_cis(predictions_dir, **bootstrap).items():
+            results.setdefault(weighting, {}).update(cis)
+
+    tmp_fp = output_dir / f".{RESULTS_FN}.tmp"
+    tmp_fp.write_text(json.dumps(results, indent=4))
+    os.replace(tmp_fp, output_dir / RESULTS_FN)
+    (output_dir / ".done").touch()
+
+
+def predictions_dir_key(
+    predictions_dir: Path,
+    samples_per_subject: int = 4,
+    resampling_seed: int = 0,
+    streaming: dict | None = None,
+    bootstrap: dict | None = None,
+    subgroups: dict | None = None,
+    full_fingerprint: bool = False,
+) -> str:
+    """Returns the key of the evaluation of a prediction directory by `evaluate_predictions_dir`."""
+    # Worker counts do not change results, so are not part of the key.
+    options = {"streaming": streaming, "bootstrap": bootstrap, "subgroups": subgroups}
+    config = {
+        "samples_per_subject": samples_per_subject,
+        "resampling_seed": resampling_seed,
+        **{k: {n: v for n, v in (o or {}).items() if n != "num_workers"} for k, o in options.items()},
+    }
+    if subgroups is not None and subgroups.get("dataset_dir", None) is not None:
+        config["dataset_fingerprint"] = dataset_fingerprint(subgroups["dataset_dir"])
+    files = prediction_files(predictions_dir)
+    return evaluation_key(files, predictions_root(predictions_dir), config, full_fingerprint)
+
+
+def evaluate_predictions_dir(
+    predictions_dir: Path,
+    output_dir: Path,
+    samples_per_subject: int = 4,
+    resampling_seed: int = 0,
+    do_overwrite: bool = False,
+    streaming: dict | None = None,
+    bootstrap: dict | None = None,
+    subgroups: dict | None = None,
+    cache_dir: Path | None = None,
+    full_fingerprint: bool = False,
+    validate: bool = True,
+) -> dict:
+    """Evaluates the predictions in a directory in-process, as `meds-evaluation-cli` would.
+
+    Results are keyed by the content of the predictions and the evaluation options (see
+    `MEDS_DEV.evaluation.result_cache`): results already written with the same key (e.g., by an interrupted
+    batch) or stored in the evaluation cache in `cache_dir` are re-used unless `do_overwrite` is set, and
+    stale results are recomputed.
+
+    If `streaming` is given, predictions are evaluated out-of-core by
+    `MEDS_DEV.evaluation.streaming.evaluate_streaming`, with `streaming` as its keyword arguments, rather than
+    loaded into memory. If `bootstrap` is given, subject-clustered bootstrap confidence intervals of all
+    metrics are added to the results, by `MEDS_DEV.evaluation.bootstrap.bootstrap_cis` with `bootstrap` as its
+    keyword arguments. If `subgroups` is given, the metrics of each subgroup are written to
+    `subgroups.parquet` in `output_dir`, by `MEDS_DEV.evaluation.subgroups.evaluate_subgroups` with
+    `subgroups` as its keyword arguments.
+
+    Unless `validate` is unset, predictions are first validated shard by shard (see
+    `MEDS_DEV.predictions.validate_prediction_files`), so that invalid predictions fail fast, with every
+    problem listed, rather than partway through the evaluation.
+
+    Returns:
+        The evaluation results, as written to `results.json` in `output_dir`.
+    """
+    output_dir = Path(output_dir)
+    key = predictions_dir_key(
+        predictions_dir,
+        samples_per_subject,
+        resampling_seed,
+        streaming,
+        bootstrap,
+        subgroups,
+        full_fingerprint,
+    )
+
+    cached_evaluation(
+        output_dir,
+        key,
+        lambda: _evaluate(
+            predictions_dir,
+            output_dir,
+            samples_per_subject,
+            resampling_seed,
+            streaming,
+            bootstrap,
+            subgroups,
+            validate,
+        ),
+        outputs=[RESULTS_FN, SUBGROUPS_FN],
+        cache_dir=cache_dir,
+        do_overwrite=do_overwrite,
+    )
+    return json.loads((output_dir / RESULTS_FN).read_text())
+
+
+def results_table(results: dict[str, dict]) -> pl.DataFrame:
+    """Consolidates evaluation results into one table, with one row per run and weighting.
+
+    Only scalar metrics are included; curve-based metrics remain in each run's `results.json`.
+
+    Examples:
+        >>> results = {
+        ...     "D1/t1": {"samples_equally_weighted": {"roc_auc_score": 0.7, "curve": [0.1, 0.2]}},
+        ...     "D2/t1": {"samples_equally_weighted": {"roc_auc_score": 0.6, "f1_score": 0.5}},
+        ... }
+        >>> results_table(results)
+        shape: (2, 4)
+        ┌───────┬──────────────────────────┬───────────────┬──────────┐
+        │ run   ┆ weighting                ┆ roc_auc_score ┆ f1_score │
+        │ ---   ┆ ---                      ┆ ---           ┆ ---      │
+        │ str   ┆ str                      ┆ f64           ┆ f64      │
+        ╞═══════╪══════════════════════════╪═══════════════╪══════════╡
+        │ D1/t1 ┆ samples_equally_weighted ┆ 0.7           ┆ null     │
+        │ D2/t1 ┆ samples_equally_weighted ┆ 0.6           ┆ 0.5      │
+        └───────┴──────────────────────────┴───────────────┴──────────┘
+    """
+    rows = []
+    for run, run_results in results.items():
+        for weighting, metrics in run_results.items():
+            scalars = {k: float(v) for k, v in metrics.items() if isinstance(v, int | float)}
+            rows.append({"run": run, "weighting": weighting, **scalars})
+    return pl.from_dicts(rows, infer_schema_length=None)
+
+
+def evaluate_batch(
+    predictions_dirs: list[Path],
+    output_dir: Path,
+    num_workers: int | None = None,
+    samples_per_subject: int = 4,
+    resampling_seed: int = 0,
+    do_overwrite: bool = False,
+    streaming: dict | None = None,
+    bootstrap: dict | None = None,
+    subgroups: dict | None = None,
+    cache_dir: Path | None = None,
+    full_fingerprint: bool = False,
+    validate: bool = True,
+) -> pl.DataFrame:
+    """Evaluates many prediction directories in one process pool.
+
+    The results of each directory are written to `results.json` under `output_dir`, at the directory's name
+    from `run_names`, and all results are consolidated into `output_dir/results.parquet` (which is also
+    returned), with the `run` and `predictions_dir` of each row. If any directory fails to evaluate, the
+    others are still evaluated and consolidated before an error is raised.
+
+    Args:
+        predictions_dirs: The prediction directories to evaluate.
+        output_dir: The root output directory of the batch.
+        num_workers: The number of worker processes; by default, the number of available CPUs.
+        samples_per_subject: As for `meds-evaluation`.
+        resampling_seed: As for `meds-evaluation`.
+        do_overwrite: Whether to re-evaluate directories whose (up-to-date) results already exist.
+        streaming: The streaming evaluation options, if predictions should be evaluated out-of-core (see
+            `evaluate_predictions_dir`).
+        bootstrap: The bootstrap options, if confidence intervals should be computed (see
+            `evaluate_predictions_dir`).
+        subgroups: The subgroup options, if subgroups should be evaluated (see `evaluate_predictions_dir`).
+            The subgroup metrics of all runs are consolidated into `output_dir/subgroups.parquet`.
+        cache_dir: The evaluation cache directory, if any (see `evaluate_predictions_dir`).
+        full_fingerprint: Whether to fully hash prediction files to key their results.
+        validate: Whether to validate each directory's predictions before evaluating them.
+
+    Raises:
+        ValueError: If no prediction directories are given, or if any of them failed to evaluate.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> from ..predictions import write_prediction_shard
+        >>> def predictions(probabilities: list[float]) -> pl.DataFrame:
+        ...     return pl.DataFrame({
+        ...         "subject_id": [1, 2, 3, 4],
+        ...         "prediction_time": [datetime(2021, 1, 1)] * 4,
+        ...         "boolean_value": [False, True, False, True],
+        ...         "predicted_boolean_value": [p > 0.5 for p in probabilities],
+        ...         "predicted_boolean_probability": probabilities,
+        ...     })
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for name, probabilities in [("A", [0.1, 0.9, 0.2, 0.8]), ("B", [0.9, 0.1, 0.2, 0.8])]:
+        ...         shard_fp = root / "exp" / name / "predictions" / "0.parquet"
+        ...         write_prediction_shard(predictions(probabilities), shard_fp)
+        ...     dirs = resolve_predictions_dirs(f"{root}/exp/*")
+        ...     table = evaluate_batch(dirs, root / "eval", num_workers=2)
+        ...     print(sorted(str(fp.relative_to(root / "eval")) for fp in (root / "eval").rglob("*.json")))
+        ...     print(pl.read_parquet(root / "eval" / "results.parquet").equals(table))
+        ['A/results.json', 'B/results.json']
+        True
+        >>> table.select("run", "weighting", "roc_auc_score", "binary_accuracy")
+        shape: (4, 4)
+        ┌─────┬───────────────────────────┬───────────────┬─────────────────┐
+        │ run ┆ weighting                 ┆ roc_auc_score ┆ binary_accuracy │
+        │ --- ┆ ---                       ┆ ---           ┆ ---             │
+        │ str ┆ str                       ┆ f64           ┆ f64             │
+        ╞═════╪═══════════════════════════╪═══════════════╪═════════════════╡
+        │ A   ┆ samples_equally_weighted  ┆ 1.0           ┆ 1.0             │
+        │ A   ┆ subjects_equally_weighted ┆ 1.0           ┆ 1.0             │
+        │ B   ┆ samples_equally_weighted  ┆ 0.25          ┆ 0.5             │
+        │ B   ┆ subjects_equally_weighted ┆ 0.25          ┆ 0.5             │
+        └─────┴───────────────────────────┴───────────────┴─────────────────┘
+        >>> evaluate_batch([], Path("eval"))
+        Traceback (most recent call last):
+            ...
+        ValueError: No prediction directories to evaluate.
+    """
+    if not predictions_dirs:
+        raise ValueError("No prediction directories to evaluate.")
+
+    output_dir = Path(output_dir)
+    names = run_names(predictions_dirs)
+    n_workers = min(num_workers or available_cpus(), len(predictions_dirs))
+    logger.info(f"Evaluating {len(predictions_dirs)} prediction directories with {n_workers} workers.")
+
+    results, failed = {}, {}
+    # Polars is multi-threaded, so worker processes are spawned rather than forked.
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+        futures = {
+            pool.submit(
+                evaluate_predictions_dir,
+                predictions_dir,
+                output_dir / names[predictions_dir],
+                samples_per_subject,
+                resampling_seed,
+                do_overwrite,
+                streaming,
+                bootstrap,
+                subgroups,
+                cache_dir,
+                full_fingerprint,
+                validate,
+            ): predictions_dir
+            for predictions_dir in predictions_dirs
+        }
+        for future in as_completed(futures):
+            predictions_dir = futures[future]
+            try:
+                results[predictions_dir] = future.result()
+                logger.info(f"Evaluated {predictions_dir}.")
+            except Exception as e:
+                logger.error(f"Failed to evaluate {predictions_dir}: {e}")
+                failed[predictions_dir] = e
+
+    if results:
+        evaluated = [d for d in predictions_dirs if d in results]
+        table = results_table({names[d]: results[d] for d in evaluated}).with_columns(
+            pl.col("run").replace_strict({names[d]: str(d) for d in evaluated}).alias("predictions_dir")
+        )
+        output_dir.mkdir(parents=True, exist_ok=True)
+        table.write_parquet(output_dir / TABLE_FN)
+        logger.info(f"Wrote the consolidated results of {len(evaluated)} runs to {output_dir / TABLE_FN}.")
+        if subgroups is not None:
+            subgroup_tables = [
+                pl.read_parquet(output_dir / names[d] / SUBGROUPS_FN).select(
+                    pl.lit(names[d]).alias("run"), pl.lit(str(d)).alias("predictions_dir"), pl.all()
+                )
+                for d in evaluated
+            ]
+            pl.concat(subgroup_tables, how="diagonal_relaxed").write_parquet(output_dir / SUBGROUPS_FN)
+
+    if failed:
+        first_error = next(iter(failed.values()))
+        raise ValueError(
+            f"Failed to evaluate {len(failed)} prediction directories: {sorted(map(str, failed))}"
+        ) from first_error
+    return table
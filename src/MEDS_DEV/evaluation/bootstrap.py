@@ -0,0 +1,312 @@
+"""Subject-clustered bootstrap confidence intervals, from per-subject sufficient statistics.
+
+Rather than re-sampling and re-scoring millions of predictions for each replicate, predictions are reduced
+once to per-subject sufficient statistics (label counts per probability bin, probability sums, and confusion
+counts), as in `MEDS_DEV.evaluation.streaming`. Each replicate then draws a Poisson(1) weight per subject (a
+Poisson bootstrap, which approximates re-sampling subjects with replacement) and all metrics of a batch of
+replicates are computed at once, as sparse products of those statistics with the subject weights. Batches of
+replicates are spread over threads, and each batch has its own seed, so results do not depend on the number of
+workers.
+
+Ranking metrics are computed from probabilities binned into `n_bins` equal-width bins, as in the approximate
+mode of streaming evaluation.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from meds_evaluation.schema import (
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTED_BOOLEAN_VALUE_FIELD,
+    SUBJECT_ID_FIELD,
+)
+from scipy import sparse
+
+from ..predictions import prediction_files
+from ..resources import available_cpus
+from .streaming import N_CALIBRATION_BINS, WEIGHTINGS
+
+logger = logging.getLogger(__name__)
+
+N_REPLICATES = 1000
+CONFIDENCE = 0.95
+N_BINS = 1000
+METRICS = (
+    "binary_accuracy",
+    "f1_score",
+    "roc_auc_score",
+    "average_precision_score",
+    "brier_score_loss",
+    "calibration_error",
+)
+
+# The maximum number of (replicate, subject) weights materialized at once by each worker.
+_MAX_BATCH_ELEMENTS = 20_000_000
+
+
+def subject_bin_stats(predictions: pl.LazyFrame, n_bins: int = N_BINS) -> pl.DataFrame:
+    """Reduces predictions to sufficient statistics per subject and probability bin.
+
+    Examples:
+        >>> predictions = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "boolean_value": [True, False, True],
+        ...     "predicted_boolean_value": [True, True, False],
+        ...     "predicted_boolean_probability": [0.9, 0.6, 0.4],
+        ... })
+        >>> stats = subject_bin_stats(predictions, n_bins=2).sort("subject_id", "bin")
+        >>> stats.select("subject_id", "bin", "n_pos", "n_neg", "sum_sq_error", "n_subject")
+        shape: (2, 6)
+        ┌────────────┬─────┬───────┬───────┬──────────────┬───────────┐
+        │ subject_id ┆ bin ┆ n_pos ┆ n_neg ┆ sum_sq_error ┆ n_subject │
+        │ ---        ┆ --- ┆ ---   ┆ ---   ┆ ---          ┆ ---       │
+        │ i64        ┆ i64 ┆ f64   ┆ f64   ┆ f64          ┆ f64       │
+        ╞════════════╪═════╪═══════╪═══════╪══════════════╪═══════════╡
+        │ 1          ┆ 1   ┆ 1.0   ┆ 1.0   ┆ 0.37         ┆ 2.0       │
+        │ 2          ┆ 0   ┆ 1.0   ┆ 0.0   ┆ 0.36         ┆ 1.0       │
+        └────────────┴─────┴───────┴───────┴──────────────┴───────────┘
+    """
+    p = pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD).cast(pl.Float64)
+    y = pl.col(BOOLEAN_VALUE_FIELD).cast(pl.Float64)
+    y_hat = pl.col(PREDICTED_BOOLEAN_VALUE_FIELD).cast(pl.Float64)
+    return (
+        predictions.with_columns(
+            bin=(p * n_bins).floor().clip(0, n_bins - 1).cast(pl.Int64),
+            n_subject=pl.len().over(SUBJECT_ID_FIELD).cast(pl.Float64),
+        )
+        .group_by(SUBJECT_ID_FIELD, "bin")
+        .agg(
+            n_pos=y.sum(),
+            n_neg=(1 - y).sum(),
+            sum_p=p.sum(),
+            sum_sq_error=((p - y) ** 2).sum(),
+            tp=(y * y_hat).sum(),
+            fp=((1 - y) * y_hat).sum(),
+            n_subject=pl.col("n_subject").first(),
+        )
+        .collect()
+    )
+
+
+def _replicate_metrics(
+    pos: np.ndarray,
+    neg: np.ndarray,
+    cal_starts: np.ndarray,
+    cal_sum_p: np.ndarray,
+    sum_sq_error: np.ndarray,
+    tp: np.ndarray,
+    fp: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """Computes the metrics of each replicate (row) from its weighted counts per bin, in ascending order.
+
+    Calibration bins are the groups of bins starting at `cal_starts`.
+    """
+    n_pos, n_neg = pos.sum(axis=1), neg.sum(axis=1)
+    n = n_pos + n_neg
+    cal_pos = np.add.reduceat(pos, cal_starts, axis=1)
+    cal_total = cal_pos + np.add.reduceat(neg, cal_starts, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Bins are reversed into descending order of score, as in `streaming.sketch_metrics`.
+        pos, neg = pos[:, ::-1], neg[:, ::-1]
+        cum_pos = np.cumsum(pos, axis=1)
+        auroc = (neg * (cum_pos - pos / 2)).sum(axis=1) / (n_pos * n_neg)
+        precision = np.nan_to_num(cum_pos / np.cumsum(pos + neg, axis=1))
+        auprc = (pos * precision).sum(axis=1) / n_pos
+
+        fraction_of_positives = cal_pos / cal_total
+        mean_predicted_probability = cal_sum_p / cal_total
+        calibration_error = np.nanmean(np.abs(fraction_of_positives - mean_predicted_probability), axis=1)
+
+        f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + (n_pos - tp)), 0.0)
+
+    return {
+        "binary_accuracy": (tp + n_neg - fp) / n,
+        "f1_score": f1,
+        "roc_auc_score": np.where((n_pos > 0) & (n_neg > 0), auroc, np.nan),
+        "average_precision_score": np.where(n_pos > 0, auprc, np.nan),
+        "brier_score_loss": sum_sq_error / n,
+        "calibration_error": calibration_error,
+    }
+
+
+def bootstrap_replicates(
+    stats: pl.DataFrame,
+    n_replicates: int = N_REPLICATES,
+    n_bins: int = N_BINS,
+    n_calibration_bins: int = N_CALIBRATION_BINS,
+    seed: int = 0,
+    num_workers: int = 1,
+) -> dict[str, dict[str, np.ndarray]]:
+    """Computes the metrics of each Poisson bootstrap replicate of the subjects in `stats`.
+
+    Args:
+        stats: The per-subject and per-bin statistics of all predictions, from `subject_bin_stats`.
+        n_replicates: The number of bootstrap replicates.
+        n_bins: The number of probability bins `stats` was computed with.
+        n_calibration_bins: The number of bins of the calibration curve.
+        seed: The random seed.
+        num_workers: The number of threads computing batches of replicates.
+
+    Returns:
+        The array of each metric's values over replicates, for each weighting.
+
+    Examples:
+        >>> rng = np.random.default_rng(0)
+        >>> y = rng.random(3000) < 0.3
+        >>> predictions = pl.LazyFrame({
+        ...     "subject_id": np.arange(3000) // 3,
+        ...     "boolean_value": y,
+        ...     "predicted_boolean_value": y,
+        ...     "predicted_boolean_probability": np.clip(0.3 * y + rng.random(3000) * 0.7, 0, 1),
+        ... })
+        >>> stats = subject_bin_stats(predictions)
+        >>> replicates = bootstrap_replicates(stats, n_replicates=200, num_workers=2)
+        >>> auroc = replicates["samples_equally_weighted"]["roc_auc_score"]
+        >>> auroc.shape, bool(0.8 < auroc.mean() < 0.85), bool(0.005 < auroc.std() < 0.02)
+        ((200,), True, True)
+        >>> bool(np.allclose(replicates["subjects_equally_weighted"]["binary_accuracy"], 1))
+        True
+
+    Replicates do not depend on the number of workers:
+        >>> again = bootstrap_replicates(stats, n_replicates=200, num_workers=1)
+        >>> bool(np.array_equal(again["samples_equally_weighted"]["roc_auc_score"], auroc))
+        True
+    """
+    subject_idx = stats[SUBJECT_ID_FIELD].rank("dense").cast(pl.Int64).to_numpy() - 1
+    n_subjects = int(subject_idx.max()) + 1 if len(subject_idx) else 0
+    bins = stats["bin"].to_numpy()
+    cal_bins = np.minimum(bins * n_calibration_bins // n_bins, n_calibration_bins - 1)
+    bin_cal_bins = np.minimum(np.arange(n_bins) * n_calibration_bins // n_bins, n_calibration_bins - 1)
+    cal_starts = np.flatnonzero(np.r_[True, bin_cal_bins[1:] != bin_cal_bins[:-1]])
+
+    def subject_matrix(col: str, columns: np.ndarray, n_columns: int) -> sparse.csr_matrix:
+        values = stats[col].cast(pl.Float64).to_numpy()
+        return sparse.csr_matrix((values, (subject_idx, columns)), shape=(n_subjects, n_columns))
+
+    def subject_vector(col: str) -> np.ndarray:
+        return np.bincount(subject_idx, weights=stats[col].cast(pl.Float64).to_numpy(), minlength=n_subjects)
+
+    # The (transposed) statistics of each subject, so that each batch of replicates is one product with the
+    # subject weights; subjects are equally weighted by scaling their statistics by their prediction counts.
+    n_subject = np.ones(n_subjects)
+    n_subject[subject_idx] = stats["n_subject"].to_numpy()
+    subject_stats = {}
+    for weighting, scale in zip(WEIGHTINGS, (np.ones(n_subjects), 1.0 / n_subject)):
+        scale_matrix = sparse.diags(scale)
+        subject_stats[weighting] = {
+            "pos": (scale_matrix @ subject_matrix("n_pos", bins, n_bins)).T.tocsr(),
+            "neg": (scale_matrix @ subject_matrix("n_neg", bins, n_bins)).T.tocsr(),
+            "cal_sum_p": (scale_matrix @ subject_matrix("sum_p", cal_bins, n_calibration_bins)).T.tocsr(),
+            "sum_sq_error": scale * subject_vector("sum_sq_error"),
+            "tp": scale * subject_vector("tp"),
+            "fp": scale * subject_vector("fp"),
+        }
+
+    batch_size = max(1, min(n_replicates, _MAX_BATCH_ELEMENTS // max(n_subjects, 1)))
+    batches = [(i, min(batch_size, n_replicates - i)) for i in range(0, n_replicates, batch_size)]
+
+    def run_batch(batch: tuple[int, int]) -> dict[str, dict[str, np.ndarray]]:
+        start, size = batch
+        rng = np.random.default_rng([seed, start])
+        subject_weights = rng.poisson(1.0, size=(n_subjects, size)).astype(np.float64)
+        return {
+            weighting: _replicate_metrics(
+                pos=(s["pos"] @ subject_weights).T,
+                neg=(s["neg"] @ subject_weights).T,
+                cal_starts=cal_starts,
+                cal_sum_p=(s["cal_sum_p"] @ subject_weights).T,
+                sum_sq_error=s["sum_sq_error"] @ subject_weights,
+                tp=s["tp"] @ subject_weights,
+                fp=s["fp"] @ subject_weights,
+            )
+            for weighting, s in subject_stats.items()
+        }
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        results = list(pool.map(run_batch, batches))
+
+    return {
+        weighting: {m: np.concatenate([r[weighting][m] for r in results]) for m in METRICS}
+        for weighting in WEIGHTINGS
+    }
+
+
+def bootstrap_cis(
+    predictions_dir: Path,
+    n_replicates: int = N_REPLICATES,
+    confidence: float = CONFIDENCE,
+    n_bins: int = N_BINS,
+    n_calibration_bins: int = N_CALIBRATION_BINS,
+    seed: int = 0,
+    num_workers: int | None = None,
+) -> dict[str, dict[str, float]]:
+    """Computes subject-clustered percentile bootstrap confidence intervals of all metrics of a predict stage.
+
+    Returns:
+        For each weighting, the `{metric}_ci_lower` and `{metric}_ci_upper` bounds of each metric, to be
+        merged into the evaluation results, along with the number of `bootstrap_replicates`.
+
+    Raises:
+        FileNotFoundError: If no prediction files are found.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> from sklearn.metrics import roc_auc_score
+        >>> from ..predictions import scan_predictions, write_prediction_shard
+        >>> rng = np.random.default_rng(0)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     for i in range(2):
+        ...         y = rng.random(500) < 0.5
+        ...         write_prediction_shard(
+        ...             pl.DataFrame({
+        ...                 "subject_id": i * 1000 + np.arange(500) // 2,
+        ...                 "prediction_time": [datetime(2021, 1, 1)] * 500,
+        ...                 "boolean_value": y,
+        ...                 "predicted_boolean_value": y,
+        ...                 "predicted_boolean_probability": 0.3 * y + 0.7 * rng.random(500),
+        ...             }),
+        ...             Path(tmp_dir) / "predictions" / f"{i}.parquet",
+        ...         )
+        ...     cis = bootstrap_cis(Path(tmp_dir), n_replicates=100)
+        ...     predictions = scan_predictions(Path(tmp_dir)).collect()
+        >>> auroc = roc_auc_score(predictions["boolean_value"], predictions["predicted_boolean_probability"])
+        >>> samples = cis["samples_equally_weighted"]
+        >>> samples["bootstrap_replicates"]
+        100
+        >>> lower, upper = samples["roc_auc_score_ci_lower"], samples["roc_auc_score_ci_upper"]
+        >>> bool(lower < auroc < upper), bool(0.01 < upper - lower < 0.1)
+        (True, True)
+        >>> samples["binary_accuracy_ci_lower"], samples["binary_accuracy_ci_upper"]
+        (1.0, 1.0)
+        >>> bootstrap_cis(Path("/nonexistent"))
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No prediction files found in /nonexistent
+    """
+    files = prediction_files(predictions_dir)
+    if not files:
+        raise FileNotFoundError(f"No prediction files found in {predictions_dir}")
+
+    num_workers = num_workers or available_cpus()
+    logger.info(f"Computing {n_replicates} bootstrap replicates over {len(files)} prediction shards.")
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        stats = pl.concat(pool.map(lambda fp: subject_bin_stats(pl.scan_parquet(fp), n_bins), files))
+
+    replicates = bootstrap_replicates(stats, n_replicates, n_bins, n_calibration_bins, seed, num_workers)
+
+    alpha = (1 - confidence) / 2
+    cis = {}
+    for weighting, metrics in replicates.items():
+        cis[weighting] = {"bootstrap_replicates": n_replicates}
+        for metric, values in metrics.items():
+            values = values[~np.isnan(values)]
+            lower, upper = np.quantile(values, [alpha, 1 - alpha]) if len(values) else (np.nan, np.nan)
+            cis[weighting][f"{metric}_ci_lower"] = float(lower)
+            cis[weighting][f"{metric}_ci_upper"] = float(upper)
+    return cis
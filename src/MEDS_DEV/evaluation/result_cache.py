@@ -0,0 +1,293 @@
+"""Caching of evaluation outputs, keyed by the content of the predictions they evaluate.
+
+Evaluation outputs are keyed by a fingerprint of the prediction files, the evaluation configuration, and the
+`MEDS_DEV` and `meds-evaluation` versions. The key of the outputs in an evaluation output directory is
+recorded in its `.eval_key` file. Outputs whose key matches are re-used as-is, and outputs whose key differs
+(e.g., because the predictions were regenerated) are recomputed automatically, without `do_overwrite`.
+
+Evaluated outputs may also be stored in a shared cache directory under their key (like the model artifact
+registry, as read-only copies), so that unchanged predictions are served from the cache even in
+new output directories, e.g., when re-evaluating a large grid of experiments.
+
+Prediction files are fingerprinted from their sizes and parquet footers, which hold the number of rows, the
+compressed size, and the min/max statistics of every column chunk, so fingerprints only read a few kilobytes
+per file yet change with the files' contents. Files are fully hashed with `full_fingerprint`, and non-parquet
+files always are.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import shutil
+from collections.abc import Callable, Sequence
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+from .. import __version__
+from ..cache import file_lock, fingerprint, is_built, make_read_only
+from ..plan import CACHED, STALE, TO_RUN
+from ..registry import copy_file, copy_tree
+from ..utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+KEY_FILE = ".eval_key"
+PARQUET_MAGIC = b"PAR1"
+
+try:
+    MEDS_EVALUATION_VERSION = version("meds-evaluation")
+except PackageNotFoundError:  # pragma: no cover
+    MEDS_EVALUATION_VERSION = "unknown"
+
+
+def prediction_file_fingerprint(fp: Path, full_fingerprint: bool = False) -> str:
+    """Returns a fingerprint of a prediction file's contents.
+
+    Examples:
+        >>> import tempfile
+        >>> import polars as pl
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     fp = Path(tmp_dir) / "0.parquet"
+        ...     pl.DataFrame({"p": [0.1, 0.2]}).write_parquet(fp)
+        ...     fp1 = prediction_file_fingerprint(fp)
+        ...     pl.DataFrame({"p": [0.1, 0.2]}).write_parquet(fp)
+        ...     fp2 = prediction_file_fingerprint(fp)
+        ...     pl.DataFrame({"p": [0.1, 0.3]}).write_parquet(fp)
+        ...     fp3 = prediction_file_fingerprint(fp)
+        ...     fp4 = prediction_file_fingerprint(fp, full_fingerprint=True)
+        >>> fp1 == fp2, fp1 == fp3, fp3 == fp4
+        (True, False, False)
+    """
+    fp = Path(fp)
+    size = fp.stat().st_size
+    if full_fingerprint or size < 12:
+        return file_hash(fp)
+
+    with open(fp, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        footer_len = int.from_bytes(f.read(4), "little")
+        if f.read(4) != PARQUET_MAGIC or footer_len + 8 > size:
+            return file_hash(fp)
+        f.seek(-(footer_len + 8), os.SEEK_END)
+        footer = f.read(footer_len)
+    return hashlib.sha256(size.to_bytes(8, "little") + footer).hexdigest()
+
+
+def predictions_fingerprint(files: list[Path], root: Path, full_fingerprint: bool = False) -> str:
+    """Returns a fingerprint of a set of prediction files, from their paths relative to `root` and contents.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     _ = (root / "a.csv").write_text("1")
+        ...     fp1 = predictions_fingerprint([root / "a.csv"], root)
+        ...     _ = (root / "a.csv").rename(root / "b.csv")
+        ...     fp2 = predictions_fingerprint([root / "b.csv"], root)
+        >>> fp1 == fp2
+        False
+    """
+    root = Path(root)
+    return fingerprint(
+        [
+            (Path(fp).relative_to(root).as_posix(), prediction_file_fingerprint(fp, full_fingerprint))
+            for fp in files
+        ]
+    )
+
+
+def predictions_path_files(predictions_path: str) -> tuple[list[Path], Path]:
+    """Returns the files matched by a predictions path (a file or glob) and the root they are relative to.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     (Path(tmp_dir) / "held_out").mkdir()
+        ...     for fn in ("held_out/0.parquet", "held_out/1.parquet"):
+        ...         (Path(tmp_dir) / fn).touch()
+        ...     files, root = predictions_path_files(f"{tmp_dir}/**/*.parquet")
+        ...     print([str(fp.relative_to(root)) for fp in files], root == Path(tmp_dir))
+        ['held_out/0.parquet', 'held_out/1.parquet'] True
+    """
+    files = sorted(Path(fp) for fp in glob.glob(predictions_path, recursive=True) if Path(fp).is_file())
+    parts = Path(predictions_path).parts
+    n_literal = next((i for i, part in enumerate(parts) if any(c in part for c in "*?[")), len(parts) - 1)
+    return files, Path(*parts[:n_literal])
+
+
+def evaluation_key(files: list[Path], root: Path, config: dict, full_fingerprint: bool = False) -> str:
+    """Returns the cache key of the evaluation of `files` with the given evaluation configuration."""
+    return fingerprint(
+        predictions_fingerprint(files, root, full_fingerprint), config, __version__, MEDS_EVALUATION_VERSION
+    )
+
+
+class EvaluationCache:
+    """A shared, content-addressed store of evaluation outputs, under `{cache_dir}/{key}`.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     cache = EvaluationCache(Path(tmp_dir) / "cache")
+        ...     out_dir = Path(tmp_dir) / "eval_1"
+        ...     out_dir.mkdir()
+        ...     _ = (out_dir / "results.json").write_text("{}")
+        ...     _ = (out_dir / "notes.txt").write_text("not an output")
+        ...     (out_dir / ".done").touch()
+        ...     cache.store("abc", out_dir, [".done", "results.json", "subgroups.parquet"])
+        ...     restored = cache.restore("abc", Path(tmp_dir) / "eval_2")
+        ...     print(restored, cache.restore("def", Path(tmp_dir) / "eval_3"))
+        ...     print(sorted(p.name for p in (Path(tmp_dir) / "eval_2").iterdir()))
+        True False
+        ['.done', 'results.json']
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+
+    def entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def restore(self, key: str, output_dir: Path) -> bool:
+        """Copies the cached outputs with `key` into `output_dir`; returns whether they were cached."""
+        entry_dir = self.entry_dir(key)
+        if not is_built(entry_dir):
+            return False
+        logger.info(f"Restoring evaluation outputs {output_dir} from the evaluation cache {entry_dir}.")
+        copy_tree(entry_dir, output_dir)
+        return True
+
+    def store(self, key: str, output_dir: Path, outputs: Sequence[str]):
+        """Stores the completed evaluation `outputs` in `output_dir` under `key`, if not yet stored."""
+        output_dir = Path(output_dir)
+        entry_dir = self.entry_dir(key)
+        if is_built(entry_dir) or not is_built(output_dir):
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with file_lock(entry_dir.with_name(f"{key}.lock")):
+            if is_built(entry_dir):
+                return
+            tmp_dir = entry_dir.with_name(f"{key}.tmp")
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            tmp_dir.mkdir()
+            for name in outputs:
+                if (output_dir / name).is_file():
+                    copy_file(output_dir / name, tmp_dir / name)
+            make_read_only(tmp_dir)
+            os.rename(tmp_dir, entry_dir)
+            logger.info(f"Stored evaluation outputs {output_dir} in the evaluation cache as {entry_dir}.")
+
+
+def cached_evaluation(
+    output_dir: Path,
+    key: str,
+    evaluate: Callable[[], object],
+    outputs: Sequence[str],
+    cache_dir: Path | None = None,
+    do_overwrite: bool = False,
+) -> bool:
+    """Runs `evaluate` to write evaluation outputs to `output_dir`, unless outputs with `key` already exist.
+
+    Outputs are re-used if `output_dir` already holds outputs with `key`, or restored from the evaluation
+    cache in `cache_dir` (if any) if it holds them. Otherwise, any stale `outputs` are removed and `evaluate`
+    is run, after which its outputs are recorded with `key` (and stored in the cache). The outputs are
+    complete when `evaluate` has written `.done` to `output_dir`. Other files in `output_dir` are left
+    untouched.
+
+    Args:
+        output_dir: The evaluation output directory.
+        key: The evaluation key, from `evaluation_key`.
+        evaluate: The function writing the evaluation outputs to `output_dir`.
+        outputs: The names of the files `evaluate` may write to `output_dir`.
+        cache_dir: The shared evaluation cache, if any.
+        do_overwrite: Whether to re-evaluate even if outputs with `key` exist.
+
+    Returns:
+        Whether existing outputs were re-used.
+
+    Examples:
+        >>> import tempfile
+        >>> def evaluate(output_dir: Path):
+        ...     print(f"Evaluating {output_dir.name}")
+        ...     _ = (output_dir / "results.json").write_text("{}")
+        ...     (output_dir / ".done").touch()
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for out, key in [("a", "k1"), ("a", "k1"), ("a", "k2"), ("b", "k1")]:
+        ...         out_dir = root / out
+        ...         out_dir.mkdir(exist_ok=True)
+        ...         run = lambda: evaluate(out_dir)
+        ...         print(cached_evaluation(out_dir, key, run, ["results.json"], root / "cache"))
+        Evaluating a
+        False
+        True
+        Evaluating a
+        False
+        True
+    """
+    output_dir = Path(output_dir)
+    key_fp = output_dir / KEY_FILE
+    if not do_overwrite and is_built(output_dir) and key_fp.is_file() and key_fp.read_text() == key:
+        logger.info(f"Evaluation outputs {output_dir} are up to date.")
+        return True
+
+    # Stale outputs are removed first, so that they are never mixed with restored or recomputed ones.
+    outputs = [".done", KEY_FILE, *outputs]
+    for name in outputs:
+        (output_dir / name).unlink(missing_ok=True)
+
+    if not do_overwrite and cache_dir is not None and EvaluationCache(cache_dir).restore(key, output_dir):
+        return True
+
+    evaluate()
+    if not is_built(output_dir):
+        raise RuntimeError(f"Evaluation did not complete: {output_dir / '.done'} was not written.")
+
+    key_fp.write_text(key)
+    if cache_dir is not None:
+        EvaluationCache(cache_dir).store(key, output_dir, outputs)
+    return False
+
+
+def evaluation_status(
+    output_dir: Path, key: str, cache_dir: Path | None = None, do_overwrite: bool = False
+) -> tuple[str, str]:
+    """Returns the plan status (see `MEDS_DEV.plan`) of the evaluation outputs with `key`, and why.
+
+    This mirrors `cached_evaluation`, without evaluating or restoring anything.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     out_dir, cache_dir = Path(tmp_dir) / "eval", Path(tmp_dir) / "cache"
+        ...     out_dir.mkdir()
+        ...     print(evaluation_status(out_dir, "k1", cache_dir))
+        ...     (out_dir / ".done").touch()
+        ...     _ = (out_dir / KEY_FILE).write_text("k1")
+        ...     print(evaluation_status(out_dir, "k1", cache_dir))
+        ...     print(evaluation_status(out_dir, "k1", cache_dir, do_overwrite=True))
+        ...     print(evaluation_status(out_dir, "k2", cache_dir))
+        ...     (cache_dir / "k2").mkdir(parents=True)
+        ...     (cache_dir / "k2" / ".done").touch()
+        ...     print(evaluation_status(out_dir, "k2", cache_dir))
+        ('to-run', 'not yet evaluated')
+        ('cached', 'results up to date')
+        ('stale', 'complete, but do_overwrite is set')
+        ('stale', 'predictions or evaluation options changed')
+        ('cached', 'restored from the evaluation cache entry k2')
+    """
+    output_dir = Path(output_dir)
+    key_fp = output_dir / KEY_FILE
+    is_complete = is_built(output_dir)
+    if do_overwrite:
+        return (STALE, "complete, but do_overwrite is set") if is_complete else (TO_RUN, "not yet evaluated")
+    if is_complete and key_fp.is_file() and key_fp.read_text() == key:
+        return CACHED, "results up to date"
+    if cache_dir is not None and is_built(EvaluationCache(cache_dir).entry_dir(key)):
+        return CACHED, f"restored from the evaluation cache entry {key}"
+    if is_complete:
+        return STALE, "predictions or evaluation options changed"
+    return TO_RUN, "not yet evaluated"
@@ -0,0 +1,309 @@
+"""Out-of-core evaluation of binary classification predictions from mergeable sketches.
+
+Rather than materializing all predictions in memory, each prediction shard is scanned and reduced to a
+*sketch*: a small table of additive sufficient statistics (label counts, sums of probabilities, and confusion
+counts), grouped by a score key. Sketches of different shards (and of different workers) are merged by
+summing them per key, and all metrics are computed from the merged sketch:
+
+  - In *exact* mode, the key is the predicted probability itself, so AUROC, AUPRC (average precision), the
+    Brier score, and calibration curves match scikit-learn exactly, with memory bounded by the number of
+    distinct predicted probabilities.
+  - In *approximate* mode, the key is the index of the probability's bin among `n_bins` equal-width bins, so
+    memory is bounded by `n_bins` and ranking metrics are exact up to ties within a bin (the Brier score and
+    confusion-based metrics remain exact).
+
+As in `meds-evaluation`, metrics are reported with samples equally weighted and with subjects equally
+weighted. For the latter, each prediction is weighted by the inverse of its subject's number of predictions
+(the expectation of `meds-evaluation`'s per-subject resampling), which relies on subjects not spanning label
+shards, as is the case for MEDS data.
+"""
+
+import logging
+from collections.abc import Iterable, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from meds_evaluation.schema import (
+    BOOLEAN_VALUE_FIELD,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTED_BOOLEAN_VALUE_FIELD,
+    SUBJECT_ID_FIELD,
+)
+
+from ..predictions import prediction_files
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_BINS = 100_000
+N_CALIBRATION_BINS = 10
+WEIGHTINGS = ("samples_equally_weighted", "subjects_equally_weighted")
+SKETCH_COLS = ["n_pos", "n_neg", "sum_p", "sum_p2", "sum_p_pos", "tp", "fp"]
+
+
+def shard_sketch(
+    predictions: pl.LazyFrame, exact: bool = False, n_bins: int = DEFAULT_N_BINS, by: Sequence[str] = ()
+) -> pl.DataFrame:
+    """Reduces the predictions of one shard to a sketch of each weighting, in a single streaming scan.
+
+    Args:
+        predictions: The predictions of the shard.
+        exact: Whether to key the sketch by exact probabilities, rather than by one of `n_bins` bins.
+        n_bins: The number of probability bins in approximate mode.
+        by: Columns of `predictions` to additionally group the sketch by (e.g., to sketch subgroups).
+
+    Returns:
+        The sketch, with a `weighting` column (one of `WEIGHTINGS`), the `by` columns, the score `key`, and
+        the (weighted) `SKETCH_COLS` of the predictions with those values.
+
+    Examples:
+        >>> predictions = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "boolean_value": [True, False, True],
+        ...     "predicted_boolean_value": [True, True, False],
+        ...     "predicted_boolean_probability": [0.9, 0.6, 0.4],
+        ... })
+        >>> shard_sketch(predictions, n_bins=2).sort("weighting", "key")
+        shape: (4, 9)
+        ┌───────────────────────────┬─────┬───────┬───────┬───┬────────┬───────────┬─────┬─────┐
+        │ weighting                 ┆ key ┆ n_pos ┆ n_neg ┆ … ┆ sum_p2 ┆ sum_p_pos ┆ tp  ┆ fp  │
+        │ ---                       ┆ --- ┆ ---   ┆ ---   ┆   ┆ ---    ┆ ---       ┆ --- ┆ --- │
+        │ str                       ┆ f64 ┆ f64   ┆ f64   ┆   ┆ f64    ┆ f64       ┆ f64 ┆ f64 │
+        ╞═══════════════════════════╪═════╪═══════╪═══════╪═══╪════════╪═══════════╪═════╪═════╡
+        │ samples_equally_weighted  ┆ 0.0 ┆ 1.0   ┆ 0.0   ┆ … ┆ 0.16   ┆ 0.4       ┆ 0.0 ┆ 0.0 │
+        │ samples_equally_weighted  ┆ 1.0 ┆ 1.0   ┆ 1.0   ┆ … ┆ 1.17   ┆ 0.9       ┆ 1.0 ┆ 1.0 │
+        │ subjects_equally_weighted ┆ 0.0 ┆ 1.0   ┆ 0.0   ┆ … ┆ 0.16   ┆ 0.4       ┆ 0.0 ┆ 0.0 │
+        │ subjects_equally_weighted ┆ 1.0 ┆ 0.5   ┆ 0.5   ┆ … ┆ 0.585  ┆ 0.45      ┆ 0.5 ┆ 0.5 │
+        └───────────────────────────┴─────┴───────┴───────┴───┴────────┴───────────┴─────┴─────┘
+    """
+    p = pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD).cast(pl.Float64)
+    y = pl.col(BOOLEAN_VALUE_FIELD).cast(pl.Float64)
+    y_hat = pl.col(PREDICTED_BOOLEAN_VALUE_FIELD).cast(pl.Float64)
+    if exact:
+        key = p
+    else:
+        key = (p * n_bins).floor().clip(0, n_bins - 1)
+
+    w = pl.col("weight")
+    aggs = {
+        "n_pos": (w * y).sum(),
+        "n_neg": (w * (1 - y)).sum(),
+        "sum_p": (w * p).sum(),
+        "sum_p2": (w * p * p).sum(),
+        "sum_p_pos": (w * y * p).sum(),
+        "tp": (w * y * y_hat).sum(),
+        "fp": (w * (1 - y) * y_hat).sum(),
+    }
+
+    weights = {
+        "samples_equally_weighted": pl.lit(1.0),
+        "subjects_equally_weighted": 1.0 / pl.len().over(SUBJECT_ID_FIELD).cast(pl.Float64),
+    }
+    sketches = [
+        predictions.with_columns(weight=weight, key=key)
+        .group_by(*by, "key")
+        .agg(**aggs)
+        .select(pl.lit(weighting).alias("weighting"), *by, "key", *SKETCH_COLS)
+        for weighting, weight in weights.items()
+    ]
+    return pl.concat(pl.collect_all(sketches))
+
+
+def merge_sketches(sketches: Iterable[pl.DataFrame]) -> pl.DataFrame:
+    """Merges sketches of disjoint sets of predictions into one, sorted by weighting, groups, and key.
+
+    Sketches are summed over all columns other than `SKETCH_COLS`, so sketches grouped by more columns can be
+    marginalized by dropping them first.
+
+    Examples:
+        >>> a = pl.DataFrame({"weighting": ["w", "w"], "key": [0.1, 0.5], "n_pos": [1.0, 2.0]})
+        >>> b = pl.DataFrame({"weighting": ["w"], "key": [0.5], "n_pos": [3.0]})
+        >>> merge_sketches([a, b])
+        shape: (2, 3)
+        ┌───────────┬─────┬───────┐
+        │ weighting ┆ key ┆ n_pos │
+        │ ---       ┆ --- ┆ ---   │
+        │ str       ┆ f64 ┆ f64   │
+        ╞═══════════╪═════╪═══════╡
+        │ w         ┆ 0.1 ┆ 1.0   │
+        │ w         ┆ 0.5 ┆ 5.0   │
+        └───────────┴─────┴───────┘
+    """
+    sketch = pl.concat(sketches)
+    group_cols = [c for c in sketch.columns if c not in SKETCH_COLS]
+    return sketch.group_by(group_cols).agg(pl.all().sum()).sort(group_cols)
+
+
+def sketch_metrics(sketch: pl.DataFrame, n_calibration_bins: int = N_CALIBRATION_BINS) -> dict:
+    """Computes binary classification metrics from the sketch of a single weighting.
+
+    The scalar metrics have the same names and definitions as in `meds-evaluation`; the calibration curve
+    (with `n_calibration_bins` equal-width bins, omitting empty bins) and the Brier score are also reported.
+    AUROC is `NaN` if the labels have only one class, and AUPRC if there are no positive labels.
+
+    Examples:
+        >>> from sklearn.metrics import average_precision_score, brier_score_loss, roc_auc_score
+        >>> rng = np.random.default_rng(0)
+        >>> y = rng.random(1000) < 0.3
+        >>> p = np.round(np.clip(0.3 * y + rng.random(1000) * 0.7, 0, 1), 2)
+        >>> predictions = pl.LazyFrame({
+        ...     "subject_id": np.arange(1000) // 3,
+        ...     "boolean_value": y,
+        ...     "predicted_boolean_value": p > 0.5,
+        ...     "predicted_boolean_probability": p,
+        ... })
+        >>> sketch = shard_sketch(predictions, exact=True).filter(pl.col("weighting") == WEIGHTINGS[0])
+        >>> metrics = sketch_metrics(sketch)
+        >>> bool(np.isclose(metrics["roc_auc_score"], roc_auc_score(y, p)))
+        True
+        >>> bool(np.isclose(metrics["average_precision_score"], average_precision_score(y, p)))
+        True
+        >>> bool(np.isclose(metrics["brier_score_loss"], brier_score_loss(y, p)))
+        True
+
+    In approximate mode, ranking metrics are only exact up to ties within bins:
+        >>> sketch = shard_sketch(predictions, n_bins=10).filter(pl.col("weighting") == WEIGHTINGS[0])
+        >>> metrics = sketch_metrics(sketch)
+        >>> round(metrics["roc_auc_score"], 3), round(roc_auc_score(y, p), 3)
+        (0.838, 0.836)
+        >>> bool(np.isclose(metrics["brier_score_loss"], brier_score_loss(y, p)))
+        True
+
+    Degenerate labels give undefined ranking metrics:
+        >>> metrics = sketch_metrics(pl.DataFrame({
+        ...     "key": [0.2], "n_pos": [2.0], "n_neg": [0.0], "sum_p": [0.4], "sum_p2": [0.08],
+        ...     "sum_p_pos": [0.4], "tp": [0.0], "fp": [0.0],
+        ... }))
+        >>> metrics["roc_auc_score"], metrics["average_precision_score"]
+        (nan, 1.0)
+    """
+    s = {
+        c: sketch.sort("key", descending=True)[c].to_numpy().astype(np.float64) for c in ["key", *SKETCH_COLS]
+    }
+    n_pos, n_neg = s["n_pos"].sum(), s["n_neg"].sum()
+    n = n_pos + n_neg
+
+    metrics = {}
+    tp, fp = s["tp"].sum(), s["fp"].sum()
+    metrics["binary_accuracy"] = float((tp + n_neg - fp) / n)
+    metrics["f1_score"] = float(2 * tp / (2 * tp + fp + (n_pos - tp))) if tp > 0 else 0.0
+
+    # Keys are in descending order of score, so positives of earlier keys outrank negatives of later ones, and
+    # positives and negatives with the same key are tied.
+    if n_pos > 0 and n_neg > 0:
+        pos_above = np.cumsum(s["n_pos"]) - s["n_pos"]
+        metrics["roc_auc_score"] = float((s["n_neg"] * (pos_above + s["n_pos"] / 2)).sum() / (n_pos * n_neg))
+    else:
+        metrics["roc_auc_score"] = float("nan")
+    if n_pos > 0:
+        precision = np.cumsum(s["n_pos"]) / np.cumsum(s["n_pos"] + s["n_neg"])
+        metrics["average_precision_score"] = float((s["n_pos"] / n_pos * precision).sum())
+    else:
+        metrics["average_precision_score"] = float("nan")
+
+    metrics["brier_score_loss"] = float((s["sum_p2"].sum() - 2 * s["sum_p_pos"].sum() + n_pos) / n)
+
+    counts = s["n_pos"] + s["n_neg"]
+    mean_p = np.divide(s["sum_p"], counts, out=np.zeros_like(counts), where=counts > 0)
+    bins = np.linspace(0.0, 1.0, n_calibration_bins + 1)
+    bin_ids = np.searchsorted(bins[1:-1], mean_p)
+    bin_total = np.bincount(bin_ids, weights=counts, minlength=n_calibration_bins)
+    bin_sums = np.bincount(bin_ids, weights=s["sum_p"], minlength=n_calibration_bins)
+    bin_true = np.bincount(bin_ids, weights=s["n_pos"], minlength=n_calibration_bins)
+    nonzero = bin_total > 0
+    fraction_of_positives = bin_true[nonzero] / bin_total[nonzero]
+    mean_predicted_probability = bin_sums[nonzero] / bin_total[nonzero]
+    metrics["calibration_error"] = float(np.abs(fraction_of_positives - mean_predicted_probability).mean())
+    metrics["calibration_curve"] = {
+        "fraction_of_positives": fraction_of_positives.tolist(),
+        "mean_predicted_probability": mean_predicted_probability.tolist(),
+        "count": bin_total[nonzero].tolist(),
+    }
+    return metrics
+
+
+def evaluate_streaming(
+    predictions_dir: Path,
+    exact: bool = False,
+    n_bins: int = DEFAULT_N_BINS,
+    n_calibration_bins: int = N_CALIBRATION_BINS,
+    num_workers: int = 1,
+) -> dict[str, dict]:
+    """Evaluates all prediction shards of a predict stage in bounded memory.
+
+    Shards are sketched by `num_workers` threads (polars releases the GIL while scanning), with at most
+    `num_workers` shards submitted at a time, and each sketch is merged into the running total as soon as it
+    is done (before the next shard is submitted), so memory is bounded by the size of `num_workers` shards
+    plus that of `num_workers + 1` sketches.
+
+    Args:
+        predictions_dir: The predictions directory, as for `MEDS_DEV.predictions.prediction_files`.
+        exact: Whether to key sketches by exact probabilities, rather than by one of `n_bins` bins.
+        n_bins: The number of probability bins in approximate mode.
+        n_calibration_bins: The number of bins of the calibration curve.
+        num_workers: The number of shards to sketch concurrently.
+
+    Returns:
+        The metrics of each weighting, keyed as in `meds-evaluation`'s results.
+
+    Raises:
+        FileNotFoundError: If no prediction files are found.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> from ..predictions import write_prediction_shard
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     for i in range(3):
+        ...         write_prediction_shard(
+        ...             pl.DataFrame({
+        ...                 "subject_id": [2 * i, 2 * i + 1, 2 * i + 1],
+        ...                 "prediction_time": [datetime(2021, 1, 1)] * 3,
+        ...                 "boolean_value": [True, False, i == 0],
+        ...                 "predicted_boolean_value": [True, False, False],
+        ...                 "predicted_boolean_probability": [0.8, 0.3, 0.1 * i],
+        ...             }),
+        ...             Path(tmp_dir) / "predictions" / f"{i}.parquet",
+        ...         )
+        ...     results = evaluate_streaming(Path(tmp_dir), exact=True, num_workers=2)
+        >>> metrics = results["samples_equally_weighted"]
+        >>> ranking_metrics = ("roc_auc_score", "average_precision_score", "brier_score_loss")
+        >>> {k: round(metrics[k], 3) for k in ranking_metrics}
+        {'roc_auc_score': 0.75, 'average_precision_score': 0.861, 'brier_score_loss': 0.16}
+        >>> {k: round(metrics[k], 3) for k in ("binary_accuracy", "f1_score", "calibration_error")}
+        {'binary_accuracy': 0.889, 'f1_score': 0.857, 'calibration_error': 0.287}
+        >>> round(results["subjects_equally_weighted"]["roc_auc_score"], 3)
+        0.857
+        >>> evaluate_streaming(Path("/nonexistent"))
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No prediction files found in /nonexistent
+    """
+    files = prediction_files(predictions_dir)
+    if not files:
+        raise FileNotFoundError(f"No prediction files found in {predictions_dir}")
+
+    logger.info(f"Sketching {len(files)} prediction shards ({'exact' if exact else f'{n_bins} bins'}).")
+    sketch = None
+    remaining = iter(files)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+
+        def submit_next() -> set:
+            fp = next(remaining, None)
+            return set() if fp is None else {pool.submit(shard_sketch, pl.scan_parquet(fp), exact, n_bins)}
+
+        pending = set()
+        for _ in range(num_workers):
+            pending |= submit_next()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = future.result()
+                sketch = shard if sketch is None else merge_sketches([sketch, shard])
+                pending |= submit_next()
+
+    return {
+        weighting: sketch_metrics(sketch.filter(pl.col("weighting") == weighting), n_calibration_bins)
+        for weighting in WEIGHTINGS
+    }
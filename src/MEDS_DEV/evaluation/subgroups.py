@@ -0,0 +1,306 @@
+"""Single-pass evaluation of predictions within subgroups (e.g., per split, site, age band, or sex).
+
+Subgroups are defined by:
+
+  - A column of the predictions (e.g., a `site` column carried over from the labels). The `split` column is
+    always available, and holds the split directory of each prediction shard (e.g., `held_out`).
+  - A static code of the MEDS dataset, as `{name: ..., code_prefix: ...}`: each subject's subgroup is their
+    static (untimed) code with that prefix, without the prefix (e.g., `{name: sex, code_prefix: "GENDER//"}`).
+  - An age band at prediction time, as `{name: ..., age_bands: [...]}`, with the band edges in years, and with
+    ages computed from the subject's `MEDS_BIRTH` event (or another `birth_code`).
+
+Each prediction shard is reduced, in one group-by pass, to a sketch (see `MEDS_DEV.evaluation.streaming`)
+grouped by the values of *all* subgroup definitions at once; the sketch of each subgroup is then obtained by
+summing over the other definitions, and metrics are computed from it. Subjects are equally weighted over all
+of their predictions, rather than within each subgroup.
+"""
+
+import logging
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import meds
+import polars as pl
+
+from ..predictions import prediction_files, predictions_root
+from .streaming import (
+    DEFAULT_N_BINS,
+    N_CALIBRATION_BINS,
+    SKETCH_COLS,
+    merge_sketches,
+    shard_sketch,
+    sketch_metrics,
+)
+
+logger = logging.getLogger(__name__)
+
+SPLIT_COL = "split"
+SUBGROUPS_FN = "subgroups.parquet"
+MISSING_VALUE = "UNK"
+DAYS_PER_YEAR = 365.25
+
+
+def parse_subgroups(subgroups: Sequence[str | dict]) -> list[dict]:
+    """Normalizes subgroup definitions to dictionaries with a `name` and exactly one source.
+
+    Raises:
+        ValueError: If a definition has no or several sources, or names are duplicated.
+
+    Examples:
+        >>> parse_subgroups(["split", {"name": "sex", "code_prefix": "GENDER//"}])
+        [{'name': 'split', 'column': 'split'}, {'name': 'sex', 'code_prefix': 'GENDER//'}]
+        >>> parse_subgroups([{"name": "age", "age_bands": [40, 18]}])
+        [{'name': 'age', 'age_bands': [18.0, 40.0], 'birth_code': 'MEDS_BIRTH'}]
+        >>> parse_subgroups([{"name": "age", "column": "age", "code_prefix": "AGE//"}])
+        Traceback (most recent call last):
+            ...
+        ValueError: Subgroup 'age' must have exactly one of ('column', 'code_prefix', 'age_bands'); got ...
+        >>> parse_subgroups(["split", "split"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Duplicate subgroup names: ['split', 'split']
+    """
+    sources = ("column", "code_prefix", "age_bands")
+    defs = []
+    for subgroup in subgroups:
+        if isinstance(subgroup, str):
+            subgroup = {"name": subgroup, "column": subgroup}
+        subgroup = dict(subgroup)
+        if sum(k in subgroup for k in sources) != 1:
+            raise ValueError(
+                f"Subgroup '{subgroup.get('name')}' must have exactly one of {sources}; got {subgroup}"
+            )
+        if "age_bands" in subgroup:
+            subgroup["age_bands"] = sorted(float(edge) for edge in subgroup["age_bands"])
+            subgroup.setdefault("birth_code", meds.birth_code)
+        defs.append(subgroup)
+
+    names = [d["name"] for d in defs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate subgroup names: {names}")
+    return defs
+
+
+def _birth_col(subgroup: dict) -> str:
+    return f"_{subgroup['name']}_birth_time"
+
+
+def subject_subgroups(dataset_dir: Path | None, subgroups: list[dict]) -> pl.LazyFrame | None:
+    """Returns the static code subgroups and birth times of all subjects, from one scan of the MEDS dataset.
+
+    Returns:
+        A frame with one row per subject, or `None` if no subgroup is defined from the dataset.
+
+    Raises:
+        ValueError: If a subgroup needs the dataset but no dataset directory is given.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> data = pl.DataFrame({
+        ...     "subject_id": [1, 1, 1, 2, 2],
+        ...     "time": [None, datetime(1980, 1, 1), datetime(2020, 1, 1), None, datetime(2000, 6, 1)],
+        ...     "code": ["GENDER//F", "MEDS_BIRTH", "DX//1", "GENDER//M", "MEDS_BIRTH"],
+        ... })
+        >>> subgroups = parse_subgroups([
+        ...     "split", {"name": "sex", "code_prefix": "GENDER//"}, {"name": "age", "age_bands": [30]}
+        ... ])
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     (Path(tmp_dir) / "data" / "train").mkdir(parents=True)
+        ...     data.write_parquet(Path(tmp_dir) / "data" / "train" / "0.parquet")
+        ...     subject_subgroups(Path(tmp_dir), subgroups).sort("subject_id").collect()
+        shape: (2, 3)
+        ┌────────────┬─────┬─────────────────────┐
+        │ subject_id ┆ sex ┆ _age_birth_time     │
+        │ ---        ┆ --- ┆ ---                 │
+        │ i64        ┆ str ┆ datetime[μs]        │
+        ╞════════════╪═════╪═════════════════════╡
+        │ 1          ┆ F   ┆ 1980-01-01 00:00:00 │
+        │ 2          ┆ M   ┆ 2000-06-01 00:00:00 │
+        └────────────┴─────┴─────────────────────┘
+        >>> print(subject_subgroups(None, parse_subgroups(["split"])))
+        None
+        >>> subject_subgroups(None, subgroups)
+        Traceback (most recent call last):
+            ...
+        ValueError: Subgroups ['sex', 'age'] are defined from the MEDS dataset, but no dataset_dir was given.
+    """
+    dataset_subgroups = [d for d in subgroups if "column" not in d]
+    if not dataset_subgroups:
+        return None
+    if dataset_dir is None:
+        names = [d["name"] for d in dataset_subgroups]
+        raise ValueError(
+            f"Subgroups {names} are defined from the MEDS dataset, but no dataset_dir was given."
+        )
+
+    code, time = pl.col(meds.code_field), pl.col(meds.time_field)
+    aggs = []
+    for d in dataset_subgroups:
+        if "code_prefix" in d:
+            static_code = code.filter(time.is_null() & code.str.starts_with(d["code_prefix"]))
+            aggs.append(static_code.min().str.strip_prefix(d["code_prefix"]).alias(d["name"]))
+        else:
+            aggs.append(time.filter(code == d["birth_code"]).min().alias(_birth_col(d)))
+
+    data = pl.scan_parquet(str(Path(dataset_dir) / "data" / "**" / "*.parquet"))
+    return data.group_by(meds.subject_id_field).agg(*aggs)
+
+
+def _age_band_labels(edges: list[float]) -> list[str]:
+    """Returns the labels of the age bands with the given edges.
+
+    Examples:
+        >>> _age_band_labels([18.0, 65.0])
+        ['<18', '18-65', '>=65']
+    """
+    fmt = [f"{e:g}" for e in edges]
+    return [f"<{fmt[0]}", *(f"{lo}-{hi}" for lo, hi in zip(fmt[:-1], fmt[1:])), f">={fmt[-1]}"]
+
+
+def with_subgroups(
+    predictions: pl.LazyFrame, split: str | None, subgroups: list[dict], subjects: pl.LazyFrame | None
+) -> pl.LazyFrame:
+    """Adds the value of each subgroup definition, as a string column named after it, to predictions.
+
+    Predictions with no value for a subgroup (e.g., subjects without the static code) are in the `UNK`
+    subgroup.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> predictions = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "prediction_time": [datetime(2000, 1, 1), datetime(2020, 1, 1), datetime(2020, 1, 1)],
+        ... })
+        >>> subjects = pl.LazyFrame({
+        ...     "subject_id": [1], "sex": ["F"], "_age_birth_time": [datetime(1980, 1, 1)]
+        ... })
+        >>> subgroups = parse_subgroups([
+        ...     "split", {"name": "sex", "code_prefix": "GENDER//"}, {"name": "age", "age_bands": [30]}
+        ... ])
+        >>> predictions = with_subgroups(predictions, "held_out", subgroups, subjects)
+        >>> predictions.select("split", "sex", "age").collect()
+        shape: (3, 3)
+        ┌──────────┬─────┬──────┐
+        │ split    ┆ sex ┆ age  │
+        │ ---      ┆ --- ┆ ---  │
+        │ str      ┆ str ┆ str  │
+        ╞══════════╪═════╪══════╡
+        │ held_out ┆ F   ┆ <30  │
+        │ held_out ┆ F   ┆ >=30 │
+        │ held_out ┆ UNK ┆ UNK  │
+        └──────────┴─────┴──────┘
+    """
+    predictions = predictions.with_columns(pl.lit(split, dtype=pl.String).alias(SPLIT_COL))
+    if subjects is not None:
+        predictions = predictions.join(subjects, on=meds.subject_id_field, how="left")
+
+    subgroup_cols = []
+    for d in subgroups:
+        if "column" in d:
+            value = pl.col(d["column"]).cast(pl.String)
+        elif "code_prefix" in d:
+            value = pl.col(d["name"])
+        else:
+            age = (pl.col(meds.prediction_time_field) - pl.col(_birth_col(d))).dt.total_days() / DAYS_PER_YEAR
+            labels = _age_band_labels(d["age_bands"])
+            value = age.cut(d["age_bands"], labels=labels, left_closed=True).cast(pl.String)
+        subgroup_cols.append(value.fill_null(MISSING_VALUE).alias(d["name"]))
+    return predictions.with_columns(subgroup_cols)
+
+
+def evaluate_subgroups(
+    predictions_dir: Path,
+    by: Sequence[str | dict],
+    dataset_dir: Path | None = None,
+    exact: bool = False,
+    n_bins: int = DEFAULT_N_BINS,
+    n_calibration_bins: int = N_CALIBRATION_BINS,
+    num_workers: int = 1,
+) -> pl.DataFrame:
+    """Evaluates the predictions of a predict stage within each subgroup, in one pass over the predictions.
+
+    Args:
+        predictions_dir: The predictions directory, as for `MEDS_DEV.predictions.prediction_files`.
+        by: The subgroup definitions (see the module docstring).
+        dataset_dir: The MEDS dataset, for subgroups defined by static codes or age.
+        exact: As for `MEDS_DEV.evaluation.streaming.evaluate_streaming`.
+        n_bins: As for `MEDS_DEV.evaluation.streaming.evaluate_streaming`.
+        n_calibration_bins: As for `MEDS_DEV.evaluation.streaming.evaluate_streaming`.
+        num_workers: The number of shards to sketch concurrently.
+
+    Returns:
+        A table with one row per subgroup value and weighting, with the (weighted) number of predictions `n`
+        and the scalar metrics of the predictions in that subgroup.
+
+    Raises:
+        FileNotFoundError: If no prediction files are found.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> from ..predictions import write_prediction_shard
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     for split, site in [("train", "A"), ("held_out", "B")]:
+        ...         write_prediction_shard(
+        ...             pl.DataFrame({
+        ...                 "subject_id": [1, 2, 3, 4] if split == "train" else [5, 6, 7, 8],
+        ...                 "prediction_time": [datetime(2021, 1, 1)] * 4,
+        ...                 "boolean_value": [True, False, True, False],
+        ...                 "predicted_boolean_value": [True, False, False, False],
+        ...                 "predicted_boolean_probability": [0.9, 0.1, 0.4, 0.6 if site == "A" else 0.2],
+        ...                 "site": [site, site, "C", "C"],
+        ...             }),
+        ...             Path(tmp_dir) / "predictions" / split / "0.parquet",
+        ...         )
+        ...     table = evaluate_subgroups(Path(tmp_dir), ["split", "site"], exact=True)
+        >>> table.filter(pl.col("weighting") == "samples_equally_weighted").select(
+        ...     "subgroup", "value", "n", "roc_auc_score", "binary_accuracy"
+        ... )
+        shape: (5, 5)
+        ┌──────────┬──────────┬─────┬───────────────┬─────────────────┐
+        │ subgroup ┆ value    ┆ n   ┆ roc_auc_score ┆ binary_accuracy │
+        │ ---      ┆ ---      ┆ --- ┆ ---           ┆ ---             │
+        │ str      ┆ str      ┆ f64 ┆ f64           ┆ f64             │
+        ╞══════════╪══════════╪═════╪═══════════════╪═════════════════╡
+        │ split    ┆ held_out ┆ 4.0 ┆ 1.0           ┆ 0.75            │
+        │ split    ┆ train    ┆ 4.0 ┆ 0.75          ┆ 0.75            │
+        │ site     ┆ A        ┆ 2.0 ┆ 1.0           ┆ 1.0             │
+        │ site     ┆ B        ┆ 2.0 ┆ 1.0           ┆ 1.0             │
+        │ site     ┆ C        ┆ 4.0 ┆ 0.5           ┆ 0.5             │
+        └──────────┴──────────┴─────┴───────────────┴─────────────────┘
+    """
+    files = prediction_files(predictions_dir)
+    if not files:
+        raise FileNotFoundError(f"No prediction files found in {predictions_dir}")
+
+    subgroups = parse_subgroups(by)
+    names = [d["name"] for d in subgroups]
+    subjects = subject_subgroups(dataset_dir, subgroups)
+    if subjects is not None:
+        subjects = subjects.collect().lazy()
+
+    root = predictions_root(predictions_dir)
+
+    def sketch(fp: Path) -> pl.DataFrame:
+        rel_parts = fp.relative_to(root).parts
+        split = rel_parts[0] if len(rel_parts) > 1 else None
+        predictions = with_subgroups(pl.scan_parquet(fp), split, subgroups, subjects)
+        return shard_sketch(predictions, exact, n_bins, by=names)
+
+    logger.info(f"Sketching {len(files)} prediction shards by subgroups {names}.")
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        full_sketch = merge_sketches(pool.map(sketch, files))
+
+    rows = []
+    for name in names:
+        subgroup_sketch = merge_sketches([full_sketch.select("weighting", name, "key", *SKETCH_COLS)])
+        for (weighting, value), value_sketch in subgroup_sketch.group_by(
+            "weighting", name, maintain_order=True
+        ):
+            metrics = sketch_metrics(value_sketch, n_calibration_bins)
+            scalars = {k: v for k, v in metrics.items() if isinstance(v, float)}
+            n = float((value_sketch["n_pos"] + value_sketch["n_neg"]).sum())
+            rows.append({"subgroup": name, "value": value, "weighting": weighting, "n": n, **scalars})
+    return pl.from_dicts(rows, infer_schema_length=None)
@@ -0,0 +1,419 @@
+"""Executor backends, which run the commands of stages locally, in a local resource pool, or as batch jobs.
+
+`run_in_env` decides whether a stage's command needs to run at all (skipping it if its `.done` file exists)
+and then hands it to an executor, so that skipping completed stages, shared caches, and the artifact registry
+work the same way whichever backend runs the command:
+
+  - `local`: runs each command as a subprocess of the caller, as soon as it is ready (the default).
+  - `pool`: runs each command locally, but only once its resource requests fit in the CPUs and memory not
+    claimed by the other commands running through the pool (e.g., those of the tasks of a multi-task model
+    run), so that concurrency is bounded by what the machine can hold rather than by a fixed count.
+  - `sbatch`: submits each command as a SLURM batch job, with its resource requests as `#SBATCH`
+    directives, and waits for it to finish (`sbatch --wait`). Stage outputs must be on a file system shared
+    with the cluster's nodes.
+  - `fake`: the `sbatch` backend, submitting to `MEDS_DEV.fake_sbatch`, a local stand-in for `sbatch` that
+    runs jobs as local subprocesses, for testing job submission without a cluster.
+
+The resource requests of each command (`cpus`, `memory` in MiB, `gpus`, and `time` in seconds) are declared
+per stage under the `requests` key of the model's `model.yaml` (by run mode, with `cache` for the builds of
+its shared caches) or of the dataset's `dataset.yaml` (under `build`), and can be overridden for every stage
+of a run with `executor.requests`.
+"""
+
+import logging
+import math
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from omegaconf import DictConfig
+
+from .budget import BudgetExceeded, read_usage, record_usage, run_with_budget
+from .resources import available_cpus
+
+logger = logging.getLogger(__name__)
+
+REQUEST_KEYS = ("cpus", "memory", "gpus", "time")
+BACKENDS = ("local", "pool", "sbatch", "fake")
+
+SBATCH_SCRIPT = ".sbatch.sh"
+SBATCH_LOG = ".sbatch.log"
+SBATCH_TIMES = ".sbatch.times"
+
+
+def stage_requests(cfg: DictConfig, overrides: dict | None, stage: str) -> dict[str, int]:
+    """Returns the resource requests of a stage's command.
+
+    Models and datasets may declare requests per stage under the `requests` key of their `model.yaml` or
+    `dataset.yaml` (passed here as `overrides`), e.g., `requests: {train: {cpus: 8, gpus: 1}}`, and the
+    requests set in `cfg.executor.requests` apply to every stage and take precedence over those.
+
+    Raises:
+        ValueError: If the requests have unknown keys.
+
+    Examples:
+        >>> cfg = DictConfig({"executor": {"requests": {"cpus": None, "memory": 4096, "time": None}}})
+        >>> stage_requests(cfg, {"train": {"cpus": 8, "memory": 32768}}, "train")
+        {'cpus': 8, 'memory': 4096}
+        >>> stage_requests(cfg, {"train": {"cpus": 8}}, "predict")
+        {'memory': 4096}
+        >>> stage_requests(DictConfig({}), None, "build")
+        {}
+        >>> stage_requests(DictConfig({}), {"train": {"nodes": 2}}, "train")
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown resource requests: ['nodes']. Options are ('cpus', 'memory', 'gpus', 'time')
+    """
+    declared = (overrides or {}).get(str(stage), None) or {}
+    cli_requests = (cfg.get("executor", None) or {}).get("requests", None) or {}
+    if unknown := sorted((set(declared) | set(cli_requests)) - set(REQUEST_KEYS)):
+        raise ValueError(f"Unknown resource requests: {unknown}. Options are {REQUEST_KEYS}")
+
+    requests = {}
+    for key in REQUEST_KEYS:
+        if cli_requests.get(key, None) is not None:
+            requests[key] = int(cli_requests[key])
+        elif declared.get(key, None) is not None:
+            requests[key] = int(declared[key])
+    return requests
+
+
+class Executor:
+    """The `local` backend: runs each command as a subprocess of the caller, via `run_with_budget`.
+
+    Executors are called by `run_in_env` with the command, the stage's output directory, its budget (see
+    `MEDS_DEV.budget`) and resource requests (see `stage_requests`), and the other arguments to
+    `subprocess.Popen`, and return the completed process, with its captured output.
+    """
+
+    def __call__(
+        self,
+        cmd: str | list[str],
+        output_dir: Path,
+        budget: dict[str, float] | None = None,
+        requests: dict[str, int] | None = None,
+        **popen_kwargs,
+    ) -> subprocess.CompletedProcess:
+        return run_with_budget(cmd, output_dir, budget, **popen_kwargs)
+
+
+class PoolExecutor(Executor):
+    """The `pool` backend: runs commands locally once their requests fit in the unclaimed CPUs and memory.
+
+    Commands request 1 CPU and no memory unless they declare otherwise, and requests larger than the pool are
+    reduced to the pool's size, so that every command can eventually run. The pool is shared by all threads
+    calling the same executor.
+
+    Args:
+        max_cpus: The number of CPUs shared by the commands running through the pool.
+        max_memory: The memory (in MiB) shared by the commands running through the pool, or `None` to not
+            limit commands by memory.
+
+    Examples:
+        >>> import tempfile
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> pool = PoolExecutor(max_cpus=2)
+        >>> cmd = "date +%s.%N > start; sleep 0.2; date +%s.%N > end"
+        >>> with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(3) as threads:
+        ...     dirs = [Path(tmp_dir) / str(i) for i in range(3)]
+        ...     futures = []
+        ...     for out_dir, cpus in zip(dirs, [8, 1, 1]):
+        ...         out_dir.mkdir()
+        ...         job = threads.submit(pool, cmd, out_dir, None, {"cpus": cpus}, shell=True, cwd=out_dir)
+        ...         futures.append(job)
+        ...     print([future.result().returncode for future in futures])
+        ...     spans = [(float((d / "start").read_text()), float((d / "end").read_text())) for d in dirs]
+        [0, 0, 0]
+
+    The command requesting (more than) all CPUs never ran alongside the others:
+        >>> (start, end), others = spans[0], spans[1:]
+        >>> all(o_end <= start or end <= o_start for o_start, o_end in others)
+        True
+        >>> pool.claimed
+        {'cpus': 0, 'memory': 0}
+    """
+
+    def __init__(self, max_cpus: int, max_memory: int | None = None):
+        self.max_cpus = max_cpus
+        self.max_memory = max_memory
+        self.claimed = {"cpus": 0, "memory": 0}
+        self._released = threading.Condition()
+
+    def _fits(self, claim: dict[str, int]) -> bool:
+        if self.claimed["cpus"] + claim["cpus"] > self.max_cpus:
+            return False
+        return self.max_memory is None or self.claimed["memory"] + claim["memory"] <= self.max_memory
+
+    def __call__(
+        self,
+        cmd: str | list[str],
+        output_dir: Path,
+        budget: dict[str, float] | None = None,
+        requests: dict[str, int] | None = None,
+        **popen_kwargs,
+    ) -> subprocess.CompletedProcess:
+        requests = requests or {}
+        claim = {
+            "cpus": min(requests.get("cpus", 1), self.max_cpus),
+            "memory": min(requests.get("memory", 0), self.max_memory or 0),
+        }
+
+        with self._released:
+            if not self._fits(claim):
+                logger.info(f"Waiting for {claim} of the pool ({self.claimed} claimed) to run {cmd}.")
+            self._released.wait_for(lambda: self._fits(claim))
+            for key, value in claim.items():
+                self.claimed[key] += value
+
+        try:
+            return super().__call__(cmd, output_dir, budget, requests, **popen_kwargs)
+        finally:
+            with self._released:
+                for key, value in claim.items():
+                    self.claimed[key] -= value
+                self._released.notify_all()
+
+
+class SbatchExecutor(Executor):
+    """The `sbatch` backend: runs each command as a SLURM batch job, waiting for it to finish.
+
+    The job script, `.sbatch.sh`, and the job's output, `.sbatch.log`, are written to the stage's output
+    directory. Budgets are enforced by the scheduler: the job's time limit is the smaller of its `time`
+    request and the wall time (or CPU-hours, over its requested CPUs) left in its budget, and its memory
+    request is capped by its peak memory budget. The job's run time (excluding time spent queued) is recorded
+    in `.usage.json`, with its CPU-hours as allocated (run time times requested CPUs).
+
+    Args:
+        sbatch: The command to submit jobs with.
+        partition: The partition to submit jobs to, if not the cluster's default.
+        account: The account to charge jobs to, if not the user's default.
+        sbatch_args: Other options to submit every job with, e.g., `["--qos=high"]`.
+
+    Examples:
+        >>> executor = SbatchExecutor(partition="gpu", sbatch_args=["--qos=high"])
+        >>> print(executor.job_script("train --epochs=2", Path("out"), {"cpus": 4, "gpus": 1}, {"time": 90},
+        ...                           cwd=Path("/work")))
+        #!/bin/bash
+        #SBATCH --job-name=meds-dev-out
+        #SBATCH --output=out/.sbatch.log
+        #SBATCH --partition=gpu
+        #SBATCH --cpus-per-task=4
+        #SBATCH --gpus=1
+        #SBATCH --time=2
+        #SBATCH --qos=high
+        date +%s.%N > out/.sbatch.times
+        trap 'date +%s.%N >> out/.sbatch.times' EXIT
+        cd /work
+        train --epochs=2
+
+    Jobs can be run through the local stand-in for `sbatch`, as the `fake` backend does:
+        >>> import json, os, tempfile
+        >>> from unittest.mock import patch
+        >>> fake = SbatchExecutor([sys.executable, "-m", "MEDS_DEV.fake_sbatch"])
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     with patch.dict(os.environ, {"MEDS_DEV_FAKE_SLURM_DIR": tmp_dir}):
+        ...         out_dir = Path(tmp_dir) / "out"
+        ...         out_dir.mkdir()
+        ...         done = fake('echo "cpus=$SLURM_CPUS_PER_TASK"', out_dir, None, {"cpus": 2}, shell=True)
+        ...     usage = read_usage(out_dir)
+        ...     jobs = [json.loads(line) for line in (Path(tmp_dir) / "jobs.jsonl").read_text().splitlines()]
+        >>> done.returncode, done.stdout
+        (0, b'cpus=2\\n')
+        >>> usage["status"], usage["n_runs"]
+        ('completed', 1)
+        >>> [(job["job_id"], job["state"]) for job in jobs]
+        [(1, 'COMPLETED')]
+
+    Budgets left exhausted by prior runs stop the job from being submitted at all:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     _ = record_usage(Path(tmp_dir), read_usage(Path(tmp_dir)), 100.0, 0.0, 0, "failed")
+        ...     fake("echo hi", Path(tmp_dir), {"wall_time": 60}, None, shell=True)
+        Traceback (most recent call last):
+            ...
+        MEDS_DEV.budget.BudgetExceeded: Not submitting echo hi: its wall_time budget of 60 is exhausted.
+    """
+
+    def __init__(
+        self,
+        sbatch: list[str] | tuple[str, ...] = ("sbatch",),
+        partition: str | None = None,
+        account: str | None = None,
+        sbatch_args: list[str] | tuple[str, ...] = (),
+    ):
+        self.sbatch = list(sbatch)
+        self.partition = partition
+        self.account = account
+        self.sbatch_args = list(sbatch_args)
+
+    @staticmethod
+    def limits(
+        requests: dict[str, int], budget: dict[str, float], prior: dict
+    ) -> tuple[dict[str, float], str | None]:
+        """Returns the job's time (in seconds) and memory limits, and which budget limits its time, if any.
+
+        Examples:
+            >>> prior = {"wall_time": 600.0, "cpu_hours": 1.0}
+            >>> budget = {"wall_time": 3600, "peak_memory": 8192}
+            >>> SbatchExecutor.limits({"cpus": 4, "time": 7200}, budget, prior)
+            ({'time': 3000.0, 'memory': 8192}, 'wall_time')
+            >>> SbatchExecutor.limits({"cpus": 4, "memory": 4096}, {"cpu_hours": 3}, prior)
+            ({'time': 1800.0, 'memory': 4096}, 'cpu_hours')
+            >>> SbatchExecutor.limits({"time": 60}, {}, prior)
+            ({'time': 60}, None)
+        """
+        limits, time_budget = {}, None
+        if "time" in requests:
+            limits["time"] = requests["time"]
+
+        remaining = {}
+        if "wall_time" in budget:
+            remaining["wall_time"] = budget["wall_time"] - prior["wall_time"]
+        if "cpu_hours" in budget:
+            remaining["cpu_hours"] = (
+                (budget["cpu_hours"] - prior["cpu_hours"]) * 3600 / requests.get("cpus", 1)
+            )
+        for key, seconds in remaining.items():
+            if seconds < limits.get("time", math.inf):
+                limits["time"], time_budget = seconds, key
+
+        memory = [v for v in (requests.get("memory", None), budget.get("peak_memory", None)) if v is not None]
+        if memory:
+            limits["memory"] = min(memory)
+        return limits, time_budget
+
+    def job_script(
+        self,
+        cmd: str,
+        output_dir: Path,
+        requests: dict[str, int],
+        limits: dict[str, float],
+        cwd: Path | None = None,
+    ) -> str:
+        """Returns the job script running `cmd`, with its resource requests and limits as directives."""
+        output_dir = Path(output_dir)
+        options = [f"--job-name=meds-dev-{output_dir.name}", f"--output={output_dir / SBATCH_LOG}"]
+        if self.partition:
+            options.append(f"--partition={self.partition}")
+        if self.account:
+            options.append(f"--account={self.account}")
+        if "cpus" in requests:
+            options.append(f"--cpus-per-task={requests['cpus']}")
+        if "memory" in limits:
+            options.append(f"--mem={int(limits['memory'])}M")
+        if "gpus" in requests:
+            options.append(f"--gpus={requests['gpus']}")
+        if "time" in limits:
+            options.append(f"--time={math.ceil(limits['time'] / 60)}")
+        options.extend(self.sbatch_args)
+
+        times_fp = output_dir / SBATCH_TIMES
+        lines = ["#!/bin/bash", *(f"#SBATCH {option}" for option in options)]
+        lines.append(f"date +%s.%N > {times_fp}")
+        lines.append(f"trap 'date +%s.%N >> {times_fp}' EXIT")
+        lines.append(f"cd {shlex.quote(str(cwd or Path.cwd()))}")
+        lines.append(cmd)
+        return "\n".join(lines)
+
+    def __call__(
+        self,
+        cmd: str | list[str],
+        output_dir: Path,
+        budget: dict[str, float] | None = None,
+        requests: dict[str, int] | None = None,
+        **popen_kwargs,
+    ) -> subprocess.CompletedProcess:
+        output_dir = Path(output_dir)
+        requests = requests or {}
+        budget = budget or {}
+        prior = read_usage(output_dir)
+
+        limits, time_budget = self.limits(requests, budget, prior)
+        if time_budget is not None and limits["time"] <= 0:
+            raise BudgetExceeded(
+                f"Not submitting {cmd}: its {time_budget} budget of {budget[time_budget]:g} is exhausted.",
+                prior,
+            )
+
+        shell_cmd = cmd if isinstance(cmd, str) else shlex.join(cmd)
+        script_fp = output_dir / SBATCH_SCRIPT
+        script_fp.write_text(
+            self.job_script(shell_cmd, output_dir, requests, limits, popen_kwargs.get("cwd"))
+        )
+        (output_dir / SBATCH_LOG).unlink(missing_ok=True)
+        (output_dir / SBATCH_TIMES).unlink(missing_ok=True)
+
+        logger.info(f"Submitting {script_fp} with {self.sbatch[0]}: {shell_cmd}")
+        st = time.monotonic()
+        submitted = subprocess.run(
+            [*self.sbatch, "--parsable", "--wait", str(script_fp)],
+            capture_output=True,
+            env=popen_kwargs.get("env", None),
+        )
+        run_time = time.monotonic() - st
+        job_id = submitted.stdout.decode().strip().split(";")[0]
+
+        times = (
+            (output_dir / SBATCH_TIMES).read_text().split() if (output_dir / SBATCH_TIMES).is_file() else []
+        )
+        if len(times) == 2:
+            run_time = float(times[1]) - float(times[0])
+
+        exceeded = None
+        if submitted.returncode != 0 and time_budget is not None and run_time >= limits["time"]:
+            exceeded = time_budget
+        if exceeded is not None:
+            status = f"budget_exceeded:{exceeded}"
+        else:
+            status = "completed" if submitted.returncode == 0 else "failed"
+        cpu_hours = run_time * requests.get("cpus", 1) / 3600
+        usage = record_usage(output_dir, prior, run_time, cpu_hours, 0, status)
+        logger.info(f"Job {job_id} for {output_dir} finished with status {status}.")
+
+        log_fp = output_dir / SBATCH_LOG
+        stdout = log_fp.read_bytes() if log_fp.is_file() else b""
+        if exceeded is not None:
+            raise BudgetExceeded(
+                f"Job {job_id} running {cmd} exceeded its {exceeded} budget of {budget[exceeded]:g}.", usage
+            )
+        return subprocess.CompletedProcess(cmd, submitted.returncode, stdout, submitted.stderr)
+
+
+def make_executor(cfg: DictConfig) -> Executor:
+    """Returns the executor configured by `cfg.executor` (the `local` backend if it is not set).
+
+    Examples:
+        >>> type(make_executor(DictConfig({}))).__name__
+        'Executor'
+        >>> pool = make_executor(DictConfig({"executor": {"backend": "pool", "max_cpus": 3}}))
+        >>> type(pool).__name__, pool.max_cpus, pool.max_memory
+        ('PoolExecutor', 3, None)
+        >>> fake = make_executor(DictConfig({"executor": {"backend": "fake", "partition": "short"}}))
+        >>> fake.sbatch[1:], fake.partition
+        (['-m', 'MEDS_DEV.fake_sbatch'], 'short')
+        >>> make_executor(DictConfig({"executor": {"backend": "kubernetes"}}))
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown executor backend kubernetes. Options are ('local', 'pool', 'sbatch', 'fake')
+    """
+    executor_cfg = cfg.get("executor", None) or {}
+    backend = executor_cfg.get("backend", None) or "local"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown executor backend {backend}. Options are {BACKENDS}")
+
+    if backend == "local":
+        return Executor()
+    if backend == "pool":
+        return PoolExecutor(
+            executor_cfg.get("max_cpus", None) or available_cpus(), executor_cfg.get("max_memory", None)
+        )
+
+    sbatch = ["sbatch"] if backend == "sbatch" else [sys.executable, "-m", "MEDS_DEV.fake_sbatch"]
+    return SbatchExecutor(
+        sbatch,
+        partition=executor_cfg.get("partition", None),
+        account=executor_cfg.get("account", None),
+        sbatch_args=list(executor_cfg.get("sbatch_args", None) or []),
+    )
@@ -0,0 +1,182 @@
+"""A local stand-in for SLURM's `sbatch`, for testing the `sbatch` executor backend without a cluster.
+
+Run as `python -m MEDS_DEV.fake_sbatch [--parsable] [--wait] [--OPTION=VALUE ...] SCRIPT`. Like `sbatch`, it
+reads `#SBATCH` directives from the job script (with options given on the command line taking precedence),
+prints the job's ID, and runs the script with `SLURM_JOB_ID`, `SLURM_JOB_NAME`, `SLURM_CPUS_PER_TASK`,
+`SLURM_MEM_PER_NODE`, and `SLURM_GPUS` set, writing its output to the `--output` file (with `%j` replaced by
+the job ID) and killing it if it exceeds its `--time` limit. Unlike `sbatch`, jobs are never queued: they
+start immediately, as local subprocesses. With `--wait`, it waits for the job to finish and exits with the
+job's exit code.
+
+Every job is appended to `jobs.jsonl` in `$MEDS_DEV_FAKE_SLURM_DIR` (by default, `meds_dev_fake_slurm` in the
+temporary directory), which also holds the job ID counter, so tests can check what was submitted.
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from .cache import file_lock
+
+STATE_DIR_ENV = "MEDS_DEV_FAKE_SLURM_DIR"
+JOBS_FN = "jobs.jsonl"
+
+
+def parse_time(value: str) -> int:
+    """Returns the number of seconds in a SLURM time limit.
+
+    Examples:
+        >>> parse_time("90"), parse_time("1:30"), parse_time("2:00:00"), parse_time("1-02:00:00")
+        (5400, 90, 7200, 93600)
+        >>> parse_time("1-2")
+        93600
+    """
+    days = 0
+    if "-" in value:
+        day_part, value = value.split("-", 1)
+        days = int(day_part)
+        parts = [int(p) for p in value.split(":")]
+        hours, minutes, seconds = (parts + [0, 0])[:3]
+    else:
+        parts = [int(p) for p in value.split(":")]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, *parts
+        else:
+            hours, minutes, seconds = parts
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_memory(value: str) -> int:
+    """Returns the number of MiB in a SLURM memory request.
+
+    Examples:
+        >>> parse_memory("512"), parse_memory("512M"), parse_memory("4G"), parse_memory("1T")
+        (512, 512, 4096, 1048576)
+    """
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def parse_options(args: list[str]) -> dict[str, str | bool]:
+    """Parses `sbatch` options of the forms `--name=value` and `--flag`.
+
+    Examples:
+        >>> parse_options(["--parsable", "--cpus-per-task=4", "--job-name=a=b"])
+        {'parsable': True, 'cpus-per-task': '4', 'job-name': 'a=b'}
+    """
+    options = {}
+    for arg in args:
+        name, sep, value = arg.removeprefix("--").partition("=")
+        options[name] = value if sep else True
+    return options
+
+
+def script_options(script: str) -> dict[str, str | bool]:
+    """Returns the options given by the `#SBATCH` directives of a job script.
+
+    Directives are only read until the first command, as `sbatch` does.
+
+    Examples:
+        >>> script_options("#!/bin/bash\\n#SBATCH --cpus-per-task=2 --mem=1G\\necho\\n#SBATCH --gpus=1")
+        {'cpus-per-task': '2', 'mem': '1G'}
+    """
+    args = []
+    for line in script.splitlines()[1:]:
+        if line.startswith("#SBATCH"):
+            args.extend(line.removeprefix("#SBATCH").split())
+        elif line.strip() and not line.startswith("#"):
+            break
+    return parse_options(args)
+
+
+def state_dir() -> Path:
+    return Path(os.environ.get(STATE_DIR_ENV, None) or Path(tempfile.gettempdir()) / "meds_dev_fake_slurm")
+
+
+def next_job_id() -> int:
+    """Returns a new job ID, unique within the state directory."""
+    root = state_dir()
+    root.mkdir(parents=True, exist_ok=True)
+    counter_fp = root / "last_job_id"
+    with file_lock(root / ".lock"):
+        job_id = int(counter_fp.read_text()) + 1 if counter_fp.is_file() else 1
+        counter_fp.write_text(str(job_id))
+    return job_id
+
+
+def record_job(job: dict):
+    root = state_dir()
+    with file_lock(root / ".lock"):
+        with open(root / JOBS_FN, "a") as f:
+            f.write(json.dumps(job) + "\n")
+
+
+def job_env(job_id: int, options: dict) -> dict[str, str]:
+    """Returns the environment of a job, with the variables SLURM sets from its options.
+
+    Examples:
+        >>> env = job_env(7, {"job-name": "j", "cpus-per-task": "4", "mem": "2G"})
+        >>> {k: v for k, v in env.items() if k.startswith("SLURM_")}
+        {'SLURM_JOB_ID': '7', 'SLURM_JOB_NAME': 'j', 'SLURM_CPUS_PER_TASK': '4', 'SLURM_MEM_PER_NODE': '2048'}
+    """
+    env = {k: v for k, v in os.environ.items() if not k.startswith("SLURM_")}
+    env["SLURM_JOB_ID"] = str(job_id)
+    env["SLURM_JOB_NAME"] = str(options.get("job-name", "fake"))
+    if "cpus-per-task" in options:
+        env["SLURM_CPUS_PER_TASK"] = str(options["cpus-per-task"])
+    if "mem" in options:
+        env["SLURM_MEM_PER_NODE"] = str(parse_memory(options["mem"]))
+    if "gpus" in options:
+        env["SLURM_GPUS"] = str(options["gpus"])
+    return env
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Submits (and, with `--wait`, waits for) a job; returns the exit code `sbatch` would have."""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[-1].startswith("--"):
+        print("fake_sbatch: error: no job script given", file=sys.stderr)
+        return 1
+
+    script_fp = Path(argv[-1])
+    options = {**script_options(script_fp.read_text()), **parse_options(argv[:-1])}
+    job_id = next_job_id()
+    print(job_id if options.get("parsable", False) else f"Submitted batch job {job_id}", flush=True)
+
+    output_fp = Path(str(options.get("output", "slurm-%j.out")).replace("%j", str(job_id)))
+    job = {"job_id": job_id, "script": str(script_fp), "options": options}
+    with open(output_fp, "wb") as output:
+        proc = subprocess.Popen(
+            ["bash", str(script_fp)],
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            env=job_env(job_id, options),
+            start_new_session=True,
+        )
+        if not options.get("wait", False):
+            record_job({**job, "state": "SUBMITTED"})
+            return 0
+
+        timeout = parse_time(options["time"]) if "time" in options else None
+        try:
+            returncode = proc.wait(timeout=timeout)
+            state = "COMPLETED" if returncode == 0 else "FAILED"
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+            returncode, state = 1, "TIMEOUT"
+
+    record_job({**job, "state": state, "exit_code": returncode})
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+from importlib.resources import files
+
+CFG_YAML = files("MEDS_DEV.configs") / "_grid.yaml"
+QUEUE_FN = "grid.db"
+
+__all__ = ["CFG_YAML", "QUEUE_FN"]
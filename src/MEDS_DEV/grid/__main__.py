@@ -0,0 +1,201 @@
+import logging
+import os
+import socket
+from pathlib import Path
+
+import hydra
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from ..api import build_dataset, evaluate, extract_task, run_model
+from ..datasets import DATASETS
+from ..models import MODELS
+from ..registry import REGISTRY_DIRNAME
+from ..tasks import TASKS
+from . import CFG_YAML, QUEUE_FN
+from .work_queue import STAGES, GridItem, GridQueue, work
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ("init", "work", "status", "retry")
+# The options set with action=init and stored in the queue, so that all workers run items alike.
+SETTINGS = ("dataset_dirs", "demo", "cache_dir", "overrides")
+
+
+def _select(kind: str, names: list[str] | None, options: dict) -> list[str]:
+    if names is None:
+        return sorted(options)
+    if unknown := sorted(set(names) - set(options)):
+        raise ValueError(f"Unknown {kind}: {unknown}. Options are {sorted(options)}")
+    return list(names)
+
+
+def grid_items(
+    datasets: list[str] | None = None,
+    tasks: list[str] | None = None,
+    models: list[str] | None = None,
+    stages: list[str] | None = None,
+) -> list[GridItem]:
+    """Enumerates the items of a grid, each after its prerequisites.
+
+    Datasets, tasks, and models default to all of those in MEDS-DEV (`DATASETS`, `TASKS`, and `MODELS`), but
+    tasks are only paired with datasets for which MEDS-DEV has predicates.
+
+    Raises:
+        ValueError: If any dataset, task, model, or stage is unknown.
+
+    Examples:
+        >>> items = grid_items(["MIMIC-IV"], ["mortality/in_icu/first_24h"], ["random_predictor"])
+        >>> for item in items:
+        ...     print(item)
+        dataset MIMIC-IV
+        task MIMIC-IV/mortality/in_icu/first_24h
+        model MIMIC-IV/mortality/in_icu/first_24h/random_predictor
+        evaluation MIMIC-IV/mortality/in_icu/first_24h/random_predictor
+        >>> items = grid_items(["MIMIC-IV"], models=["random_predictor"], stages=["model", "evaluation"])
+        >>> len(items) == 2 * len(TASKS)
+        True
+        >>> grid_items(["MIMIC-IV"], ["mortality"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown tasks: ['mortality']. Options are [...]
+        >>> grid_items(stages=["train"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown stages: ['train']. Options are ('dataset', 'task', 'model', 'evaluation')
+    """
+    stages = STAGES if stages is None else list(stages)
+    if unknown := sorted(set(stages) - set(STAGES)):
+        raise ValueError(f"Unknown stages: {unknown}. Options are {STAGES}")
+
+    datasets = _select("datasets", datasets, DATASETS)
+    tasks = _select("tasks", tasks, TASKS)
+    models = _select("models", models, MODELS)
+
+    pairs = [(d, t) for d in datasets for t in tasks if DATASETS[d]["predicates"] is not None]
+    items = {
+        "dataset": [GridItem("dataset", d) for d in datasets],
+        "task": [GridItem("task", d, t) for d, t in pairs],
+        "model": [GridItem("model", d, t, m) for d, t in pairs for m in models],
+        "evaluation": [GridItem("evaluation", d, t, m) for d, t in pairs for m in models],
+    }
+    return [item for stage in STAGES if stage in stages for item in items[stage]]
+
+
+def item_dir(grid_dir: Path, item: GridItem, dataset_dirs: dict[str, str] | None = None) -> Path:
+    """Returns the output directory of a grid item, under `grid_dir` (unless it is a pre-built dataset).
+
+    Each model item has its own output directory (and virtual environment), of its model, dataset, and task,
+    so that concurrently running items never write to the same stage directory. Stages shared across the
+    tasks of a dataset (e.g., pre-training) are instead stored in the artifact registry under the grid's
+    `cache_dir` by the first item to complete them, and restored from it by the dataset's later items.
+    Evaluations are stored by dataset, task, and model, so they can be compiled by `meds-dev-results` with
+    its default `evaluation_pattern`.
+
+    Examples:
+        >>> item = GridItem("evaluation", "MIMIC-IV", "mortality/in_icu/first_24h", "random_predictor")
+        >>> while item is not None:
+        ...     print(item_dir(Path("grid"), item, {"MIMIC-IV": "/data/mimic"}))
+        ...     item = item.prerequisite()
+        grid/evaluations/MIMIC-IV/mortality/in_icu/first_24h/random_predictor
+        grid/models/random_predictor/MIMIC-IV/mortality/in_icu/first_24h
+        grid/labels/MIMIC-IV/mortality/in_icu/first_24h
+        /data/mimic
+        >>> item_dir(Path("grid"), GridItem("dataset", "MIMIC-IV"))
+        PosixPath('grid/datasets/MIMIC-IV')
+        >>> item_dir(Path("grid"), GridItem("model", "D1", "t", "m")) == item_dir(
+        ...     Path("grid"), GridItem("model", "D2", "t", "m")
+        ... )
+        False
+    """
+    match item.stage:
+        case "dataset":
+            return Path((dataset_dirs or {}).get(item.dataset, None) or grid_dir / "datasets" / item.dataset)
+        case "task":
+            return grid_dir / "labels" / item.dataset / item.task
+        case "model":
+            return grid_dir / "models" / item.model / item.dataset / item.task
+        case "evaluation":
+            return grid_dir / "evaluations" / item.dataset / item.task / item.model
+    raise ValueError(f"Unknown stage {item.stage}. Options are {STAGES}")
+
+
+def run_item(grid_dir: Path, settings: dict, item: GridItem):
+    """Runs a grid item's stage in-process, through `MEDS_DEV.api`, with the grid's `settings`."""
+    dataset_dirs = settings.get("dataset_dirs", None)
+    overrides = (settings.get("overrides", None) or {}).get(item.stage, None) or {}
+    output_dir = item_dir(grid_dir, item, dataset_dirs)
+    dataset_dir = item_dir(grid_dir, GridItem("dataset", item.dataset), dataset_dirs)
+    demo = settings.get("demo", False)
+
+    match item.stage:
+        case "dataset":
+            build_dataset(item.dataset, output_dir, demo=demo, **overrides)
+        case "task":
+            extract_task(item.task, item.dataset, dataset_dir, output_dir, **overrides)
+        case "model":
+            cache_dir = Path(settings.get("cache_dir", None) or grid_dir / ".cache")
+            run_model(
+                item.model,
+                dataset_dir,
+                output_dir,
+                mode="full",
+                dataset_type="full",
+                labels_dir=item_dir(grid_dir, GridItem("task", item.dataset, item.task)),
+                dataset_name=item.dataset,
+                task_name=item.task,
+                demo=demo,
+                **{"cache_dir": cache_dir, "registry_dir": cache_dir / REGISTRY_DIRNAME, **overrides},
+            )
+        case "evaluation":
+            model_dir = item_dir(grid_dir, GridItem("model", item.dataset, item.task, item.model))
+            evaluate(output_dir, model_dir / item.dataset / item.task / "predict", **overrides)
+
+
+def status(queue: GridQueue) -> pl.DataFrame:
+    """Returns the number of items of each stage with each status."""
+    return pl.DataFrame([{"stage": stage, **queue.counts(stage)} for stage in STAGES])
+
+
+def run(cfg: DictConfig) -> pl.DataFrame:
+    """Runs the action `cfg.action` on the grid's queue, as configured by `_grid.yaml`.
+
+    Returns:
+        The number of items of each stage with each status, after the action.
+    """
+    if cfg.action not in ACTIONS:
+        raise ValueError(f"Unknown action {cfg.action}. Options are {ACTIONS}")
+
+    grid_dir = Path(cfg.grid_dir)
+    queue = GridQueue(grid_dir / QUEUE_FN)
+
+    if cfg.action == "init":
+        items = grid_items(cfg.datasets, cfg.tasks, cfg.models, cfg.stages)
+        queue.set_settings({key: OmegaConf.to_container(cfg, resolve=True)[key] for key in SETTINGS})
+        logger.info(f"Added {queue.add(items)} of the grid's {len(items)} items to {queue.db_fp}.")
+    elif cfg.action == "retry":
+        logger.info(f"Returned {queue.retry(cfg.stages)} failed items to {queue.db_fp}.")
+    elif cfg.action == "work":
+        worker = cfg.worker.name or f"{socket.gethostname()}:{os.getpid()}"
+        settings = queue.settings()
+        worked = work(
+            queue,
+            lambda item: run_item(grid_dir, settings, item),
+            worker,
+            lease_seconds=cfg.worker.lease_seconds,
+            heartbeat_seconds=cfg.worker.heartbeat_seconds,
+            poll_seconds=cfg.worker.poll_seconds,
+            max_attempts=cfg.worker.max_attempts,
+            max_items=cfg.worker.max_items,
+        )
+        logger.info(f"Worker {worker} completed {worked['done']} items and failed {worked['failed']}.")
+
+    return status(queue)
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    print(run(cfg))
+    errors = GridQueue(Path(cfg.grid_dir) / QUEUE_FN).errors()
+    for item, error in errors:
+        print(f"[failed] {item}: {error}")
@@ -0,0 +1,465 @@
+"""A crash-safe work queue of experiment grid items, backed by a local SQLite database.
+
+Each item of the grid is one stage (`dataset`, `task`, `model`, or `evaluation`) over one dataset, task, and
+model, and may be run only after its prerequisite item (e.g., a model's evaluation after the model's run) is
+done. Workers, in any number of processes or on any number of nodes sharing the database's file system,
+claim items under leases that they extend with heartbeats while running them. The lease of a worker that
+dies (e.g., when preempted) is not extended, so once it expires, its item can be claimed again by another
+worker; items that fail (or whose workers die) `max_attempts` times are marked as failed, along with all of
+the items depending on them, and are left for `retry`. Every change of an item's status is a single
+transaction, so a crash at any point leaves the queue consistent, and items already done are never re-run.
+
+SQLite's locking relies on the file system's POSIX locks, which some network file systems do not implement
+reliably; the database should be on a file system where they are.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Generator, Iterable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+DONE = "done"
+STATUSES = (PENDING, RUNNING, FAILED, DONE)
+
+STAGES = ("dataset", "task", "model", "evaluation")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    task TEXT NOT NULL,
+    model TEXT NOT NULL,
+    after INTEGER REFERENCES items (id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    heartbeat_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    UNIQUE (stage, dataset, task, model)
+);
+CREATE INDEX IF NOT EXISTS items_by_status ON items (status, id);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+@dataclass(frozen=True)
+class GridItem:
+    """An item of the grid: one stage over a dataset and, for all but `dataset` items, a task and model.
+
+    Examples:
+        >>> item = GridItem("evaluation", "MIMIC-IV", "mortality/in_icu/first_24h", "random_predictor")
+        >>> print(item)
+        evaluation MIMIC-IV/mortality/in_icu/first_24h/random_predictor
+        >>> while item is not None:
+        ...     item = item.prerequisite()
+        ...     print(item)
+        model MIMIC-IV/mortality/in_icu/first_24h/random_predictor
+        task MIMIC-IV/mortality/in_icu/first_24h
+        dataset MIMIC-IV
+        None
+    """
+
+    stage: str
+    dataset: str
+    task: str = ""
+    model: str = ""
+
+    def prerequisite(self) -> "GridItem | None":
+        """Returns the item of the preceding stage, which must be done before this one can run."""
+        match self.stage:
+            case "evaluation":
+                return GridItem("model", self.dataset, self.task, self.model)
+            case "model":
+                return GridItem("task", self.dataset, self.task)
+            case "task":
+                return GridItem("dataset", self.dataset)
+        return None
+
+    def __str__(self) -> str:
+        return f"{self.stage} {'/'.join(part for part in (self.dataset, self.task, self.model) if part)}"
+
+
+@dataclass(frozen=True)
+class Lease:
+    """A worker's claim on an item of the queue, valid while the worker keeps extending it.
+
+    Attributes:
+        id: The item's ID in the queue.
+        item: The claimed item.
+        worker: The name of the worker holding the lease.
+        attempt: Which attempt at running the item this is, starting at 1.
+    """
+
+    id: int
+    item: GridItem
+    worker: str
+    attempt: int
+
+
+class GridQueue:
+    """The work queue of a grid, stored in the SQLite database at `db_fp`.
+
+    Examples:
+        >>> import tempfile
+        >>> items = [GridItem("dataset", "D"), GridItem("task", "D", "t"), GridItem("model", "D", "t", "m")]
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     queue = GridQueue(Path(tmp_dir) / "grid.db")
+        ...     print(queue.add(items), queue.add(items[:2]), queue.counts())
+        ...     lease = queue.claim("w1", lease_seconds=60)
+        ...     print(lease.item, lease.attempt, queue.claim("w2", lease_seconds=60))
+        ...     print(queue.heartbeat(lease, 60), queue.complete(lease))
+        ...     lease = queue.claim("w2", lease_seconds=60)
+        ...     print(lease.item, queue.counts())
+        3 0 {'pending': 3, 'running': 0, 'failed': 0, 'done': 0}
+        dataset D 1 None
+        True True
+        task D/t {'pending': 1, 'running': 1, 'failed': 0, 'done': 1}
+
+    The lease of a worker that stops sending heartbeats expires, and its item is reclaimed by another worker,
+    after which the first worker can neither extend the lease nor complete the item:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     queue = GridQueue(Path(tmp_dir) / "grid.db")
+        ...     _ = queue.add(items)
+        ...     crashed = queue.claim("w1", lease_seconds=0.01)
+        ...     time.sleep(0.05)
+        ...     lease = queue.claim("w2", lease_seconds=60)
+        ...     print(lease.item, lease.worker, lease.attempt)
+        ...     print(queue.heartbeat(crashed, 60), queue.complete(crashed), queue.counts())
+        dataset D w2 2
+        False False {'pending': 2, 'running': 1, 'failed': 0, 'done': 0}
+
+    Failed items are retried until they have been attempted `max_attempts` times, after which they and the
+    items depending on them are marked as failed, until reset with `retry`:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     queue = GridQueue(Path(tmp_dir) / "grid.db")
+        ...     _ = queue.add(items)
+        ...     for _ in range(2):
+        ...         print(queue.fail(queue.claim("w1", 60), "ValueError: boom", max_attempts=2))
+        ...     print(queue.claim("w1", 60), queue.counts())
+        ...     for item, error in queue.errors():
+        ...         print(f"{item}: {error}")
+        ...     print(queue.retry(), queue.claim("w1", 60).attempt)
+        pending
+        failed
+        None {'pending': 0, 'running': 0, 'failed': 3, 'done': 0}
+        dataset D: ValueError: boom
+        task D/t: prerequisite dataset D failed
+        model D/t/m: prerequisite dataset D failed
+        3 1
+    """
+
+    def __init__(self, db_fp: Path):
+        self.db_fp = Path(db_fp)
+        self.db_fp.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Generator[sqlite3.Connection, None, None]:
+        # Connections are opened per operation (so the queue can be shared across threads) in autocommit
+        # mode, with each operation that reads then writes wrapped in its own `BEGIN IMMEDIATE` transaction.
+        conn = sqlite3.connect(self.db_fp, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _find(conn: sqlite3.Connection, item: GridItem) -> int | None:
+        row = conn.execute(
+            "SELECT id FROM items WHERE stage = ? AND dataset = ? AND task = ? AND model = ?",
+            (item.stage, item.dataset, item.task, item.model),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, items: Iterable[GridItem]) -> int:
+        """Adds the items not yet in the queue, returning how many were added.
+
+        Items should be given after their prerequisites. An item's prerequisite is its nearest preceding
+        stage in the queue, so grids without, e.g., `dataset` items run their `task` items unconditionally.
+        """
+        n_added = 0
+        with self._transaction() as conn:
+            for item in items:
+                if self._find(conn, item) is not None:
+                    continue
+                after, prerequisite = None, item.prerequisite()
+                while after is None and prerequisite is not None:
+                    after, prerequisite = self._find(conn, prerequisite), prerequisite.prerequisite()
+                conn.execute(
+                    "INSERT INTO items (stage, dataset, task, model, after) VALUES (?, ?, ?, ?, ?)",
+                    (item.stage, item.dataset, item.task, item.model, after),
+                )
+                n_added += 1
+        return n_added
+
+    def set_settings(self, settings: dict):
+        """Stores the grid's settings (any JSON-serializable values), so that every worker runs items alike.
+
+        Examples:
+            >>> import tempfile
+            >>> with tempfile.TemporaryDirectory() as tmp_dir:
+            ...     queue = GridQueue(Path(tmp_dir) / "grid.db")
+            ...     print(queue.settings())
+            ...     queue.set_settings({"demo": True, "dataset_dirs": {"D": "/data/D"}})
+            ...     queue.set_settings({"demo": False})
+            ...     print(queue.settings())
+            {}
+            {'dataset_dirs': {'D': '/data/D'}, 'demo': False}
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in settings.items()],
+            )
+
+    def settings(self) -> dict:
+        """Returns the grid's settings, as stored by `set_settings`."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, value FROM settings ORDER BY key").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    @staticmethod
+    def _fail_dependents(conn: sqlite3.Connection, item_id: int, item: GridItem):
+        conn.execute(
+            """
+            WITH RECURSIVE dependents (id) AS (
+                SELECT id FROM items WHERE after = ?
+                UNION SELECT items.id FROM items JOIN dependents ON items.after = dependents.id
+            )
+            UPDATE items SET status = 'failed', error = ? WHERE id IN dependents AND status = 'pending'
+            """,
+            (item_id, f"prerequisite {item} failed"),
+        )
+
+    def claim(self, worker: str, lease_seconds: float, max_attempts: int = 3) -> Lease | None:
+        """Claims the first runnable item for `worker`, or returns `None` if no item can be run now.
+
+        Runnable items are those pending or with an expired lease, whose prerequisite (if any) is done. Items
+        with expired leases that have already been attempted `max_attempts` times are marked as failed.
+        """
+        while True:
+            now = time.time()
+            with self._transaction() as conn:
+                row = conn.execute(
+                    """
+                    SELECT items.id, items.stage, items.dataset, items.task, items.model, items.attempts
+                    FROM items LEFT JOIN items AS prior ON items.after = prior.id
+                    WHERE (items.status = 'pending' OR (items.status = 'running' AND items.lease_expires < ?))
+                        AND (prior.id IS NULL OR prior.status = 'done')
+                    ORDER BY items.id LIMIT 1
+                    """,
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+
+                item_id, attempts, item = row[0], row[5], GridItem(*row[1:5])
+                if attempts >= max_attempts:
+                    error = f"lease expired on each of {attempts} attempts"
+                    logger.warning(f"Marking {item} as failed: {error}.")
+                    conn.execute(
+                        "UPDATE items SET status = 'failed', worker = NULL, lease_expires = NULL, error = ? "
+                        "WHERE id = ?",
+                        (error, item_id),
+                    )
+                    self._fail_dependents(conn, item_id, item)
+                    continue
+
+                if attempts:
+                    logger.info(f"Reclaiming {item} after {attempts} attempts.")
+                conn.execute(
+                    "UPDATE items SET status = 'running', worker = ?, attempts = attempts + 1, "
+                    "lease_expires = ?, heartbeat_at = ?, started_at = ?, error = NULL WHERE id = ?",
+                    (worker, now + lease_seconds, now, now, item_id),
+                )
+                return Lease(item_id, item, worker, attempts + 1)
+
+    def _update_leased(self, lease: Lease, assignments: str, params: tuple) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE items SET {assignments} WHERE id = ? AND worker = ? AND status = 'running' "
+                "AND attempts = ?",
+                (*params, lease.id, lease.worker, lease.attempt),
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, lease: Lease, lease_seconds: float) -> bool:
+        """Extends a lease by `lease_seconds` from now; returns `False` if another worker has taken it."""
+        now = time.time()
+        return self._update_leased(lease, "lease_expires = ?, heartbeat_at = ?", (now + lease_seconds, now))
+
+    def complete(self, lease: Lease) -> bool:
+        """Marks a leased item as done; returns `False` if the lease has been lost to another worker."""
+        return self._update_leased(
+            lease,
+            "status = 'done', worker = NULL, lease_expires = NULL, finished_at = ?",
+            (time.time(),),
+        )
+
+    def release(self, lease: Lease) -> bool:
+        """Returns a leased item to the queue without counting the attempt, e.g., if its worker is stopped."""
+        return self._update_leased(
+            lease, "status = 'pending', worker = NULL, lease_expires = NULL, attempts = attempts - 1", ()
+        )
+
+    def fail(self, lease: Lease, error: str, max_attempts: int = 3) -> str | None:
+        """Records a failed attempt at a leased item, returning its new status (or `None` if it was lost).
+
+        The item is returned to the queue if it has been attempted fewer than `max_attempts` times, and is
+        otherwise marked as failed, along with all of the items depending on it.
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "worker = NULL, lease_expires = NULL, finished_at = ?, error = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running' AND attempts = ?",
+                (max_attempts, time.time(), error, lease.id, lease.worker, lease.attempt),
+            )
+            if cursor.rowcount != 1:
+                return None
+            (status,) = conn.execute("SELECT status FROM items WHERE id = ?", (lease.id,)).fetchone()
+            if status == FAILED:
+                self._fail_dependents(conn, lease.id, lease.item)
+        return status
+
+    def retry(self, stages: Iterable[str] | None = None) -> int:
+        """Returns the failed items (of `stages`, if given) to the queue, returning how many were reset."""
+        query = "UPDATE items SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'"
+        params = ()
+        if stages is not None:
+            stages = list(stages)
+            query = f"{query} AND stage IN ({', '.join('?' * len(stages))})"
+            params = tuple(stages)
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount
+
+    def counts(self, stage: str | None = None) -> dict[str, int]:
+        """Returns the number of items (of `stage`, if given) with each status."""
+        query, params = "SELECT status, COUNT(*) FROM items GROUP BY status", ()
+        if stage is not None:
+            query, params = "SELECT status, COUNT(*) FROM items WHERE stage = ? GROUP BY status", (stage,)
+        with self._connect() as conn:
+            counts = dict(conn.execute(query, params).fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def errors(self) -> list[tuple[GridItem, str]]:
+        """Returns the failed items, with the error each failed with."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, dataset, task, model, error FROM items WHERE status = 'failed' ORDER BY id"
+            ).fetchall()
+        return [(GridItem(*row[:4]), row[4]) for row in rows]
+
+
+def _heartbeats(queue: GridQueue, lease: Lease, lease_seconds: float, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        try:
+            if not queue.heartbeat(lease, lease_seconds):
+                logger.warning(
+                    f"Lost the lease on {lease.item} to another worker; its result will be dropped."
+                )
+                return
+        except sqlite3.Error as e:  # pragma: no cover
+            logger.warning(f"Failed to extend the lease on {lease.item}; retrying: {e}")
+
+
+def work(
+    queue: GridQueue,
+    run_item: Callable[[GridItem], object],
+    worker: str,
+    lease_seconds: float = 900,
+    heartbeat_seconds: float = 60,
+    poll_seconds: float = 30,
+    max_attempts: int = 3,
+    max_items: int | None = None,
+) -> dict[str, int]:
+    """Claims and runs items of the queue with `run_item` until none are left to run, or `max_items` are run.
+
+    While an item runs, its lease is extended every `heartbeat_seconds` by a background thread. If no item can
+    be run now, but others are running (and so may unblock items depending on them, or may be abandoned), the
+    worker waits `poll_seconds` before trying again. An item whose `run_item` raises an exception is returned
+    to the queue (or marked as failed, after `max_attempts`); if the worker is interrupted, the item is
+    returned to the queue without counting the attempt.
+
+    Returns:
+        The number of items this worker completed and failed.
+
+    Examples:
+        >>> import tempfile
+        >>> items = [GridItem("task", "D", t) for t in ("a", "b")] + [GridItem("model", "D", "a", "m")]
+        >>> def run_item(item):
+        ...     time.sleep(0.2)
+        ...     if item.task == "b":
+        ...         raise ValueError("no labels")
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     queue = GridQueue(Path(tmp_dir) / "grid.db")
+        ...     _ = queue.add(items)
+        ...     print(work(queue, run_item, "w1", lease_seconds=0.1, heartbeat_seconds=0.01, max_attempts=2))
+        ...     print(queue.counts())
+        ...     print([f"{item}: {error}" for item, error in queue.errors()])
+        {'done': 2, 'failed': 2}
+        {'pending': 0, 'running': 0, 'failed': 1, 'done': 2}
+        ['task D/b: ValueError: no labels']
+    """
+    worked = {DONE: 0, FAILED: 0}
+    while max_items is None or sum(worked.values()) < max_items:
+        lease = queue.claim(worker, lease_seconds, max_attempts)
+        if lease is None:
+            counts = queue.counts()
+            if not counts[RUNNING]:
+                break
+            logger.info(f"No items can be run yet; waiting for the {counts[RUNNING]} running items.")
+            time.sleep(poll_seconds)
+            continue
+
+        logger.info(f"Worker {worker} running {lease.item} (attempt {lease.attempt}).")
+        stop = threading.Event()
+        heartbeats = threading.Thread(
+            target=_heartbeats, args=(queue, lease, lease_seconds, heartbeat_seconds, stop), daemon=True
+        )
+        heartbeats.start()
+        try:
+            run_item(lease.item)
+        except Exception as e:
+            logger.error(f"Worker {worker} failed to run {lease.item}: {e}")
+            worked[FAILED] += 1
+            queue.fail(lease, f"{type(e).__name__}: {e}", max_attempts)
+        except BaseException:
+            logger.warning(f"Worker {worker} interrupted; returning {lease.item} to the queue.")
+            queue.release(lease)
+            raise
+        else:
+            worked[DONE] += 1
+            if not queue.complete(lease):
+                logger.warning(f"{lease.item} finished, but its lease had been lost to another worker.")
+        finally:
+            stop.set()
+            heartbeats.join()
+
+    return worked
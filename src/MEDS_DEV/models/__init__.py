@@ -1,4 +1,5 @@
 import itertools
+import sys
 from collections.abc import Generator
 from enum import StrEnum, auto
 from importlib.resources import files
@@ -7,6 +8,10 @@ from pathlib import Path
 import meds
 from omegaconf import DictConfig, OmegaConf
 
+from ..cache import dataset_fingerprint, fingerprint
+from ..resources import model_resources
+from ..utils import file_hash
+
 model_files = files("MEDS_DEV.models")
 CFG_YAML = files("MEDS_DEV.configs") / "_run_model.yaml"
 
@@ -18,6 +23,10 @@ for path in model_files.rglob("*/model.yaml"):
     requirements_path = path.parent / "requirements.txt"
     MODELS[model_name]["requirements"] = requirements_path if requirements_path.exists() else None
     MODELS[model_name]["model_dir"] = path.parent
+    MODELS[model_name].setdefault("caches", None)
+    MODELS[model_name].setdefault("resources", None)
+    MODELS[model_name].setdefault("budget", None)
+    MODELS[model_name].setdefault("requests", None)
 
 
 class RunMode(StrEnum):
@@ -27,11 +36,13 @@ class RunMode(StrEnum):
         TRAIN: Train a model.
         PREDICT: Predict with a model.
         FULL: Perform all viable stages for a model.
+        SERVE: Keep a model's predict path loaded in a worker, serving scoring jobs (see `MEDS_DEV.serving`).
     """
 
     TRAIN = auto()
     PREDICT = auto()
     FULL = auto()
+    SERVE = auto()
 
 
 ALL_RUN_MODES = [RunMode.TRAIN, RunMode.PREDICT]
@@ -54,6 +65,7 @@ class DatasetType(StrEnum):
 ALL_DATASET_TYPES = [DatasetType.UNSUPERVISED, DatasetType.SUPERVISED]
 
 COMMANDS_DICT_T = dict[str, dict[str, str]]
+STAGE_T = tuple[str, Path]
 
 
 def fmt_command(
@@ -119,8 +131,106 @@ def fmt_command(
     return commands[dataset_type][run_mode].format(**format_kwargs)
 
 
+def command_resources(cfg: DictConfig) -> dict[str, int | None]:
+    """Returns the `num_threads`, `num_workers`, and `memory_limit` each of the model's commands should use.
+
+    These are detected from the CPUs and memory available to this process (including container limits) and
+    split across the `cfg.num_task_workers` concurrently running tasks, with any overrides from the
+    `resources` key of the model's `model.yaml` applied, and those from the run configuration taking
+    precedence; see `MEDS_DEV.resources.model_resources`.
+
+    Examples:
+        >>> command_resources(DictConfig({"num_workers": 3, "num_threads": 2, "memory_limit": 1024}))
+        {'num_threads': 2, 'num_workers': 3, 'memory_limit': 1024}
+        >>> command_resources(DictConfig({}))["num_workers"] >= 1
+        True
+        >>> command_resources(DictConfig({"num_workers": None, "num_task_workers": 10**6}))["num_workers"]
+        1
+    """
+    overrides = MODELS.get(cfg.get("model", None), {}).get("resources", None)
+    return model_resources(cfg, overrides)
+
+
+def model_cache_root(cfg: DictConfig) -> Path:
+    """Returns the root directory under which the model's shared caches are stored.
+
+    Examples:
+        >>> model_cache_root(DictConfig({"model": "M", "cache_dir": "cache"}))
+        PosixPath('cache/models/M')
+    """
+    return Path(cfg.cache_dir) / "models" / cfg.model
+
+
+def model_cache_dirs(
+    cfg: DictConfig, caches: dict[str, str] | None, requirements: Path | None
+) -> dict[str, Path]:
+    """Returns the directories in which the model's shared caches are (or will be) stored.
+
+    Models can declare, under the `caches` key of their `model.yaml`, named commands that produce
+    task-independent artifacts (e.g., a tabularized or converted view of the dataset) that can be shared
+    across all tasks and runs over the same dataset. Each cache is stored in `cfg.cache_dir` under a key built
+    from the fingerprint of the dataset, the (un-formatted) cache command, the model's requirements, and the
+    demo flag, so that it is re-used exactly when all of those are unchanged.
+
+    Args:
+        cfg: The configuration for the model run.
+        caches: The dictionary of cache names to cache commands for the model, or `None`.
+        requirements: The path to the model's requirements file, or `None`.
+
+    Returns:
+        A dictionary mapping each cache name to its directory.
+
+    Examples:
+        >>> import tempfile
+        >>> cfg = DictConfig({"model": "M", "dataset_dir": "data", "cache_dir": "cache", "demo": False})
+        >>> model_cache_dirs(cfg, None, None)
+        {}
+        >>> dirs = model_cache_dirs(cfg, {"tab": "tabularize {dataset_dir} {output_dir}"}, None)
+        >>> dirs["tab"].parent
+        PosixPath('cache/models/M/tab')
+
+    The key changes with anything the cache may depend on, such as the cache command:
+        >>> other_caches = {"tab": "tabularize --max_codes=10 {dataset_dir} {output_dir}"}
+        >>> other_dirs = model_cache_dirs(cfg, other_caches, None)
+        >>> dirs["tab"] == other_dirs["tab"]
+        False
+    """
+    if not caches:
+        return {}
+
+    dataset_fp = dataset_fingerprint(cfg.dataset_dir)
+    requirements_hash = file_hash(requirements) if requirements else None
+    demo = cfg.get("demo", False)
+
+    cache_root = model_cache_root(cfg)
+    return {
+        name: cache_root / name / fingerprint(dataset_fp, cmd, requirements_hash, demo)
+        for name, cmd in caches.items()
+    }
+
+
+def fmt_cache_command(cfg: DictConfig, cmd: str, model_dir: Path, cache_dir: Path) -> str:
+    """Formats a cache command, with `{output_dir}` pointing to the cache directory.
+
+    Examples:
+        >>> cfg = DictConfig({"dataset_dir": "data", "num_workers": 2})
+        >>> fmt_cache_command(cfg, "build {dataset_dir} {output_dir} -j {num_workers}", "model", Path("c/k"))
+        'build data c/k -j 2'
+    """
+    return cmd.format(
+        dataset_dir=str(cfg.dataset_dir),
+        model_dir=str(model_dir),
+        demo=cfg.get("demo", False),
+        output_dir=str(cache_dir),
+        **command_resources(cfg),
+    )
+
+
 def model_commands(
-    cfg: DictConfig, commands: dict[str, dict[str, str]], model_dir: Path
+    cfg: DictConfig,
+    commands: dict[str, dict[str, str]],
+    model_dir: Path,
+    cache_dirs: dict[str, Path] | None = None,
 ) -> Generator[tuple[str, Path]]:
     """Yields the sequence of appropriate dataset, run mode pairs for the given config and commands.
 
@@ -148,6 +258,8 @@ def model_commands(
         commands: The dictionary of commands for the model. These are stored in the model folder in the
             `model.yaml` in the `commands` key and are loaded for the correct model from the MODELS variable.
         model_dir: The directory on disk of the model's configuration files in MEDS-DEV.
+        cache_dirs: The directories of the model's shared caches, as returned by `model_cache_dirs`. These are
+            available to commands as `{caches[name]}`.
 
     Yields:
         The sequence of base commands (un-formatted) to run for the given model run.
@@ -177,6 +289,41 @@ def model_commands(
         >>> list(model_commands(cfg, commands, model_dir))
         [('FT data=data labels=labels output=output', PosixPath('output'))]
 
+    Shared cache directories are available to commands by name:
+        >>> cache_commands = {"supervised": {"train": "FT data={caches[tab]} output={output_dir}"}}
+        >>> list(model_commands(cfg, cache_commands, model_dir, {"tab": Path("cache/tab/abc")}))
+        [('FT data=cache/tab/abc output=output', PosixPath('output'))]
+
+    The resources each command should use are available to commands as `{num_workers}`, `{num_threads}`,
+    and `{memory_limit}` (in MiB); see `command_resources`:
+        >>> cfg.num_workers = 8
+        >>> cfg.num_threads = 2
+        >>> cfg.memory_limit = 4096
+        >>> resource_cmd = "FT -w {num_workers} -t {num_threads} -m {memory_limit}"
+        >>> list(model_commands(cfg, {"supervised": {"train": resource_cmd}}, model_dir))
+        [('FT -w 8 -t 2 -m 4096', PosixPath('output'))]
+
+    The precision of CPU inference (and whether to report its accuracy cost against fp32) are available to
+    commands as `{inference_precision}` and `{report_precision_delta}`:
+        >>> precision_cmd = "P precision={inference_precision} report={report_precision_delta}"
+        >>> list(model_commands(cfg, {"supervised": {"train": precision_cmd}}, model_dir))
+        [('P precision=fp32 report=True', PosixPath('output'))]
+
+    Commands run in the model's environment, but can run MEDS-DEV helpers (e.g., `MEDS_DEV.predictions`) with
+    the interpreter running MEDS-DEV, `{meds_dev_python}`:
+        >>> helper_cmd = "{meds_dev_python} -m MEDS_DEV.predictions"
+        >>> list(model_commands(cfg, {"supervised": {"train": helper_cmd}}, model_dir))[0][0] == (
+        ...     f"{sys.executable} -m MEDS_DEV.predictions"
+        ... )
+        True
+
+    Workers started with `mode=serve` are given the socket to serve on as `{serve_socket}` and the name of the
+    model they serve as `{model}`, which they report to clients (see `MEDS_DEV.serving`):
+        >>> serve_cfg = DictConfig({**cfg, "mode": "serve", "serve_socket": "/tmp/w.sock", "model": "M"})
+        >>> serve_commands = {"supervised": {"serve": "S {serve_socket} {model} {labels_dir}"}}
+        >>> list(model_commands(serve_cfg, serve_commands, model_dir))
+        [('S /tmp/w.sock M labels', PosixPath('output'))]
+
     Other configuration arguments get passed through, like `model_initialization_dir`, though they only appear
     in the final command if their format args exist.
         >>> cfg.model_initialization_dir = "foobar"
@@ -203,9 +350,17 @@ def model_commands(
         "dataset_dir": str(cfg.dataset_dir),
         "model_dir": str(model_dir),
         "demo": cfg.get("demo", False),
+        "meds_dev_python": sys.executable,
+        **command_resources(cfg),
+        "inference_precision": cfg.get("inference_precision", "fp32"),
+        "report_precision_delta": cfg.get("report_precision_delta", True),
+        "caches": {name: str(d) for name, d in (cache_dirs or {}).items()},
     }
     if cfg.get("model_initialization_dir", None):
         format_kwargs["model_initialization_dir"] = cfg.model_initialization_dir
+    if cfg.get("serve_socket", None):
+        format_kwargs["serve_socket"] = str(cfg.serve_socket)
+        format_kwargs["model"] = cfg.get("model", None)
     if cfg.get("split", None):
         if do_set_split:
             raise ValueError(f"Cannot set split manually when mode is {cfg.mode}.")
@@ -254,4 +409,135 @@ def model_commands(
             format_kwargs["model_initialization_dir"] = str(run_output_dir)
 
 
-__all__ = ["MODELS", "CFG_YAML", "RunMode", "DatasetType", "model_commands"]
+def multi_task_model_commands(
+    cfg: DictConfig, commands: COMMANDS_DICT_T, model_dir: Path, cache_dirs: dict[str, Path] | None = None
+) -> tuple[list[STAGE_T], dict[str, list[STAGE_T]]]:
+    """Splits a multi-stage model run over several tasks into shared stages and per-task stages.
+
+    The configuration lists the tasks to run in `cfg.task_names`, and `cfg.labels_dir` must contain one labels
+    subdirectory per task, named by the task name (as is produced by `meds-dev-task`). The sequence of
+    commands for each task is as given by `model_commands` with `task_name` and `labels_dir` set for that
+    task.
+    The longest prefix of stages that is identical across all tasks (e.g., unsupervised pre-training) is
+    returned as the shared stages, which need only be run once; the remaining stages of each task (e.g.,
+    supervised training and prediction) are independent across tasks and can be run concurrently.
+
+    Args:
+        cfg: The configuration for the model run. Must be a multi-stage run (i.e., either `cfg.mode` or
+            `cfg.dataset_type` must be "full").
+        commands: The dictionary of commands for the model.
+        model_dir: The directory on disk of the model's configuration files in MEDS-DEV.
+        cache_dirs: The directories of the model's shared caches, as returned by `model_cache_dirs`.
+
+    Returns:
+        A tuple of the list of shared stages and a dictionary mapping each task name to its list of
+        task-specific stages, where each stage is a tuple of the command and its output directory.
+
+    Raises:
+        ValueError: If the configuration is not a multi-stage run, sets both `task_name` and `task_names`,
+            or sets no tasks.
+
+    Examples:
+        >>> cfg = DictConfig({
+        ...     "mode": "full",
+        ...     "dataset_type": "full",
+        ...     "dataset_dir": "data",
+        ...     "dataset_name": "D",
+        ...     "labels_dir": "labels",
+        ...     "task_names": ["t1", "a/t2"],
+        ...     "task_name": None,
+        ...     "output_dir": "out",
+        ... })
+        >>> commands = {
+        ...     "unsupervised": {"train": "PT {dataset_dir} {output_dir}"},
+        ...     "supervised": {
+        ...         "train": "FT {labels_dir} {model_initialization_dir} {output_dir}",
+        ...         "predict": "predict {labels_dir} {model_initialization_dir} {output_dir}",
+        ...     },
+        ... }
+        >>> shared, per_task = multi_task_model_commands(cfg, commands, "model_dir")
+        >>> shared
+        [('PT data out/D/unsupervised/train', PosixPath('out/D/unsupervised/train'))]
+        >>> for task, stages in per_task.items():
+        ...     print(task)
+        ...     for cmd, _ in stages:
+        ...         print(f"  {cmd}")
+        t1
+          FT labels/t1 out/D/unsupervised/train out/D/t1/train
+          predict labels/t1 out/D/t1/train out/D/t1/predict
+        a/t2
+          FT labels/a/t2 out/D/unsupervised/train out/D/a/t2/train
+          predict labels/a/t2 out/D/a/t2/train out/D/a/t2/predict
+
+    Models without shared stages simply have no shared stages:
+        >>> supervised_commands = {
+        ...     "supervised": {
+        ...         "train": "FT {labels_dir} {output_dir}",
+        ...         "predict": "predict {labels_dir} {model_initialization_dir} {output_dir}",
+        ...     },
+        ... }
+        >>> shared, per_task = multi_task_model_commands(cfg, supervised_commands, "model_dir")
+        >>> shared
+        []
+        >>> [len(stages) for stages in per_task.values()]
+        [2, 2]
+
+    Errors are raised for invalid configurations:
+        >>> cfg.mode = "train"
+        >>> cfg.dataset_type = "supervised"
+        >>> multi_task_model_commands(cfg, commands, "model_dir")
+        Traceback (most recent call last):
+            ...
+        ValueError: Multiple tasks can only be run when mode or dataset_type is full.
+        >>> cfg.mode = "full"
+        >>> cfg.task_name = "t1"
+        >>> multi_task_model_commands(cfg, commands, "model_dir")
+        Traceback (most recent call last):
+            ...
+        ValueError: Cannot set both task_name and task_names.
+        >>> cfg.task_name = None
+        >>> cfg.task_names = []
+        >>> multi_task_model_commands(cfg, commands, "model_dir")
+        Traceback (most recent call last):
+            ...
+        ValueError: No tasks specified in task_names.
+    """
+
+    if cfg.mode != RunMode.FULL and cfg.dataset_type != DatasetType.FULL:
+        raise ValueError("Multiple tasks can only be run when mode or dataset_type is full.")
+    if cfg.get("task_name", None):
+        raise ValueError("Cannot set both task_name and task_names.")
+
+    task_names = list(cfg.get("task_names", None) or [])
+    if not task_names:
+        raise ValueError("No tasks specified in task_names.")
+
+    task_stages = {}
+    for task_name in task_names:
+        task_cfg = OmegaConf.merge(
+            cfg, {"task_name": task_name, "labels_dir": str(Path(cfg.labels_dir) / task_name)}
+        )
+        task_stages[task_name] = list(model_commands(task_cfg, commands, model_dir, cache_dirs))
+
+    all_stages = list(task_stages.values())
+    n_shared = 0
+    while all(len(stages) > n_shared for stages in all_stages) and all(
+        stages[n_shared] == all_stages[0][n_shared] for stages in all_stages
+    ):
+        n_shared += 1
+
+    shared_stages = all_stages[0][:n_shared]
+    return shared_stages, {task: stages[n_shared:] for task, stages in task_stages.items()}
+
+
+__all__ = [
+    "MODELS",
+    "CFG_YAML",
+    "RunMode",
+    "DatasetType",
+    "fmt_cache_command",
+    "model_cache_dirs",
+    "model_cache_root",
+    "model_commands",
+    "multi_task_model_commands",
+]
@@ -1,5 +1,7 @@
 import logging
 import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -7,18 +9,197 @@ logger = logging.getLogger(__name__)
 import hydra
 from omegaconf import DictConfig
 
+from ..budget import BudgetExceeded, stage_budget
+from ..cache import build_cache, dataset_size, is_built
+from ..executors import make_executor, stage_requests
+from ..plan import CACHED, TO_RUN, Plan, PlanNode, done_status, estimate_seconds
+from ..registry import model_registry, stage_kind
+from ..serving import is_serving, send
 from ..utils import run_in_env, temp_env
-from . import CFG_YAML, MODELS, model_commands
+from . import (
+    CFG_YAML,
+    MODELS,
+    DatasetType,
+    RunMode,
+    fmt_cache_command,
+    model_cache_dirs,
+    model_commands,
+    multi_task_model_commands,
+)
 
 
-@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
-def main(cfg: DictConfig):
+def predict_with_worker(cfg: DictConfig, output_dir: Path):
+    """Sends a `mode=predict` run to the worker for `cfg.model` on `cfg.serve_socket`, as a scoring job."""
+    done_file = output_dir / ".done"
+    if done_file.is_file():
+        logger.info(f"Skipping prediction because {done_file} exists.")
+        return
+
+    job = {
+        "model": cfg.model,
+        "labels_dir": str(cfg.labels_dir),
+        "dataset_dir": str(cfg.dataset_dir),
+        "split": cfg.get("split", None),
+        "output_dir": str(output_dir),
+        "model_initialization_dir": cfg.get("model_initialization_dir", None),
+    }
+    logger.info(f"Sending prediction job to the worker serving on {cfg.serve_socket}: {job}")
+    send(cfg.serve_socket, job)
+    done_file.touch()
+
+
+def plan(cfg: DictConfig) -> Plan:
+    """Returns the plan of a model run: which of its stages (and shared caches) `run` would run or skip.
+
+    Nothing is run or written. Stages are skipped if their `.done` file exists or if their outputs would be
+    restored from the artifact registry, and the wall time of each stage to run is estimated from the
+    completed runs of the same stage of the model stored in the registry, scaled by the dataset's size.
+
+    Examples:
+        >>> import json, tempfile
+        >>> from unittest.mock import patch
+        >>> from MEDS_DEV.api import compose_config
+        >>> commands = {
+        ...     "unsupervised": {"train": "PT {caches[tab]} {output_dir}"},
+        ...     "supervised": {
+        ...         "train": "FT {labels_dir} {model_initialization_dir} {output_dir}",
+        ...         "predict": "P {labels_dir} {model_initialization_dir} {output_dir}",
+        ...     },
+        ... }
+        >>> caches = {"tab": "tab {output_dir}"}
+        >>> model = {**MODELS["random_predictor"], "commands": commands, "caches": caches}
+        >>> with tempfile.TemporaryDirectory() as tmp_dir, patch.dict(MODELS, {"M": model}):
+        ...     root = Path(tmp_dir)
+        ...     (root / "data" / "data").mkdir(parents=True)
+        ...     _ = (root / "data" / "data" / "0.parquet").write_text("1234")
+        ...     cfg = compose_config(
+        ...         "model", model="M", mode="full", dataset_type="full", dataset_dir=root / "data",
+        ...         dataset_name="D", task_names=["t1", "t2"], labels_dir=root / "labels",
+        ...         output_dir=root / "exp", cache_dir=root / "cache", registry_dir=root / "registry",
+        ...         num_workers=1,
+        ...     )
+        ...     pt_dir = root / "exp" / "D" / "unsupervised" / "train"
+        ...     pt_dir.mkdir(parents=True)
+        ...     (pt_dir / ".done").touch()
+        ...     # A fine-tuning run over a dataset half the size, recorded in the registry.
+        ...     artifact_dir = root / "registry" / "M" / "abc"
+        ...     artifact_dir.mkdir(parents=True)
+        ...     (artifact_dir / ".done").touch()
+        ...     manifest = {"dataset_type": "supervised", "run_mode": "train", "dataset_bytes": 2}
+        ...     _ = (artifact_dir / "manifest.json").write_text(json.dumps(manifest))
+        ...     _ = (artifact_dir / ".usage.json").write_text('{"wall_time": 30.0, "status": "completed"}')
+        ...     print(str(plan(cfg)).replace(tmp_dir, "..."))
+        Plan of meds-dev-model M: 5 nodes (1 cached, 0 stale, 4 to-run); ~2m 00s to run (2 not estimated).
+        [cached] unsupervised/train: .done exists
+            command: PT .../cache/models/M/tab/... .../exp/D/unsupervised/train
+            output_dir: .../exp/D/unsupervised/train
+        [to-run] t1/supervised/train: not yet run; ~1m 00s (from 1 recorded runs)
+            command: FT .../labels/t1 .../exp/D/unsupervised/train .../exp/D/t1/train
+            output_dir: .../exp/D/t1/train
+            after: unsupervised/train
+        [to-run] t1/supervised/predict: not yet run
+            command: P .../labels/t1 .../exp/D/t1/train .../exp/D/t1/predict
+            output_dir: .../exp/D/t1/predict
+            after: t1/supervised/train
+        [to-run] t2/supervised/train: not yet run; ~1m 00s (from 1 recorded runs)
+            command: FT .../labels/t2 .../exp/D/unsupervised/train .../exp/D/t2/train
+            output_dir: .../exp/D/t2/train
+            after: unsupervised/train
+        [to-run] t2/supervised/predict: not yet run
+            command: P .../labels/t2 .../exp/D/t2/train .../exp/D/t2/predict
+            output_dir: .../exp/D/t2/predict
+            after: t2/supervised/train
+    """
+    commands = MODELS[cfg.model]["commands"]
+    model_dir = MODELS[cfg.model]["model_dir"]
+    requirements = MODELS[cfg.model]["requirements"]
+    caches = MODELS[cfg.model]["caches"] or {}
+
+    # The registry may set the model_initialization_dir, which should not leak into the caller's config.
+    cfg = cfg.copy()
+    do_overwrite = cfg.get("do_overwrite", False)
+    output_dir = Path(cfg.output_dir)
+    result = Plan(f"meds-dev-model {cfg.model}")
+
+    if cfg.mode == RunMode.PREDICT and is_serving(cfg.get("serve_socket", None), cfg.model):
+        status, reason = done_status(output_dir, do_overwrite)
+        command = f"send a scoring job to the worker serving on {cfg.serve_socket}"
+        result.nodes.append(PlanNode(f"{cfg.dataset_type}/{cfg.mode}", command, output_dir, status, reason))
+        return result
+
+    cache_dirs = model_cache_dirs(cfg, caches, requirements)
+    init_dir = cfg.get("model_initialization_dir", None)
+    registry = model_registry(cfg, commands, model_dir, requirements)
+    if cfg.get("model_initialization_dir", None) != init_dir:
+        result.notes.append(f"model_initialization_dir: {cfg.model_initialization_dir} (from the registry)")
+    dataset_bytes = dataset_size(cfg.dataset_dir)
+
+    def cache_nodes(cmd: str) -> list[str]:
+        names = []
+        for name, cache_dir in cache_dirs.items():
+            if str(cache_dir) not in cmd:
+                continue
+            names.append(f"cache/{name}")
+            if any(node.name == names[-1] for node in result.nodes):
+                continue
+            status, reason = (CACHED, "built") if is_built(cache_dir) else (TO_RUN, "not yet built")
+            cache_cmd = fmt_cache_command(cfg, caches[name], model_dir, cache_dir)
+            result.nodes.append(PlanNode(names[-1], cache_cmd, cache_dir, status, reason))
+        return names
+
+    def add_stages(stages, after: list[str], task_name: str | None = None) -> list[str]:
+        for cmd, out_dir in stages:
+            dataset_type, run_mode = stage_kind(cfg, out_dir)
+            name = f"{dataset_type}/{run_mode}"
+            if task_name is not None and dataset_type == DatasetType.SUPERVISED:
+                name = f"{task_name}/{name}"
+
+            status, reason = done_status(out_dir, do_overwrite)
+            if registry is not None:
+                key = registry.stage_key(cmd, out_dir, task_name)
+                if status == TO_RUN and is_built(registry.artifact_dir(key)):
+                    status, reason = CACHED, f"restored from registry artifact {key}"
+
+            node = PlanNode(name, cmd, Path(out_dir), status, reason, list(after))
+            if status != CACHED:
+                node.after.extend(cache_nodes(cmd))
+                history = registry.usage_history(dataset_type, run_mode) if registry is not None else []
+                node.estimate = estimate_seconds(history, dataset_bytes)
+                node.n_samples = len(history)
+            result.nodes.append(node)
+            after = [name]
+        return after
+
+    if cfg.mode == RunMode.SERVE:
+        ((cmd, _),) = model_commands(cfg, commands, model_dir, cache_dirs)
+        after = cache_nodes(cmd)
+        reason = f"serves on {cfg.serve_socket} until shut down"
+        result.nodes.append(PlanNode(f"{cfg.dataset_type}/serve", cmd, output_dir, TO_RUN, reason, after))
+    elif not cfg.get("task_names", None):
+        add_stages(model_commands(cfg, commands, model_dir, cache_dirs), [])
+    else:
+        shared_stages, task_stages = multi_task_model_commands(cfg, commands, model_dir, cache_dirs)
+        after = add_stages(shared_stages, [])
+        for task_name, stages in task_stages.items():
+            add_stages(stages, after, task_name)
+    return result
+
+
+def run(cfg: DictConfig) -> Plan | None:
+    """Runs a model's stages, as configured by `_run_model.yaml`.
+
+    Returns:
+        The plan of the run (see `plan`), rather than running it, if `cfg.plan` is set.
+    """
     if cfg.model not in MODELS:
         raise ValueError(f"Model {cfg.model} not currently configured. Available models: {MODELS.keys()}")
+    if cfg.get("plan", False):
+        return plan(cfg)
 
     commands = MODELS[cfg.model]["commands"]
     model_dir = MODELS[cfg.model]["model_dir"]
     requirements = MODELS[cfg.model]["requirements"]
+    caches = MODELS[cfg.model]["caches"] or {}
 
     output_dir = Path(cfg.output_dir)
     if cfg.get("do_overwrite", False) and output_dir.exists():  # pragma: no cover
@@ -27,12 +208,98 @@ def main(cfg: DictConfig):
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if cfg.mode == RunMode.PREDICT and is_serving(cfg.get("serve_socket", None), cfg.model):
+        predict_with_worker(cfg, output_dir)
+        logger.info(f"Model {cfg.model} finished successfully.")
+        return
+
+    cache_dirs = model_cache_dirs(cfg, caches, requirements)
+
+    registry = model_registry(cfg, commands, model_dir, requirements)
+    executor = make_executor(cfg)
+    requests = MODELS[cfg.model]["requests"]
+
     with temp_env(cfg, requirements) as (temp_dir, env):
-        for cmd, out_dir in model_commands(cfg, commands, model_dir):
-            logger.info(f"Considering running model command: {cmd}")
-            try:
-                run_in_env(cmd, out_dir, env=env, do_overwrite=cfg.do_overwrite)
-            except Exception as e:  # pragma: no cover
-                raise ValueError(f"Failed to run {cfg.model} command {cmd}") from e
+
+        def run_stages(stages, task_name=None):
+            for cmd, out_dir in stages:
+                logger.info(f"Considering running model command: {cmd}")
+                try:
+                    if registry is not None:
+                        key = registry.stage_key(cmd, out_dir, task_name)
+                        registry.restore(key, out_dir)
+                        registry.record_initialization(out_dir)
+                    for name, cache_dir in cache_dirs.items():
+                        is_done = (Path(out_dir) / ".done").is_file() and not cfg.do_overwrite
+                        if str(cache_dir) in cmd and not is_done:
+                            cache_cmd = fmt_cache_command(cfg, caches[name], model_dir, cache_dir)
+                            cache_requests = stage_requests(cfg, requests, "cache")
+                            build_cache(cache_cmd, cache_dir, env, executor, cache_requests)
+                    run_mode = stage_kind(cfg, out_dir)[1]
+                    run_in_env(
+                        cmd,
+                        out_dir,
+                        env=env,
+                        do_overwrite=cfg.do_overwrite,
+                        budget=stage_budget(cfg, MODELS[cfg.model]["budget"], run_mode),
+                        executor=executor,
+                        requests=stage_requests(cfg, requests, run_mode),
+                    )
+                    if registry is not None:
+                        registry.store(key, out_dir, task_name)
+                except BudgetExceeded as e:
+                    logger.warning(f"{e} Re-run to resume it, with a larger budget. Usage: {e.usage}")
+                    raise
+                except Exception as e:  # pragma: no cover
+                    raise ValueError(f"Failed to run {cfg.model} command {cmd}") from e
+
+        if cfg.mode == RunMode.SERVE:
+            if not cfg.get("serve_socket", None):
+                raise ValueError("serve_socket must be set to serve a model.")
+            ((cmd, _),) = model_commands(cfg, commands, model_dir, cache_dirs)
+            for name, cache_dir in cache_dirs.items():
+                if str(cache_dir) in cmd:
+                    cache_cmd = fmt_cache_command(cfg, caches[name], model_dir, cache_dir)
+                    build_cache(cache_cmd, cache_dir, env, executor, stage_requests(cfg, requests, "cache"))
+            # Workers listen on a local socket, so are always run locally, whatever the executor.
+            logger.info(f"Serving {cfg.model} on {cfg.serve_socket} until shut down: {cmd}")
+            subprocess.run(cmd, shell=True, env=env, check=True)
+            return
+
+        if not cfg.get("task_names", None):
+            run_stages(model_commands(cfg, commands, model_dir, cache_dirs))
+            logger.info(f"Model {cfg.model} finished successfully.")
+            return
+
+        shared_stages, task_stages = multi_task_model_commands(cfg, commands, model_dir, cache_dirs)
+        run_stages(shared_stages)
+
+        n_workers = min(cfg.get("num_task_workers", 1), len(task_stages))
+        logger.info(f"Running {len(task_stages)} tasks for {cfg.model} with {n_workers} workers.")
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(run_stages, stages, task): task for task, stages in task_stages.items()}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    future.result()
+                    logger.info(f"Model {cfg.model} finished task {task} successfully.")
+                except Exception as e:
+                    logger.error(f"Model {cfg.model} failed on task {task}: {e}")
+                    failed[task] = e
+
+        if failed:
+            first_error = next(iter(failed.values()))
+            raise ValueError(
+                f"Model {cfg.model} failed on {len(failed)} tasks: {sorted(failed)}"
+            ) from first_error
 
     logger.info(f"Model {cfg.model} finished successfully.")
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    result = run(cfg)
+    if cfg.get("plan", False):
+        print(result)
@@ -46,8 +46,11 @@ def main(cfg: DictConfig) -> None:
     model_pretrained_dir = Path(cfg.model_initialization_dir)
     # Infer the task label
     task_label_name = Path(cfg.labels_dir).name
-    # meds_reader dir
-    meds_reader_dir = model_pretrained_dir / "meds_reader"
+    # meds_reader dir, either shared or built during pretraining
+    if cfg.get("meds_reader_dir", None):
+        meds_reader_dir = Path(cfg.meds_reader_dir)
+    else:
+        meds_reader_dir = model_pretrained_dir / "meds_reader"
     # Pretrained model dir
     pretrained_model_dir = model_pretrained_dir / "pretrained_cehrbert"
     # Fine-tuned model dir
@@ -68,6 +71,7 @@ def main(cfg: DictConfig) -> None:
     finetune_yaml["cohort_folder"] = cfg.labels_dir
     finetune_yaml["dataset_prepared_path"] = str(dataset_prepared_path.resolve())
     finetune_yaml["dataloader_num_workers"] = cfg.num_threads
+    finetune_yaml["preprocessing_num_workers"] = cfg.num_threads
     finetune_yaml["seed"] = cfg.seed
     finetune_yaml["do_train"] = True
     finetune_yaml["do_predict"] = True
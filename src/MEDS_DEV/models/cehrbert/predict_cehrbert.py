@@ -0,0 +1,392 @@
+import json
+import logging
+import os
+import socketserver
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import hydra
+import meds_reader
+import polars as pl
+import pyarrow.parquet as pq
+import torch
+from cehrbert.data_generators.hf_data_generator.hf_dataset_collator import (
+    CehrBertDataCollator,
+)
+from cehrbert.data_generators.hf_data_generator.hf_dataset_mapping import (
+    HFFineTuningMapping,
+    HFTokenizationMapping,
+    MedToCehrBertDatasetMapping,
+)
+from cehrbert.data_generators.hf_data_generator.meds_utils import (
+    convert_one_patient,
+    get_meds_to_cehrbert_conversion_cls,
+)
+from cehrbert.runners.hf_cehrbert_finetune_runner import (
+    load_finetuned_model,
+    load_pretrained_tokenizer,
+)
+from cehrbert.runners.hf_runner_argument_dataclass import (
+    DataTrainingArguments,
+    ModelArguments,
+)
+from meds_evaluation.schema import validate_binary_classification_schema
+from omegaconf import DictConfig, OmegaConf
+from sklearn.metrics import roc_auc_score
+from transformers import HfArgumentParser
+
+logger = logging.getLogger(__name__)
+
+CONFIG = Path(__file__).parent / "_config.yaml"
+
+PREDICTION_COLUMNS = [
+    "subject_id",
+    "prediction_time",
+    "boolean_value",
+    "predicted_boolean_value",
+    "predicted_boolean_probability",
+]
+# Shard column holding the fp32 model's probabilities, when comparing an optimized model against it
+REFERENCE_PROBABILITY = "reference_predicted_boolean_probability"
+
+
+def optimize_for_cpu(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    """Returns the model prepared for CPU inference at the given precision (`fp32` or `int8`).
+
+    With `int8`, the weights of all linear layers are quantized to int8 ahead of time and their activations
+    are quantized dynamically, per batch, which is typically several times faster than fp32 on CPUs with
+    int8 vector instructions, at a small cost in accuracy.
+    """
+    match precision:
+        case "fp32":
+            return model
+        case "int8":
+            return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        case _:
+            raise ValueError(f"Unsupported inference_precision {precision}; expected 'fp32' or 'int8'.")
+
+
+def safe_auroc(labels: pl.Series, probabilities: pl.Series) -> float | None:
+    if labels.n_unique() < 2:
+        return None
+    return float(roc_auc_score(labels.to_numpy(), probabilities.to_numpy()))
+
+
+def load_shard_labels(label_fp: Path, split_subjects: pl.Series) -> pl.DataFrame:
+    """Loads the labels of one label shard for the given subjects, sorted by subject and prediction time."""
+    return (
+        pl.scan_parquet(label_fp)
+        .select("subject_id", "prediction_time", "boolean_value")
+        .filter(pl.col("subject_id").is_in(split_subjects))
+        .sort("subject_id", "prediction_time")
+        .collect()
+    )
+
+
+class ShardWriter:
+    """Writes one shard batch by batch, as one row-group per batch, and moves it into place when closed.
+
+    As in `MEDS_DEV.predictions` (which can not be imported in this environment), a shard that exists is
+    always complete, so interrupted runs resume from the first shard that does not.
+    """
+
+    def __init__(self, out_fp: Path):
+        self.out_fp = out_fp
+        self.tmp_fp = out_fp.with_name(f".{out_fp.name}.tmp")
+        self.writer = None
+        out_fp.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, df: pl.DataFrame):
+        table = df.to_arrow()
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp_fp, table.schema, write_statistics=True)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_fp, self.out_fp)
+        logger.info(f"Wrote {self.out_fp}")
+
+
+class CehrBertFeaturizer:
+    """Converts label rows into collated CEHR-BERT model inputs, mirroring the fine-tuning data pipeline."""
+
+    def __init__(self, meds_reader_dir: Path, data_args: DataTrainingArguments, tokenizer, max_length: int):
+        self.database = meds_reader.SubjectDatabase(str(meds_reader_dir))
+        self.conversion = get_meds_to_cehrbert_conversion_cls(data_args.meds_to_cehrbert_conversion_type)
+        self.mappings = [
+            MedToCehrBertDatasetMapping(data_args, is_pretraining=False),
+            HFFineTuningMapping(),
+            HFTokenizationMapping(tokenizer, False),
+        ]
+        self.collator = CehrBertDataCollator(tokenizer, max_length, is_pretraining=False)
+
+    def __call__(self, labels: pl.DataFrame) -> tuple[pl.DataFrame, dict[str, torch.Tensor] | None]:
+        """Returns the label rows that could be featurized and their collated model inputs."""
+        kept, records = [], []
+        for i, (subject_id, prediction_time, label) in enumerate(labels.iter_rows()):
+            patient = convert_one_patient(
+                self.database[subject_id], self.conversion, prediction_time, int(label)
+            )
+            if patient["birth_datetime"] is None:
+                logger.warning(f"Skipping subject {subject_id}, which has no valid birth_datetime")
+                continue
+            record = dict(patient)
+            for mapping in self.mappings:
+                record.update(mapping.transform(record))
+            if record["num_of_concepts"] == 0:
+                logger.warning(f"Skipping subject {subject_id}, which has no records")
+                continue
+            kept.append(i)
+            records.append(record)
+
+        if not records:
+            return labels.clear(), None
+
+        batch = self.collator(records)
+        for key in ("person_id", "index_date", "classifier_label"):
+            batch.pop(key, None)
+        return labels[kept], batch
+
+
+def serve(socket_path: Path, handle, model: str):
+    """Serves scoring jobs on a Unix socket until a shutdown job is received, as `MEDS_DEV.serving.serve`."""
+    socket_path.unlink(missing_ok=True)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            job = json.loads(self.rfile.readline())
+            reply = {"status": "ok"}
+            if job == {"op": "shutdown"}:
+                self.server.do_shutdown = True
+            elif job == {"op": "ping"}:
+                reply["model"] = model
+            else:
+                logger.info(f"Processing job {job}")
+                try:
+                    if job.get("model", model) != model:
+                        raise ValueError(f"This worker serves {model}, not {job['model']}")
+                    handle(job)
+                except Exception as e:
+                    logger.exception(f"Failed to process job {job}")
+                    reply = {"status": "error", "error": repr(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+    with socketserver.UnixStreamServer(str(socket_path), Handler) as server:
+        server.do_shutdown = False
+        logger.info(f"Serving on {socket_path}")
+        try:
+            while not server.do_shutdown:
+                server.handle_request()
+        finally:
+            os.unlink(socket_path)
+
+
+class CehrBertPredictor:
+    """A fine-tuned CEHR-BERT model, loaded once, that scores labels directories on the CPU."""
+
+    def __init__(self, cfg: DictConfig):
+        torch.set_num_threads(cfg.num_threads)
+        self.cfg = cfg
+        self.precision = cfg.get("inference_precision", "fp32")
+        self.compare = self.precision != "fp32" and cfg.get("report_precision_delta", True)
+
+        self.model_finetuned_dir = Path(cfg.model_initialization_dir)
+        task_label_name = Path(cfg.labels_dir).name
+        finetune_yaml = OmegaConf.to_container(
+            OmegaConf.load(self.model_finetuned_dir / f"cehrbert_finetune_{task_label_name}.yaml")
+        )
+        data_args, model_args = HfArgumentParser((DataTrainingArguments, ModelArguments)).parse_dict(
+            finetune_yaml, allow_extra_keys=True
+        )
+
+        tokenizer = load_pretrained_tokenizer(model_args)
+        self.fp32_model = load_finetuned_model(
+            model_args, str(self.model_finetuned_dir / task_label_name)
+        ).eval()
+        self.model = optimize_for_cpu(self.fp32_model, self.precision)
+        logger.info(f"Scoring with the {self.precision} model")
+
+        self.featurizer = CehrBertFeaturizer(
+            Path(data_args.data_folder), data_args, tokenizer, model_args.max_position_embeddings
+        )
+
+    def handle(self, job: dict):
+        """Scores a job received over the serving socket; see `MEDS_DEV.serving` for the protocol."""
+        expected_dir = job.get("model_initialization_dir", None)
+        if expected_dir and Path(expected_dir).resolve() != self.model_finetuned_dir.resolve():
+            raise ValueError(f"Job expects the model in {expected_dir}, not {self.model_finetuned_dir}")
+        output_dir = Path(job["output_dir"])
+        self.predict(
+            Path(job["labels_dir"]),
+            Path(job.get("dataset_dir", None) or self.cfg.dataset_dir),
+            job.get("split", None) or self.cfg.split,
+            output_dir / "predictions",
+            output_dir,
+        )
+
+    def predict(
+        self, labels_dir: Path, dataset_dir: Path, split: str, predictions_dir: Path, output_dir: Path
+    ):
+        """Writes the predictions for the labels of the given split, as one shard per label shard."""
+        cfg, featurizer, model, fp32_model = self.cfg, self.featurizer, self.model, self.fp32_model
+        precision, compare = self.precision, self.compare
+
+        # The fp32 probabilities, aligned row-by-row with the prediction shards, when comparing precisions.
+        reference_dir = output_dir / "reference_predictions"
+
+        shards = sorted(fp.relative_to(labels_dir) for fp in labels_dir.rglob("*.parquet"))
+        if not shards:
+            logger.warning(f"No labels found in {labels_dir}; no predictions written.")
+            return
+
+        split_subjects = (
+            pl.scan_parquet(dataset_dir / "metadata" / "subject_splits.parquet")
+            .filter(pl.col("split") == split)
+            .select("subject_id")
+            .collect()["subject_id"]
+        )
+
+        def pending_batches():
+            """Yields the (shard, labels, is_last) batches of pending shards, loading one shard at a time.
+
+            Every pending shard gets at least one (possibly empty) batch, so that every label shard has a
+            predictions shard.
+            """
+            for shard in shards:
+                if (predictions_dir / shard).is_file():
+                    logger.info(f"Predictions for {shard} already exist; skipping.")
+                    continue
+                labels = load_shard_labels(labels_dir / shard, split_subjects)
+                n_rows = max(len(labels), 1)
+                logger.info(f"Scoring {len(labels)} {split} labels of {shard} in batches of {cfg.batch_size}")
+                for start in range(0, n_rows, cfg.batch_size):
+                    yield shard, labels.slice(start, cfg.batch_size), start + cfg.batch_size >= n_rows
+
+        scoring_seconds = {}
+
+        def score(model: torch.nn.Module, inputs: dict[str, torch.Tensor] | None, name: str) -> list[float]:
+            if inputs is None:
+                return []
+            st = time.perf_counter()
+            probabilities = torch.sigmoid(model(**inputs).logits).reshape(-1).tolist()
+            scoring_seconds[name] = scoring_seconds.get(name, 0.0) + time.perf_counter() - st
+            return probabilities
+
+        writers = {}
+        batches = pending_batches()
+        with ThreadPoolExecutor(max_workers=1) as prefetcher, torch.inference_mode():
+            # Only the next batch is featurized ahead, while the current one is scored.
+            batch = next(batches, None)
+            next_inputs = prefetcher.submit(featurizer, batch[1]) if batch else None
+            while batch is not None:
+                shard, _, is_last = batch
+                batch_labels, inputs = next_inputs.result()
+                batch = next(batches, None)
+                if batch is not None:
+                    next_inputs = prefetcher.submit(featurizer, batch[1])
+
+                if not writers:
+                    writers[predictions_dir] = ShardWriter(predictions_dir / shard)
+                    if compare:
+                        writers[reference_dir] = ShardWriter(reference_dir / shard)
+
+                probabilities = score(model, inputs, precision)
+                predictions = batch_labels.with_columns(
+                    pl.Series("predicted_boolean_probability", probabilities, dtype=pl.Float64),
+                ).with_columns(
+                    (pl.col("predicted_boolean_probability") > 0.5).alias("predicted_boolean_value")
+                )
+                if len(predictions):
+                    validate_binary_classification_schema(predictions)
+                writers[predictions_dir].write(predictions.select(PREDICTION_COLUMNS))
+                if compare:
+                    reference = score(fp32_model, inputs, "fp32")
+                    writers[reference_dir].write(
+                        pl.DataFrame(
+                            {REFERENCE_PROBABILITY: reference}, schema={REFERENCE_PROBABILITY: pl.Float64}
+                        )
+                    )
+
+                if is_last:
+                    for writer in writers.values():
+                        writer.close()
+                    writers = {}
+
+        if compare:
+            # Shards predicted by an earlier, interrupted run may have no fp32 reference (e.g., if that run
+            # did not compare precisions), so they are left out of the comparison.
+            compared = [shard for shard in shards if (reference_dir / shard).is_file()]
+            if len(compared) < len(shards):
+                logger.warning(
+                    f"{len(shards) - len(compared)} of {len(shards)} prediction shards have no fp32 "
+                    "reference predictions and are left out of the precision comparison."
+                )
+            if not compared:
+                return
+
+            scored = pl.read_parquet(
+                [predictions_dir / shard for shard in compared],
+                columns=["boolean_value", "predicted_boolean_probability"],
+            )
+            reference = pl.read_parquet([reference_dir / shard for shard in compared])[REFERENCE_PROBABILITY]
+            auroc = safe_auroc(scored["boolean_value"], scored["predicted_boolean_probability"])
+            fp32_auroc = safe_auroc(scored["boolean_value"], reference)
+            report = {
+                "inference_precision": precision,
+                "n_predictions": len(scored),
+                "n_shards_not_compared": len(shards) - len(compared),
+                f"{precision}_auroc": auroc,
+                "fp32_auroc": fp32_auroc,
+                "auroc_delta": None if auroc is None or fp32_auroc is None else auroc - fp32_auroc,
+                "max_abs_probability_delta": float(
+                    (scored["predicted_boolean_probability"] - reference).abs().max()
+                ),
+                "scoring_seconds": scoring_seconds,
+            }
+            report_fp = output_dir / "inference_report.json"
+            report_fp.write_text(json.dumps(report, indent=2))
+            logger.info(f"Wrote the {precision} vs. fp32 inference report to {report_fp}: {report}")
+
+
+@hydra.main(version_base=None, config_path=str(CONFIG.parent.resolve()), config_name=CONFIG.stem)
+def main(cfg: DictConfig) -> None:
+    """Scores a labels directory with a fine-tuned CEHR-BERT model, in batches, on the CPU.
+
+    The fine-tuned model is loaded once from the `model_initialization_dir` of the fine-tuning run, with the
+    same data and tokenizer settings used for fine-tuning. Label rows of the requested split are featurized
+    and scored `batch_size` at a time, with the next batch featurized in the background while the current one
+    is scored on `num_threads` threads.
+
+    Predictions are written to `predictions_dir` as one parquet file per label shard, at the label shard's
+    relative path, sorted by subject and prediction time with one row-group (with statistics) per batch. An
+    interrupted run resumes from the first label shard without predictions.
+
+    If `inference_precision` is `int8`, the model is dynamically quantized before scoring. Unless
+    `report_precision_delta` is false, the fp32 model also scores every batch, and the AUROC of both models,
+    their difference, and their scoring times are written to `{output_dir}/inference_report.json`, so the
+    accuracy cost of the faster model can be checked before turning the comparison off. Shards resumed from
+    an earlier run that has no fp32 predictions for them are left out of the report.
+
+    If `serve_socket` is set, the model is instead kept loaded to score the labels directories of jobs sent
+    to that Unix socket, until shut down, following the protocol of `MEDS_DEV.serving` (which can not be
+    imported in this environment). Each job's predictions are written to `{output_dir}/predictions` of the
+    job.
+    """
+    predictor = CehrBertPredictor(cfg)
+    if cfg.get("serve_socket", None):
+        serve(Path(cfg.serve_socket), predictor.handle, cfg.serve_model)
+        return
+
+    predictor.predict(
+        Path(cfg.labels_dir),
+        Path(cfg.dataset_dir),
+        cfg.split,
+        Path(cfg.predictions_dir),
+        Path(cfg.output_dir),
+    )
+
+
+if __name__ == "__main__":
+    main()
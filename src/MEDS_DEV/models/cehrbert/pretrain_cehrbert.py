@@ -44,15 +44,21 @@ def get_pretrain_model_dir(output_dir: Path) -> Path:
 @hydra.main(version_base=None, config_path=str(CONFIG.parent.resolve()), config_name=CONFIG.stem)
 def main(cfg: DictConfig) -> None:
     output_dir = Path(cfg.output_dir)
-    # Create the meds_reader database
-    meds_reader_dir = output_dir / "meds_reader"
-    meds_reader_dir.mkdir(exist_ok=True, parents=True)
-    logger.info(f"Creating the meds reader now at {meds_reader_dir}")
-    run_subprocess(
-        cmd=f"meds_reader_convert {cfg.dataset_dir} {meds_reader_dir} --num_threads {cfg.num_threads}",
-        temp_work_dir=str(output_dir),
-        out_dir=output_dir / "meds_reader",
-    )
+    output_dir.mkdir(exist_ok=True, parents=True)
+    if cfg.get("meds_reader_dir", None):
+        # Use the shared, pre-built meds_reader database
+        meds_reader_dir = Path(cfg.meds_reader_dir)
+        logger.info(f"Using the meds reader at {meds_reader_dir}")
+    else:
+        # Create the meds_reader database
+        meds_reader_dir = output_dir / "meds_reader"
+        meds_reader_dir.mkdir(exist_ok=True, parents=True)
+        logger.info(f"Creating the meds reader now at {meds_reader_dir}")
+        run_subprocess(
+            cmd=f"meds_reader_convert {cfg.dataset_dir} {meds_reader_dir} --num_threads {cfg.num_threads}",
+            temp_work_dir=str(output_dir),
+            out_dir=output_dir / "meds_reader",
+        )
     # model output
     logger.info(f"Creating the model output at {meds_reader_dir}")
     model_output_dir = get_pretrain_model_dir(output_dir)
@@ -73,6 +79,7 @@ def main(cfg: DictConfig) -> None:
     pretraining_yaml["data_folder"] = str(meds_reader_dir.resolve())
     pretraining_yaml["dataset_prepared_path"] = str(dataset_prepared_path.resolve())
     pretraining_yaml["dataloader_num_workers"] = cfg.num_threads
+    pretraining_yaml["preprocessing_num_workers"] = cfg.num_threads
     pretraining_yaml["seed"] = cfg.seed
 
     if cfg.get("demo", False):
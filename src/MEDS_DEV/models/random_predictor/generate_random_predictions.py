@@ -1,37 +1,142 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from importlib.resources import files
 from pathlib import Path
 
 import hydra
 import meds
-import numpy as np
 import polars as pl
 from meds_evaluation.schema import (
     PREDICTED_BOOLEAN_PROBABILITY_FIELD,
     PREDICTED_BOOLEAN_VALUE_FIELD,
-    validate_binary_classification_schema,
 )
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
+
+from ...predictions import (
+    PREDICTIONS_DIRNAME,
+    check_prediction_schema,
+    label_shards,
+    validate_prediction_files,
+    write_prediction_shard,
+)
+from ...serving import JOB_KEYS, serve
 
 logger = logging.getLogger(__name__)
 
 CONFIG = files("MEDS_DEV") / "models" / "random_predictor" / "_config.yaml"
 
+# splitmix64 constants; see https://prng.di.unimi.it/splitmix64.c
+_GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+_MIX_1 = 0xBF58476D1CE4E5B9
+_MIX_2 = 0x94D049BB133111EB
+
+
+def _u64(value: int) -> pl.Expr:
+    return pl.lit(value, dtype=pl.UInt64)
+
+
+def splitmix64(x: pl.Expr) -> pl.Expr:
+    """Mixes a `UInt64` expression with the splitmix64 finalizer, with wrapping arithmetic.
+
+    Examples:
+        >>> pl.select(splitmix64(_u64(0))).item()
+        16294208416658607535
+        >>> pl.select(splitmix64(_u64(1))).item()
+        10451216379200822465
+    """
+    z = x + _u64(_GOLDEN_GAMMA)
+    z = (z ^ (z // _u64(2**30))) * _u64(_MIX_1)
+    z = (z ^ (z // _u64(2**27))) * _u64(_MIX_2)
+    return z ^ (z // _u64(2**31))
+
+
+def hashed_uniform(seed: int) -> pl.Expr:
+    """Returns a uniform [0, 1) random number per row, derived from a seeded hash of the subject and time.
+
+    As each value depends only on the seed, `subject_id`, and `prediction_time` of its row, the values are
+    identical no matter how the labels are split into files, ordered, or processed in parallel.
+
+    Examples:
+        >>> from datetime import datetime
+        >>> df = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "prediction_time": [datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 1)],
+        ... })
+        >>> df.select(hashed_uniform(1).alias("p"))["p"].to_list()
+        [0.05844825508485374, 0.3323924438438932, 0.08611480655932413]
+        >>> df.reverse().select(hashed_uniform(1).alias("p"))["p"].to_list()[::-1]
+        [0.05844825508485374, 0.3323924438438932, 0.08611480655932413]
+        >>> df.select(hashed_uniform(2).alias("p"))["p"].to_list()
+        [0.6409774929627273, 0.6302682910358717, 0.7972064570935402]
+    """
+    subject = pl.col(meds.subject_id_field).cast(pl.Int64).reinterpret(signed=False)
+    time = pl.col(meds.prediction_time_field).dt.epoch("us").fill_null(0).reinterpret(signed=False)
+    h = splitmix64(splitmix64(splitmix64(_u64(seed % 2**64)) + subject) + time)
+    return (h // _u64(2**11)).cast(pl.Float64) / 2.0**53
+
+
+def predict_job(cfg: DictConfig, job: dict):
+    """Generates the predictions of a scoring job received by a serving worker (see `MEDS_DEV.serving`).
+
+    The job's `labels_dir`, `dataset_dir`, `split`, and `output_dir` override those of the worker's
+    configuration, and predictions are written to `{output_dir}/predictions` of the job.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root_dir = Path(tmp_dir)
+        ...     splits_fp = root_dir / "dataset" / "metadata" / "subject_splits.parquet"
+        ...     splits_fp.parent.mkdir(parents=True)
+        ...     pl.DataFrame({"subject_id": [1], "split": ["held_out"]}).write_parquet(splits_fp)
+        ...     (root_dir / "cohort").mkdir()
+        ...     pl.DataFrame({
+        ...         "subject_id": [1], "prediction_time": [datetime(2021, 1, 1)], "boolean_value": [False],
+        ...     }).write_parquet(root_dir / "cohort" / "0.parquet")
+        ...     worker_cfg = DictConfig({"split": "held_out", "seed": 42, "serve_socket": "worker.sock"})
+        ...     job = {
+        ...         "labels_dir": str(root_dir / "cohort"),
+        ...         "dataset_dir": str(root_dir / "dataset"),
+        ...         "output_dir": str(root_dir / "out"),
+        ...     }
+        ...     predict_job(worker_cfg, job)
+        ...     predictions = pl.read_parquet(root_dir / "out" / "predictions" / "0.parquet")
+        ...     predictions["predicted_boolean_value"].item()
+        True
+    """
+    overrides = {k: job[k] for k in JOB_KEYS if job.get(k, None) is not None}
+    overrides["predictions_dir"] = str(Path(job["output_dir"]) / PREDICTIONS_DIRNAME)
+    overrides["serve_socket"] = None
+    main(OmegaConf.merge(cfg, overrides))
+
 
 @hydra.main(version_base=None, config_path=str(CONFIG.parent.resolve()), config_name=CONFIG.stem)
 def main(cfg: DictConfig) -> None:
     """Generates random predictions for the specified split (must be held-out) of a dataset.
 
+    The labels of each label file (shard) are streamed, filtered to the subjects of the split, and written
+    straight to the prediction shard at the same relative path under the predictions directory (see
+    `MEDS_DEV.predictions`), with up to `num_workers` shards processed in parallel, so memory use does not
+    grow with the number of labels. Each probability is a seeded hash of the row's subject ID and
+    prediction time (see `hashed_uniform`), so predictions are reproducible regardless of the label files'
+    sharding or ordering.
+
+    If `serve_socket` is set, this instead serves scoring jobs on that socket until shut down (see
+    `predict_job` and `MEDS_DEV.serving`).
+
     Args:
         cfg: The configuration object, controlled through Hydra command line arguments. Takes:
           - dataset_dir: The directory containing the dataset.
           - labels_dir: The directory containing the labels.
-          - predictions_fp: The file path to write the predictions to.
+          - predictions_dir: The directory to write the prediction shards to.
           - seed: The random seed to use for generating predictions.
           - split: The split to generate predictions for. Must be the held-out split.
+          - serve_socket: If set, the Unix socket to serve scoring jobs on.
+          - serve_model: The model name the worker reports to clients, and accepts jobs for.
 
     Returns:
-        None. Writes the predictions to the specified file path.
+        None. Writes the predictions to the specified directory.
 
     Raises:
         FileNotFoundError: If the splits file or labels file(s) cannot be found.
@@ -44,7 +149,7 @@ def main(cfg: DictConfig) -> None:
     ...     "split": "train",
     ...     "dataset_dir": "data/dataset",
     ...     "labels_dir": "data/labels",
-    ...     "predictions_fp": "data/predictions.parquet",
+    ...     "predictions_dir": "data/predictions",
     ...     "seed": 42,
     ... })
     >>> main(cfg)
@@ -58,7 +163,7 @@ def main(cfg: DictConfig) -> None:
     ...         "split": "held_out",
     ...         "dataset_dir": os.path.join(tmp_dir, "dataset"),
     ...         "labels_dir": os.path.join(tmp_dir, "labels"),
-    ...         "predictions_fp": os.path.join(tmp_dir, "predictions.parquet"),
+    ...         "predictions_dir": os.path.join(tmp_dir, "predictions"),
     ...         "seed": 42,
     ...     })
     ...     main(cfg)
@@ -73,16 +178,16 @@ def main(cfg: DictConfig) -> None:
     ...     subject_splits_fp = dataset_dir / "metadata" / "subject_splits.parquet"
     ...     subject_splits_fp.parent.mkdir(parents=True)
     ...     subject_splits.write_parquet(subject_splits_fp)
-    ...     predictions_fp = root_dir / "predictions.parquet"
+    ...     predictions_dir = root_dir / "predictions"
     ...     cfg = DictConfig({
     ...         "split": "held_out",
     ...         "dataset_dir": str(dataset_dir),
     ...         "labels_dir": str(root_dir / "labels"),
-    ...         "predictions_fp": str(predictions_fp),
+    ...         "predictions_dir": str(predictions_dir),
     ...         "seed": 42,
     ...     })
     ...     main(cfg) # will not write anything since no labels are found
-    ...     assert not predictions_fp.is_file()
+    ...     assert not predictions_dir.exists()
 
     >>> with tempfile.TemporaryDirectory() as tmp_dir:
     ...     root_dir = Path(tmp_dir)
@@ -98,7 +203,7 @@ def main(cfg: DictConfig) -> None:
     ...         "split": "held_out",
     ...         "dataset_dir": str(dataset_dir),
     ...         "labels_dir": str(labels_dir),
-    ...         "predictions_fp": str(root_dir / "predictions.parquet"),
+    ...         "predictions_dir": str(root_dir / "predictions"),
     ...         "seed": 42,
     ...     })
     ...     main(cfg)
@@ -123,16 +228,16 @@ def main(cfg: DictConfig) -> None:
     ...     labels_dir.mkdir()
     ...     labels_fp = labels_dir / "labels.parquet"
     ...     labels.write_parquet(labels_fp)
-    ...     predictions_fp = root_dir / "predictions.parquet"
+    ...     predictions_dir = root_dir / "predictions"
     ...     cfg = DictConfig({
     ...         "split": "held_out",
     ...         "dataset_dir": str(dataset_dir),
     ...         "labels_dir": str(labels_dir),
-    ...         "predictions_fp": str(predictions_fp),
+    ...         "predictions_dir": str(predictions_dir),
     ...         "seed": 42,
     ...     })
     ...     main(cfg)
-    ...     predictions = pl.read_parquet(predictions_fp)
+    ...     predictions = pl.read_parquet(predictions_dir / "labels.parquet")
     ...     predictions
     shape: (2, 5)
     ┌────────────┬─────────────────────┬───────────────┬───────────────────────────────┬─────────────────────────┐
@@ -140,15 +245,46 @@ def main(cfg: DictConfig) -> None:
     │ ---        ┆ ---                 ┆ ---           ┆ ---                           ┆ ---                     │
     │ i64        ┆ datetime[μs]        ┆ bool          ┆ f64                           ┆ bool                    │
     ╞════════════╪═════════════════════╪═══════════════╪═══════════════════════════════╪═════════════════════════╡
-    │ 1          ┆ 2021-01-01 00:00:00 ┆ false         ┆ 0.773956                      ┆ true                    │
-    │ 2          ┆ 2021-01-02 00:00:00 ┆ true          ┆ 0.438878                      ┆ false                   │
+    │ 1          ┆ 2021-01-01 00:00:00 ┆ false         ┆ 0.744955                      ┆ true                    │
+    │ 2          ┆ 2021-01-02 00:00:00 ┆ true          ┆ 0.072803                      ┆ false                   │
     └────────────┴─────────────────────┴───────────────┴───────────────────────────────┴─────────────────────────┘
+
+    Predictions are written as one shard per label shard, mirroring the labels' layout, and do not depend on
+    how the labels are sharded:
+    >>> with tempfile.TemporaryDirectory() as tmp_dir:
+    ...     root_dir = Path(tmp_dir)
+    ...     dataset_dir = root_dir / "dataset"
+    ...     subject_splits_fp = dataset_dir / "metadata" / "subject_splits.parquet"
+    ...     subject_splits_fp.parent.mkdir(parents=True)
+    ...     subject_splits.write_parquet(subject_splits_fp)
+    ...     labels_dir = root_dir / "labels"
+    ...     (labels_dir / "nested").mkdir(parents=True)
+    ...     labels[2:].write_parquet(labels_dir / "0.parquet")
+    ...     labels[1:2].write_parquet(labels_dir / "nested" / "1.parquet")
+    ...     labels[:1].write_parquet(labels_dir / "nested" / "2.parquet")
+    ...     predictions_dir = root_dir / "predictions"
+    ...     cfg = DictConfig({
+    ...         "split": "held_out",
+    ...         "dataset_dir": str(dataset_dir),
+    ...         "labels_dir": str(labels_dir),
+    ...         "predictions_dir": str(predictions_dir),
+    ...         "seed": 42,
+    ...         "num_workers": 2,
+    ...     })
+    ...     main(cfg)
+    ...     print(sorted(str(fp.relative_to(predictions_dir)) for fp in predictions_dir.rglob("*.parquet")))
+    ...     pl.read_parquet(predictions_dir).sort("subject_id")["predicted_boolean_probability"].to_list()
+    ['0.parquet', 'nested/1.parquet', 'nested/2.parquet']
+    [0.7449552768200597, 0.07280326654255298]
     """  # noqa: E501
 
+    if cfg.get("serve_socket", None):
+        serve(cfg.serve_socket, partial(predict_job, cfg), cfg.serve_model)
+        return
+
     dataset_dir = Path(cfg.dataset_dir)
     labels_dir = Path(cfg.labels_dir)
-    predictions_fp = Path(cfg.predictions_fp)
-    predictions_fp.parent.mkdir(parents=True, exist_ok=True)
+    predictions_dir = Path(cfg.predictions_dir)
     seed = cfg.seed
 
     if cfg.split != meds.held_out_split:
@@ -164,42 +300,54 @@ def main(cfg: DictConfig) -> None:
             f"{dataset_dir}."
         )
 
-    splits = pl.read_parquet(splits_file, use_pyarrow=True)
-    subjects = set(splits.filter(pl.col("split") == cfg.split)[meds.subject_id_field])
+    # The split subjects are small (one row per subject) relative to the labels, so they are materialized
+    # once and used as an order-preserving semi-join filter over the streamed labels.
+    split_subjects = (
+        pl.scan_parquet(splits_file)
+        .filter(pl.col("split") == cfg.split)
+        .select(pl.col(meds.subject_id_field).cast(pl.Int64))
+        .unique()
+        .collect()[meds.subject_id_field]
+    )
 
     # Labels can live in any parquet file within the labels directory:
-    labels_files = list(labels_dir.rglob("*.parquet"))
-    if not labels_files:
+    shards = label_shards(labels_dir)
+    if not shards:
         logger.warning(f"No labels found in {labels_dir}. Exiting without writing.")
         return
 
-    def read_split(fp: Path) -> pl.DataFrame:
-        return pl.read_parquet(fp, use_pyarrow=True).filter(pl.col(meds.subject_id_field).is_in(subjects))
+    def predict(labels: pl.LazyFrame) -> pl.LazyFrame:
+        return (
+            labels.with_columns(pl.col(meds.subject_id_field).cast(pl.Int64))
+            .filter(pl.col(meds.subject_id_field).is_in(split_subjects))
+            .with_columns(hashed_uniform(seed).alias(PREDICTED_BOOLEAN_PROBABILITY_FIELD))
+            .with_columns(
+                (pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD) > 0.5).alias(PREDICTED_BOOLEAN_VALUE_FIELD)
+            )
+        )
+
+    def predict_shard(label_shard: Path):
+        write_prediction_shard(
+            predict(pl.scan_parquet(labels_dir / label_shard)), predictions_dir / label_shard
+        )
 
+    num_workers = cfg.get("num_workers", 1) or 1
     try:
-        labels = pl.concat([read_split(f) for f in labels_files], how="vertical_relaxed")
+        # Check the schema of the lazy predictions before writing any, as they are never materialized:
+        all_labels = pl.concat([pl.scan_parquet(labels_dir / fp) for fp in shards], how="vertical_relaxed")
+        check_prediction_schema(predict(all_labels).collect_schema())
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(predict_shard, shards))
     except Exception as e:
         err_lines = [f"Error reading labels: {e}", "Labels dir contents:"]
-        for file in labels_dir.rglob("*.parquet"):
-            err_lines.append(f"  - {file.relative_to(labels_dir)}")
+        for fp in shards:
+            err_lines.append(f"  - {fp}")
         err_str = "\n".join(err_lines)
         logger.error(err_str)
         raise ValueError(err_str) from e
 
-    rng = np.random.default_rng(seed)
-    probabilities = rng.uniform(0, 1, len(labels))
-
-    predictions = labels.with_columns(
-        pl.Series(probabilities).alias(PREDICTED_BOOLEAN_PROBABILITY_FIELD),
-    )
-    predictions = predictions.with_columns(
-        (pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD) > 0.5).alias(PREDICTED_BOOLEAN_VALUE_FIELD),
-    )
-
-    # Check the schema output:
-    validate_binary_classification_schema(predictions)
-
-    predictions.write_parquet(predictions_fp, use_pyarrow=True)
+    validate_prediction_files([predictions_dir / fp for fp in shards], num_workers=num_workers)
 
 
 if __name__ == "__main__":
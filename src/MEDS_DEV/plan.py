@@ -0,0 +1,185 @@
+"""Dry-run plans of MEDS-DEV stages: what each command line tool would run or skip, and for how long.
+
+Every stage's command line tool can be run with `plan=true` to print its plan instead of running anything: the
+nodes of its stage DAG (e.g., a model's shared caches and its sequence of stages, chained through
+`model_initialization_dir`), each with its command, output directory, upstream nodes, and status:
+
+  - `cached`: the node's outputs are complete (e.g., its `.done` file exists, or its outputs will be restored
+    from the artifact registry or evaluation cache), so it will be skipped.
+  - `stale`: the node has complete outputs that will be discarded and recomputed (e.g., with `do_overwrite`,
+    or for labels or evaluations whose inputs have since changed).
+  - `to-run`: the node has no complete outputs, so it will be run (or resumed, after an interrupted run).
+
+Nodes to run are given a wall time estimate where the compute of comparable runs has been recorded (see
+`MEDS_DEV.budget`): for model stages, the completed runs of the same stage of the model stored in the artifact
+registry, scaled linearly by the size of the dataset each was run over.
+"""
+
+import statistics
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .budget import read_usage
+
+CACHED = "cached"
+STALE = "stale"
+TO_RUN = "to-run"
+
+
+@dataclass
+class PlanNode:
+    """A node of a stage's plan.
+
+    Attributes:
+        name: The node's name, unique within its plan.
+        command: The command the node runs, if it is run as a command.
+        output_dir: The node's output directory.
+        status: One of `CACHED`, `STALE`, or `TO_RUN`.
+        reason: Why the node has its status.
+        after: The names of the nodes that must complete before this one.
+        estimate: The estimated wall time of running the node, in seconds, if it will be run and comparable
+            runs have been recorded.
+        n_samples: The number of recorded runs the estimate is based on.
+    """
+
+    name: str
+    command: str | None
+    output_dir: Path
+    status: str
+    reason: str
+    after: list[str] = field(default_factory=list)
+    estimate: float | None = None
+    n_samples: int = 0
+
+
+@dataclass
+class Plan:
+    """The plan of a stage run, as returned by each stage's `run` function with `plan=true`.
+
+    Examples:
+        >>> plan = Plan("meds-dev-model random_predictor", notes=["model_initialization_dir: reg/M/abc"])
+        >>> plan.nodes.append(PlanNode("supervised/train", "train out/train", Path("out/train"), CACHED,
+        ...                            ".done exists"))
+        >>> plan.nodes.append(PlanNode("supervised/predict", "predict out/train out/predict",
+        ...                            Path("out/predict"), TO_RUN, "not yet run", ["supervised/train"], 65.2,
+        ...                            2))
+        >>> plan.counts()
+        {'cached': 1, 'stale': 0, 'to-run': 1}
+        >>> print(plan)
+        Plan of meds-dev-model random_predictor: 2 nodes (1 cached, 0 stale, 1 to-run); ~1m 05s to run.
+          model_initialization_dir: reg/M/abc
+        [cached] supervised/train: .done exists
+            command: train out/train
+            output_dir: out/train
+        [to-run] supervised/predict: not yet run; ~1m 05s (from 2 recorded runs)
+            command: predict out/train out/predict
+            output_dir: out/predict
+            after: supervised/train
+    """
+
+    title: str
+    nodes: list[PlanNode] = field(default_factory=list)
+    notes: list[str] = field(default_factory=list)
+
+    def counts(self) -> dict[str, int]:
+        counts = {CACHED: 0, STALE: 0, TO_RUN: 0}
+        for node in self.nodes:
+            counts[node.status] += 1
+        return counts
+
+    def __str__(self) -> str:
+        counts = ", ".join(f"{n} {status}" for status, n in self.counts().items())
+        header = f"Plan of {self.title}: {len(self.nodes)} nodes ({counts})"
+
+        to_run = [node for node in self.nodes if node.status != CACHED]
+        if to_run:
+            estimated = [node.estimate for node in to_run if node.estimate is not None]
+            if estimated:
+                header = f"{header}; ~{format_seconds(sum(estimated))} to run"
+            if len(estimated) < len(to_run):
+                header = f"{header} ({len(to_run) - len(estimated)} not estimated)"
+
+        lines = [f"{header}.", *(f"  {note}" for note in self.notes)]
+        for node in self.nodes:
+            line = f"[{node.status}] {node.name}: {node.reason}"
+            if node.status != CACHED and node.estimate is not None:
+                line = f"{line}; ~{format_seconds(node.estimate)} (from {node.n_samples} recorded runs)"
+            lines.append(line)
+            if node.command:
+                lines.append(f"    command: {node.command}")
+            lines.append(f"    output_dir: {node.output_dir}")
+            if node.after:
+                lines.append(f"    after: {', '.join(node.after)}")
+        return "\n".join(lines)
+
+
+def format_seconds(seconds: float) -> str:
+    """Formats a duration for display.
+
+    Examples:
+        >>> format_seconds(4.2), format_seconds(65.2), format_seconds(3 * 3600 + 125)
+        ('4s', '1m 05s', '3h 02m')
+    """
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+
+def done_status(output_dir: Path, do_overwrite: bool = False) -> tuple[str, str]:
+    """Returns the status of a node that is skipped exactly when its `.done` file exists, and why.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     out = Path(tmp_dir)
+        ...     print(done_status(out))
+        ...     _ = (out / ".usage.json").write_text('{"n_runs": 2, "status": "budget_exceeded:wall_time"}')
+        ...     print(done_status(out))
+        ...     (out / ".done").touch()
+        ...     print(done_status(out))
+        ...     print(done_status(out, do_overwrite=True))
+        ('to-run', 'not yet run')
+        ('to-run', 'resuming after 2 runs (last: budget_exceeded:wall_time)')
+        ('cached', '.done exists')
+        ('stale', 'complete, but do_overwrite is set')
+    """
+    output_dir = Path(output_dir)
+    if (output_dir / ".done").is_file():
+        if do_overwrite:
+            return STALE, "complete, but do_overwrite is set"
+        return CACHED, ".done exists"
+
+    usage = read_usage(output_dir)
+    if usage.get("n_runs", 0):
+        return TO_RUN, f"resuming after {usage['n_runs']} runs (last: {usage['status']})"
+    return TO_RUN, "not yet run"
+
+
+def estimate_seconds(history: list[tuple[dict, int]], dataset_bytes: int) -> float | None:
+    """Estimates the wall time of a stage over a dataset of `dataset_bytes`, from comparable recorded runs.
+
+    Each recorded run's wall time is scaled linearly by the ratio of the dataset sizes, and the median of
+    these is returned.
+
+    Args:
+        history: The `.usage.json` record of each comparable run and the size (in bytes) of its dataset, e.g.,
+            from `MEDS_DEV.registry.ArtifactRegistry.usage_history`.
+        dataset_bytes: The size of the dataset to estimate the wall time for.
+
+    Returns:
+        The estimated wall time in seconds, or `None` if there is no history.
+
+    Examples:
+        >>> history = [({"wall_time": 10.0}, 100), ({"wall_time": 30.0}, 200), ({"wall_time": 50.0}, 100)]
+        >>> estimate_seconds(history, 400)
+        60.0
+        >>> print(estimate_seconds([], 400))
+        None
+    """
+    scaled = [usage["wall_time"] * dataset_bytes / n_bytes for usage, n_bytes in history if n_bytes > 0]
+    if not scaled:
+        return None
+    return statistics.median(scaled)
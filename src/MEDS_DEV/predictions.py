@@ -0,0 +1,467 @@
+"""Helpers for the sharded predictions convention.
+
+Rather than collapsing all predictions into a single `predictions.parquet` file, models should write their
+predictions as one parquet file per label shard, at the same relative path under the predictions directory
+(`{output_dir}/predictions` of the predict stage) as the label shard has under the labels directory. Each
+file is sorted by `subject_id` and `prediction_time` and written with row-group statistics, so that shards
+can be written and evaluated in parallel, with memory bounded by the size of a shard, and readers can skip
+row-groups by subject.
+
+Model scripts that run in their own virtual environments, where `MEDS_DEV` can not be imported, should follow
+the same convention (see, e.g., the CEHR-BERT predictor). Models whose tools write all predictions of a split
+to one file can split it into shards with `python -m MEDS_DEV.predictions PREDICTIONS_FP LABELS_DIR OUT_DIR`,
+run with the MEDS-DEV interpreter (`{meds_dev_python}` in model commands); see `split_predictions`.
+
+Prediction files are validated against the binary classification schema of `meds-evaluation` without being
+loaded: their schemas are read from their parquet metadata, and their data checked by one lazy aggregation
+per shard, over only the columns being checked.
+"""
+
+import logging
+import os
+import sys
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import meds
+import polars as pl
+from meds_evaluation.schema import (
+    BINARY_CLASSIFICATION_SCHEMA_DICT,
+    PREDICTED_BOOLEAN_PROBABILITY_FIELD,
+    PREDICTION_FIELDS,
+    REQUIRED_FIELDS,
+)
+
+logger = logging.getLogger(__name__)
+
+PREDICTIONS_DIRNAME = "predictions"
+SORT_COLS = [meds.subject_id_field, meds.prediction_time_field]
+ROW_GROUP_SIZE = 100_000
+SCHEMA_FIELDS = list(BINARY_CLASSIFICATION_SCHEMA_DICT)
+REQUIRED_SCHEMA_FIELDS = [field for field in SCHEMA_FIELDS if field in REQUIRED_FIELDS]
+
+
+def label_shards(labels_dir: Path) -> list[Path]:
+    """Returns the paths of all label shards, relative to the labels directory, in a stable order.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     labels_dir = Path(tmp_dir)
+        ...     for fn in ("train/1.parquet", "held_out/0.parquet", "train/0.parquet", "README.md"):
+        ...         (labels_dir / fn).parent.mkdir(exist_ok=True)
+        ...         (labels_dir / fn).touch()
+        ...     label_shards(labels_dir)
+        [PosixPath('held_out/0.parquet'), PosixPath('train/0.parquet'), PosixPath('train/1.parquet')]
+    """
+    labels_dir = Path(labels_dir)
+    return sorted(fp.relative_to(labels_dir) for fp in labels_dir.rglob("*.parquet"))
+
+
+def write_prediction_shard(predictions: pl.DataFrame | pl.LazyFrame, out_fp: Path):
+    """Writes one shard of predictions, sorted by subject and prediction time, with row-group statistics.
+
+    The shard is written to a temporary file and then moved into place, so that a shard that exists is always
+    complete (e.g., for resuming interrupted runs).
+
+    Args:
+        predictions: The predictions for a single label shard, in eager or lazy form. Lazy predictions are
+            streamed to disk without being materialized.
+        out_fp: The file path to write the shard to.
+
+    Examples:
+        >>> import tempfile, pyarrow.parquet as pq
+        >>> from datetime import datetime
+        >>> predictions = pl.DataFrame({
+        ...     "subject_id": [2, 1, 1],
+        ...     "prediction_time": [datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 1)],
+        ...     "predicted_boolean_probability": [0.1, 0.2, 0.3],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     out_fp = Path(tmp_dir) / "held_out" / "0.parquet"
+        ...     write_prediction_shard(predictions.lazy(), out_fp)
+        ...     print(pl.read_parquet(out_fp)["predicted_boolean_probability"].to_list())
+        ...     stats = pq.ParquetFile(out_fp).metadata.row_group(0).column(0).statistics
+        ...     print(stats.min, stats.max)
+        ...     print(sorted(p.name for p in out_fp.parent.iterdir()))
+        [0.3, 0.2, 0.1]
+        1 2
+        ['0.parquet']
+    """
+    out_fp = Path(out_fp)
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = out_fp.with_name(f".{out_fp.name}.tmp")
+
+    sorted_predictions = predictions.sort(SORT_COLS)
+    if isinstance(sorted_predictions, pl.LazyFrame):
+        sorted_predictions.sink_parquet(tmp_fp, statistics=True, row_group_size=ROW_GROUP_SIZE)
+    else:
+        sorted_predictions.write_parquet(tmp_fp, statistics=True, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp_fp, out_fp)
+
+
+def split_predictions(predictions_fp: Path, labels_dir: Path, predictions_dir: Path) -> int:
+    """Splits a single predictions file into one predictions shard per label shard.
+
+    Each label shard's predictions are the rows of `predictions_fp` whose subject and prediction time appear
+    in that label shard. The predictions file is scanned lazily, once per label shard, so only one shard's
+    predictions are in memory at a time. Each shard is written with `write_prediction_shard`, and label shards
+    without predictions (e.g., of other splits) get empty shards.
+
+    Returns:
+        The number of predictions written, over all shards.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> labels = pl.DataFrame({
+        ...     "subject_id": [1, 2, 3, 4],
+        ...     "prediction_time": [datetime(2021, 1, 1)] * 4,
+        ...     "boolean_value": [True, False, True, False],
+        ... })
+        >>> predictions = labels.with_columns(predicted_boolean_probability=pl.Series([0.1, 0.2, 0.3, 0.4]))
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     shards = [("held_out", labels[:1]), ("held_out", labels[2:]), ("train", labels[1:2])]
+        ...     for split, shard in shards:
+        ...         (root / "labels" / split).mkdir(parents=True, exist_ok=True)
+        ...         shard.write_parquet(root / "labels" / split / f"{len(shard)}.parquet")
+        ...     predictions.filter(pl.col("subject_id") != 2).write_parquet(root / "predictions.parquet")
+        ...     split_predictions(root / "predictions.parquet", root / "labels", root / "predictions")
+        ...     for fp in prediction_files(root):
+        ...         shard = pl.read_parquet(fp)
+        ...         print(fp.relative_to(root), shard["predicted_boolean_probability"].to_list())
+        3
+        predictions/held_out/1.parquet [0.1]
+        predictions/held_out/2.parquet [0.3, 0.4]
+        predictions/train/1.parquet []
+    """
+    predictions = pl.scan_parquet(predictions_fp)
+    key_schema = {col: dtype for col, dtype in predictions.collect_schema().items() if col in SORT_COLS}
+
+    n_predictions = 0
+    for shard in label_shards(labels_dir):
+        keys = pl.scan_parquet(Path(labels_dir) / shard).select(SORT_COLS).cast(key_schema).unique()
+        shard_predictions = predictions.join(keys, on=SORT_COLS, how="semi").collect()
+        write_prediction_shard(shard_predictions, Path(predictions_dir) / shard)
+        n_predictions += len(shard_predictions)
+
+    logger.info(f"Split {n_predictions} predictions from {predictions_fp} into {predictions_dir}.")
+    return n_predictions
+
+
+def predictions_root(predictions_dir: Path) -> Path:
+    """Returns the directory the prediction files of a predict stage are under.
+
+    This is the sharded `predictions` subdirectory if it exists, in which shards have the same relative paths
+    as the label shards they predict (e.g., `held_out/0.parquet`), and the directory itself otherwise.
+    """
+    predictions_dir = Path(predictions_dir)
+    sharded_dir = predictions_dir / PREDICTIONS_DIRNAME
+    return sharded_dir if sharded_dir.is_dir() else predictions_dir
+
+
+def prediction_files(predictions_dir: Path) -> list[Path]:
+    """Returns all prediction files produced by a predict stage, in a stable order.
+
+    If the sharded `predictions` subdirectory exists, only its shards are returned; otherwise (e.g., for
+    models writing a single predictions file), all parquet files under the directory are.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     predictions_dir = Path(tmp_dir)
+        ...     (predictions_dir / "predictions.parquet").touch()
+        ...     print([str(fp.relative_to(predictions_dir)) for fp in prediction_files(predictions_dir)])
+        ...     (predictions_dir / "predictions" / "held_out").mkdir(parents=True)
+        ...     (predictions_dir / "predictions" / "held_out" / "0.parquet").touch()
+        ...     (predictions_dir / "predictions" / "held_out" / ".1.parquet.tmp").touch()
+        ...     print([str(fp.relative_to(predictions_dir)) for fp in prediction_files(predictions_dir)])
+        ['predictions.parquet']
+        ['predictions/held_out/0.parquet']
+    """
+    return sorted(predictions_root(predictions_dir).rglob("*.parquet"))
+
+
+def predictions_glob(predictions_dir: Path) -> str:
+    """Returns a glob matching exactly the files `prediction_files` would return, for external readers.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     predictions_dir = Path(tmp_dir)
+        ...     print(predictions_glob(predictions_dir).replace(tmp_dir, "$DIR"))
+        ...     (predictions_dir / "predictions").mkdir()
+        ...     print(predictions_glob(predictions_dir).replace(tmp_dir, "$DIR"))
+        $DIR/**/*.parquet
+        $DIR/predictions/**/*.parquet
+    """
+    return str(predictions_root(predictions_dir) / "**" / "*.parquet")
+
+
+def scan_predictions(predictions_dir: Path) -> pl.LazyFrame:
+    """Lazily scans all prediction files produced by a predict stage.
+
+    Raises:
+        FileNotFoundError: If no prediction files are found.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     predictions_dir = Path(tmp_dir)
+        ...     for i in range(2):
+        ...         shard = pl.DataFrame({"subject_id": [i], "prediction_time": [datetime(2021, 1, 1)]})
+        ...         write_prediction_shard(shard, predictions_dir / PREDICTIONS_DIRNAME / f"{i}.parquet")
+        ...     print(scan_predictions(predictions_dir).collect()["subject_id"].to_list())
+        [0, 1]
+        >>> scan_predictions(Path("/nonexistent"))
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No prediction files found in /nonexistent
+    """
+    files = prediction_files(predictions_dir)
+    if not files:
+        raise FileNotFoundError(f"No prediction files found in {predictions_dir}")
+    return pl.scan_parquet(files)
+
+
+def check_prediction_schema(schema: Mapping[str, pl.DataType], source: str = "predictions") -> list[str]:
+    """Checks a predictions schema against the binary classification schema of `meds-evaluation`.
+
+    Args:
+        schema: The schema, e.g., from a parquet file's metadata or a lazy frame's `collect_schema`.
+        source: The name of the predictions, for error messages.
+
+    Returns:
+        The prediction fields in the schema, in sorted order.
+
+    Raises:
+        ValueError: If required or all prediction fields are missing, or any field has the wrong type.
+
+    Examples:
+        >>> schema = {"subject_id": pl.Int64, "prediction_time": pl.Datetime(), "boolean_value": pl.Boolean}
+        >>> check_prediction_schema({**schema, "predicted_boolean_probability": pl.Float64})
+        ['predicted_boolean_probability']
+        >>> check_prediction_schema(schema)
+        Traceback (most recent call last):
+            ...
+        ValueError: predictions: missing all prediction fields (predicted_boolean_probability, ...
+        >>> check_prediction_schema({**schema, "subject_id": pl.Int32, "predicted_boolean_value": pl.Float64})
+        Traceback (most recent call last):
+            ...
+        ValueError: predictions: subject_id has type Int32, expected Int64; predicted_boolean_value has ...
+    """
+    problems = []
+    missing = [field for field in REQUIRED_SCHEMA_FIELDS if field not in schema]
+    if missing:
+        problems.append(f"missing required fields ({', '.join(missing)})")
+
+    prediction_fields = sorted(PREDICTION_FIELDS & set(schema))
+    if not prediction_fields:
+        problems.append(f"missing all prediction fields ({', '.join(sorted(PREDICTION_FIELDS))})")
+
+    for field in (field for field in SCHEMA_FIELDS if field in schema):
+        if schema[field] != BINARY_CLASSIFICATION_SCHEMA_DICT[field]:
+            problems.append(
+                f"{field} has type {schema[field]}, expected {BINARY_CLASSIFICATION_SCHEMA_DICT[field]}"
+            )
+
+    if problems:
+        raise ValueError(f"{source}: {'; '.join(problems)}")
+    return prediction_fields
+
+
+def prediction_file_stats(fp: Path, prediction_fields: Sequence[str]) -> dict[str, int]:
+    """Returns the null and out-of-range counts of a prediction file, from one lazy aggregation.
+
+    Only the checked columns are read, and the file is aggregated by the streaming engine, so memory is
+    bounded independently of the size of the file.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     fp = Path(tmp_dir) / "0.parquet"
+        ...     pl.DataFrame({
+        ...         "subject_id": [1, None, 3],
+        ...         "prediction_time": [datetime(2021, 1, 1)] * 3,
+        ...         "boolean_value": [True, False, True],
+        ...         "predicted_boolean_probability": [0.5, float("nan"), 1.5],
+        ...     }).write_parquet(fp)
+        ...     stats = prediction_file_stats(fp, ["predicted_boolean_probability"])
+        >>> for name, value in stats.items():
+        ...     print(name, value)
+        n 3
+        subject_id_nulls 1
+        prediction_time_nulls 0
+        boolean_value_nulls 0
+        predicted_boolean_probability_nulls 0
+        predicted_boolean_probability_nan 1
+        predicted_boolean_probability_out_of_range 1
+    """
+    aggs = {"n": pl.len()}
+    for field in [*REQUIRED_SCHEMA_FIELDS, *prediction_fields]:
+        aggs[f"{field}_nulls"] = pl.col(field).null_count()
+    if PREDICTED_BOOLEAN_PROBABILITY_FIELD in prediction_fields:
+        p = pl.col(PREDICTED_BOOLEAN_PROBABILITY_FIELD)
+        aggs[f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD}_nan"] = p.is_nan().sum()
+        aggs[f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD}_out_of_range"] = (
+            (p < 0) | ((p > 1) & p.is_not_nan())
+        ).sum()
+
+    stats = pl.scan_parquet(fp).select(**aggs).collect(streaming=True)
+    return {k: int(v or 0) for k, v in stats.row(0, named=True).items()}
+
+
+def validate_prediction_files(files: Sequence[Path], num_workers: int = 1) -> int:
+    """Validates prediction files shard by shard, without loading them into memory.
+
+    Each file's schema is read from its parquet metadata and checked by `check_prediction_schema`, and all
+    files must have the same prediction fields. Then each file is checked by `prediction_file_stats` (on
+    `num_workers` threads): required fields may not be null, predicted probabilities may not be NaN or outside
+    of [0, 1], and each prediction field must be either entirely null (i.e., not predicted) or never null,
+    with at least one field predicted.
+
+    Returns:
+        The total number of predictions.
+
+    Raises:
+        FileNotFoundError: If no files are given.
+        ValueError: Listing every problem found, by file.
+
+    Examples:
+        >>> import tempfile
+        >>> from datetime import datetime
+        >>> def shard(probabilities: list[float | None]) -> pl.DataFrame:
+        ...     n = len(probabilities)
+        ...     return pl.DataFrame({
+        ...         "subject_id": list(range(n)),
+        ...         "prediction_time": [datetime(2021, 1, 1)] * n,
+        ...         "boolean_value": [True] * n,
+        ...         "predicted_boolean_value": [None] * n,
+        ...         "predicted_boolean_probability": probabilities,
+        ...     }, schema=BINARY_CLASSIFICATION_SCHEMA_DICT)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     shard([0.1, 0.9]).write_parquet(root / "0.parquet")
+        ...     shard([]).write_parquet(root / "1.parquet")
+        ...     print(validate_prediction_files([root / "0.parquet", root / "1.parquet"], num_workers=2))
+        2
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     shard([0.1, 0.9]).write_parquet(root / "0.parquet")
+        ...     shard([0.1, None, 1.2]).write_parquet(root / "2.parquet")
+        ...     validate_prediction_files([root / "0.parquet", root / "2.parquet"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions:
+          .../2.parquet: predicted_boolean_probability has 1 of 3 values null; ... 1 values outside of [0, 1]
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     shard([None]).write_parquet(root / "0.parquet")
+        ...     shard([0.1]).drop("predicted_boolean_value").write_parquet(root / "1.parquet")
+        ...     validate_prediction_files([root / "0.parquet"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions:
+          no prediction field has any values (predicted_boolean_probability, predicted_boolean_value)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     shard([0.1]).write_parquet(root / "0.parquet")
+        ...     shard([0.1]).drop("predicted_boolean_value").write_parquet(root / "1.parquet")
+        ...     validate_prediction_files([root / "0.parquet", root / "1.parquet"])
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid predictions:
+          .../1.parquet: has prediction fields predicted_boolean_probability, but .../0.parquet has ...
+        >>> validate_prediction_files([])
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: No prediction files to validate.
+    """
+    if not files:
+        raise FileNotFoundError("No prediction files to validate.")
+
+    problems = []
+    prediction_fields = None
+    for fp in files:
+        try:
+            fields = check_prediction_schema(pl.read_parquet_schema(fp), str(fp))
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        if prediction_fields is None:
+            prediction_fields = (fp, fields)
+        elif fields != prediction_fields[1]:
+            problems.append(
+                f"{fp}: has prediction fields {', '.join(fields)}, but {prediction_fields[0]} has "
+                f"{', '.join(prediction_fields[1])}"
+            )
+    if problems:
+        raise ValueError("\n  ".join(["Invalid predictions:", *problems]))
+
+    fields = prediction_fields[1]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        all_stats = list(pool.map(lambda fp: prediction_file_stats(fp, fields), files))
+
+    n_total = sum(stats["n"] for stats in all_stats)
+    predicted = {
+        field for field in fields if any(stats[f"{field}_nulls"] < stats["n"] for stats in all_stats)
+    }
+    for fp, stats in zip(files, all_stats):
+        file_problems = []
+        for field in [*REQUIRED_SCHEMA_FIELDS, *sorted(predicted)]:
+            if n_nulls := stats[f"{field}_nulls"]:
+                file_problems.append(f"{field} has {n_nulls} of {stats['n']} values null")
+        if PREDICTED_BOOLEAN_PROBABILITY_FIELD in predicted:
+            if n_nan := stats[f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD}_nan"]:
+                file_problems.append(f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD} has {n_nan} NaN values")
+            if n_out := stats[f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD}_out_of_range"]:
+                file_problems.append(
+                    f"{PREDICTED_BOOLEAN_PROBABILITY_FIELD} has {n_out} values outside of [0, 1]"
+                )
+        if file_problems:
+            problems.append(f"{fp}: {'; '.join(file_problems)}")
+
+    if n_total and not predicted:
+        problems.append(f"no prediction field has any values ({', '.join(fields)})")
+    if problems:
+        raise ValueError("\n  ".join(["Invalid predictions:", *problems]))
+
+    logger.info(f"Validated {n_total} predictions in {len(files)} files.")
+    return n_total
+
+
+def validate_predictions(predictions_dir: Path, num_workers: int = 1) -> int:
+    """Validates all prediction files produced by a predict stage; see `validate_prediction_files`.
+
+    Raises:
+        FileNotFoundError: If no prediction files are found.
+    """
+    files = prediction_files(predictions_dir)
+    if not files:
+        raise FileNotFoundError(f"No prediction files found in {predictions_dir}")
+    return validate_prediction_files(files, num_workers=num_workers)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Splits a predictions file into shards, when run as `python -m MEDS_DEV.predictions`.
+
+    Examples:
+        >>> main(["predictions.parquet"])
+        usage: python -m MEDS_DEV.predictions PREDICTIONS_FP LABELS_DIR PREDICTIONS_DIR
+        2
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 3:
+        print("usage: python -m MEDS_DEV.predictions PREDICTIONS_FP LABELS_DIR PREDICTIONS_DIR")
+        return 2
+    split_predictions(*map(Path, argv))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,564 @@
+"""A local, content-addressed registry of completed model stage outputs (e.g., checkpoints).
+
+Each completed model command's output directory is stored in the registry under a key built from everything
+the output depends on: the model, its requirements, the dataset and labels contents, the task, and the
+formatted command (with run-specific paths, such as the output directory, replaced by placeholders, and
+upstream stage outputs replaced by their own registry keys). When a stage with the same key is run again,
+even from a different experiment directory, its outputs are restored from the registry instead of being
+recomputed, and runs that need a prior stage's outputs (e.g., fine-tuning needs a pre-trained model) can
+find them without `model_initialization_dir` being passed by hand.
+
+Artifacts are stored under `{registry_dir}/{model}/{key}`, with a `manifest.json` describing the stage that
+produced them. Like shared caches, stored artifacts are read-only. Files are copied into the registry (as
+reflinks, which share their data until modified, on file systems that support them), so the output
+directories of experiments are never made read-only or changed by storing them. Artifacts are restored as
+hard links to their read-only files (or as copies, across file systems), so restoring a large checkpoint costs
+no space; restored files must be replaced rather than modified in place.
+
+As the registry holds a second copy of every completed stage, it is only used by default if the
+`MEDS_DEV_CACHE_DIR` environment variable sets a cache shared across experiments, in which case it is under
+`$MEDS_DEV_CACHE_DIR/artifacts` (see `default_registry_dir`).
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+from collections.abc import Generator
+from pathlib import Path
+
+from omegaconf import DictConfig, OmegaConf
+
+from .budget import USAGE_FILE
+from .cache import (
+    dataset_fingerprint,
+    dataset_size,
+    file_lock,
+    fingerprint,
+    is_built,
+    make_read_only,
+)
+from .models import ALL_DATASET_TYPES, ALL_RUN_MODES, DatasetType, RunMode
+from .utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = "MEDS_DEV_CACHE_DIR"
+REGISTRY_DIRNAME = "artifacts"
+MANIFEST = "manifest.json"
+# Records the registry artifact a stage was initialized from, when `model_initialization_dir` was not given.
+INITIALIZATION_FILE = "model_initialization.json"
+# The Linux ioctl that clones a file's data into another (a reflink), on file systems that support it.
+FICLONE = 0x40049409
+
+
+def default_registry_dir() -> str | None:
+    """Returns the default registry directory, `$MEDS_DEV_CACHE_DIR/artifacts`, or `None` if that is unset.
+
+    This is the `${meds_dev.registry_dir:}` resolver used for the default `registry_dir` of `meds-dev-model`.
+
+    Examples:
+        >>> from unittest.mock import patch
+        >>> with patch.dict(os.environ, {CACHE_DIR_ENV: "/shared/cache"}):
+        ...     print(default_registry_dir())
+        /shared/cache/artifacts
+        >>> with patch.dict(os.environ, {CACHE_DIR_ENV: ""}):
+        ...     print(default_registry_dir())
+        None
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV, None)
+    return str(Path(cache_dir) / REGISTRY_DIRNAME) if cache_dir else None
+
+
+OmegaConf.register_new_resolver("meds_dev.registry_dir", default_registry_dir, replace=True)
+
+
+def artifact_files(root: Path, exclude: tuple[Path, ...] = ()) -> Generator[Path]:
+    """Yields the paths, relative to `root`, of all files that make up a stage's output artifact.
+
+    Top-level hidden directories (e.g., the `.logs`, `.venv`, or `.cache` directories `meds-dev-model` may
+    create in the output directory) and any `exclude`d directories are not part of the artifact.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for fn in (".done", "model/weights.bin", ".venv/bin/python", "other/a.txt"):
+        ...         (root / fn).parent.mkdir(parents=True, exist_ok=True)
+        ...         (root / fn).touch()
+        ...     print([str(fp) for fp in artifact_files(root)])
+        ...     print([str(fp) for fp in artifact_files(root, exclude=(root / "other",))])
+        ['.done', 'model/weights.bin', 'other/a.txt']
+        ['.done', 'model/weights.bin']
+    """
+    root = Path(root)
+    exclude = {Path(fp).resolve() for fp in exclude}
+    for fp in sorted(root.rglob("*")):
+        rel = fp.relative_to(root)
+        if len(rel.parts) > 1 and rel.parts[0].startswith("."):
+            continue
+        if any(parent.resolve() in exclude for parent in (fp, *fp.parents)):
+            continue
+        if fp.is_file():
+            yield rel
+
+
+def files_fingerprint(root: Path) -> str:
+    """Returns a cheap fingerprint of the artifact files under `root`, from their paths, sizes, and mtimes.
+
+    Copies made by `copy_tree` keep their files' modification times, so have the same fingerprint.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     _ = (root / "a.txt").write_text("a")
+        ...     fp1 = files_fingerprint(root)
+        ...     copy_tree(root, root.parent / f"{root.name}_copy")
+        ...     fp2 = files_fingerprint(root.parent / f"{root.name}_copy")
+        ...     shutil.rmtree(root.parent / f"{root.name}_copy")
+        ...     _ = (root / "a.txt").write_text("ab")
+        ...     fp3 = files_fingerprint(root)
+        >>> fp1 == fp2, fp1 == fp3
+        (True, False)
+    """
+    root = Path(root)
+    files = []
+    for rel in artifact_files(root):
+        stat = (root / rel).stat()
+        files.append((rel.as_posix(), stat.st_size, stat.st_mtime_ns))
+    return fingerprint(files)
+
+
+def copy_file(src: Path, dst: Path):
+    """Copies the file `src` to `dst` with its modification time, but not its permissions.
+
+    The copy is a reflink where the file system supports it, so large files (e.g., checkpoints) are copied
+    without duplicating their data, and a full copy otherwise. Either way, the two files are independent.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     src, dst = Path(tmp_dir) / "src.txt", Path(tmp_dir) / "dst.txt"
+        ...     _ = src.write_text("a")
+        ...     src.chmod(0o444)
+        ...     copy_file(src, dst)
+        ...     same_mtime = src.stat().st_mtime_ns == dst.stat().st_mtime_ns
+        ...     _ = dst.write_text("b")
+        ...     print(src.read_text(), dst.read_text(), same_mtime, oct(dst.stat().st_mode & 0o200))
+        a b True 0o200
+    """
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            shutil.copyfileobj(f_src, f_dst)
+    stat = os.stat(src)
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def link_file(src: Path, dst: Path):
+    """Hard links `dst` to the file `src`, or copies it (see `copy_file`) if it can not be linked.
+
+    Files can not be hard linked across file systems (or on some file systems at all), in which case they
+    are copied.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     src, dst = Path(tmp_dir) / "src.txt", Path(tmp_dir) / "dst.txt"
+        ...     _ = src.write_text("a")
+        ...     link_file(src, dst)
+        ...     print(dst.read_text(), dst.stat().st_nlink, src.samefile(dst))
+        a 2 True
+        >>> from unittest.mock import patch
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     src, dst = Path(tmp_dir) / "src.txt", Path(tmp_dir) / "dst.txt"
+        ...     _ = src.write_text("a")
+        ...     with patch("os.link", side_effect=OSError("cross-device link")):
+        ...         link_file(src, dst)
+        ...     print(dst.read_text(), dst.stat().st_nlink, src.samefile(dst))
+        a 1 False
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+
+def copy_tree(src: Path, dst: Path, exclude: tuple[Path, ...] = (), link: bool = False):
+    """Recreates the artifact files of `src` under `dst`, replacing any existing.
+
+    Files are copied (see `copy_file`), or, if `link` is set, hard linked (see `link_file`), which is only
+    safe for read-only sources such as stored artifacts.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     src = Path(tmp_dir) / "src"
+        ...     (src / "sub").mkdir(parents=True)
+        ...     _ = (src / "sub" / "a.txt").write_text("a")
+        ...     make_read_only(src)
+        ...     dst = Path(tmp_dir) / "dst"
+        ...     copy_tree(src, dst)
+        ...     fp = dst / "sub" / "a.txt"
+        ...     print(fp.read_text(), fp.stat().st_nlink, oct(fp.stat().st_mode & 0o200))
+        ...     copy_tree(src, dst, link=True)
+        ...     print(fp.read_text(), fp.stat().st_nlink, oct(fp.stat().st_mode & 0o200))
+        a 1 0o200
+        a 2 0o0
+    """
+    src, dst = Path(src), Path(dst)
+    for rel in artifact_files(src, exclude):
+        target = dst / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.unlink(missing_ok=True)
+        (link_file if link else copy_file)(src / rel, target)
+
+
+def stage_kind(cfg: DictConfig, out_dir: Path) -> tuple[str, str]:
+    """Returns the dataset type and run mode of the model stage writing to `out_dir`.
+
+    Examples:
+        >>> stage_kind(DictConfig({"mode": "predict", "dataset_type": "supervised"}), Path("out"))
+        ('supervised', 'predict')
+        >>> cfg = DictConfig({"mode": "full", "dataset_type": "full"})
+        >>> stage_kind(cfg, Path("out/D/unsupervised/train"))
+        ('unsupervised', 'train')
+        >>> stage_kind(cfg, Path("out/D/a/t1/predict"))
+        ('supervised', 'predict')
+    """
+    if cfg.mode != RunMode.FULL and cfg.dataset_type != DatasetType.FULL:
+        return str(cfg.dataset_type), str(cfg.mode)
+    out_dir = Path(out_dir)
+    dataset_type = (
+        DatasetType.UNSUPERVISED if out_dir.parent.name == "unsupervised" else DatasetType.SUPERVISED
+    )
+    return str(dataset_type), out_dir.name
+
+
+def first_stage(cfg: DictConfig, commands: dict[str, dict[str, str]]) -> tuple[str, str] | None:
+    """Returns the dataset type and run mode of the first stage the model run will execute, if any.
+
+    Examples:
+        >>> commands = {"unsupervised": {"train": "PT"}, "supervised": {"train": "FT", "predict": "P"}}
+        >>> first_stage(DictConfig({"mode": "full", "dataset_type": "full"}), commands)
+        ('unsupervised', 'train')
+        >>> first_stage(DictConfig({"mode": "predict", "dataset_type": "full"}), commands)
+        ('supervised', 'predict')
+        >>> print(first_stage(DictConfig({"mode": "predict", "dataset_type": "unsupervised"}), commands))
+        None
+        >>> full_cfg = DictConfig({"mode": "full", "dataset_type": "full"})
+        >>> first_stage(full_cfg, {**commands, "unsupervised": None})
+        ('supervised', 'train')
+    """
+    run_modes = ALL_RUN_MODES if cfg.mode == RunMode.FULL else [cfg.mode]
+    dataset_types = ALL_DATASET_TYPES if cfg.dataset_type == DatasetType.FULL else [cfg.dataset_type]
+    for run_mode in run_modes:
+        for dataset_type in dataset_types:
+            if (commands.get(dataset_type, None) or {}).get(run_mode, None):
+                return str(dataset_type), str(run_mode)
+    return None
+
+
+def prior_stage(dataset_type: str, run_mode: str) -> tuple[str, str] | None:
+    """Returns the stage whose output initializes the given stage in the global flow, if there is one.
+
+    Examples:
+        >>> prior_stage("supervised", "predict")
+        ('supervised', 'train')
+        >>> prior_stage("supervised", "serve")
+        ('supervised', 'train')
+        >>> prior_stage("supervised", "train")
+        ('unsupervised', 'train')
+        >>> print(prior_stage("unsupervised", "train"))
+        None
+    """
+    if run_mode in (RunMode.PREDICT, RunMode.SERVE):
+        return str(dataset_type), str(RunMode.TRAIN)
+    if dataset_type == DatasetType.SUPERVISED:
+        return str(DatasetType.UNSUPERVISED), str(RunMode.TRAIN)
+    return None
+
+
+class ArtifactRegistry:
+    """The registry of one model's stage outputs over one dataset, for a single `meds-dev-model` run.
+
+    Args:
+        registry_dir: The root directory of the registry.
+        cfg: The configuration for the model run.
+        model_dir: The directory of the model's configuration files in MEDS-DEV.
+        requirements: The path to the model's requirements file, or `None`.
+
+    Examples:
+        >>> import tempfile
+        >>> def make_registry(root: Path, exp: str, task: str | None = None) -> ArtifactRegistry:
+        ...     cfg = DictConfig({
+        ...         "model": "M", "mode": "full", "dataset_type": "unsupervised", "task_name": task,
+        ...         "dataset_dir": str(root / "data"), "output_dir": str(root / exp),
+        ...     })
+        ...     return ArtifactRegistry(root / "registry", cfg, root / "model_dir", None)
+        >>> def run(root: Path, exp: str, cmd: str, task: str | None = None) -> str:
+        ...     registry = make_registry(root, exp, task)
+        ...     out_dir = root / exp / "D" / "unsupervised" / "train"
+        ...     key = registry.stage_key(cmd.format(output_dir=out_dir, dataset_dir=root / "data"), out_dir)
+        ...     if not registry.restore(key, out_dir):
+        ...         out_dir.mkdir(parents=True)
+        ...         _ = (out_dir / "model.bin").write_text(f"trained in {exp}")
+        ...         (out_dir / ".done").touch()
+        ...         registry.store(key, out_dir)
+        ...     return (out_dir / "model.bin").read_text()
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     (root / "data" / "data").mkdir(parents=True)
+        ...     (root / "data" / "data" / "0.parquet").touch()
+        ...     print(run(root, "exp1", "PT {dataset_dir} {output_dir}"))
+        ...     print(run(root, "exp2", "PT {dataset_dir} {output_dir}", task="t2"))
+        ...     print(run(root, "exp3", "PT --lr=0.1 {dataset_dir} {output_dir}"))
+        ...     registry = make_registry(root, "exp4")
+        ...     print((registry.resolve("supervised", "train") / "model.bin").read_text())
+        ...     print(registry.resolve("supervised", "predict"))
+        ...     for exp in ("exp1", "exp2"):
+        ...         out_fp = root / exp / "D" / "unsupervised" / "train" / "model.bin"
+        ...         print(exp, oct(out_fp.stat().st_mode & 0o200), out_fp.stat().st_nlink)
+        trained in exp1
+        trained in exp1
+        trained in exp3
+        trained in exp3
+        None
+        exp1 0o200 1
+        exp2 0o0 2
+
+    Unsupervised stages are shared across tasks (as in `exp2`, above). Storing a stage's outputs leaves them
+    writable and unlinked from the registry, while restored outputs are read-only links to it.
+    """
+
+    def __init__(self, registry_dir: Path, cfg: DictConfig, model_dir: Path, requirements: Path | None):
+        self.root = Path(registry_dir) / cfg.model
+        self.cfg = cfg
+        self.model_dir = Path(model_dir)
+        self.requirements_hash = file_hash(requirements) if requirements else None
+        self.dataset_fingerprint = dataset_fingerprint(cfg.dataset_dir)
+        # Maps the output directories of stages run (or restored) in this run to their keys, so downstream
+        # stages are keyed by their upstream artifacts rather than by where those happen to be stored.
+        self.produced: dict[str, str] = {}
+        # Maps the output directories of stages initialized from a registry artifact to that artifact's key.
+        self.initialized: dict[str, str] = {}
+        self.exclude = tuple(
+            Path(cfg[k]) for k in ("venv_dir", "cache_dir", "registry_dir", "temp_dir") if cfg.get(k, None)
+        )
+
+    def artifact_dir(self, key: str) -> Path:
+        return self.root / key
+
+    def stage_task(self, out_dir: Path, task_name: str | None = None) -> str | None:
+        """Returns the task of the stage writing to `out_dir`, or `None` for unsupervised stages.
+
+        Examples:
+            >>> cfg = DictConfig({
+            ...     "model": "M", "mode": "full", "dataset_type": "full", "task_name": "t1",
+            ...     "dataset_dir": "data", "output_dir": "out",
+            ... })
+            >>> registry = ArtifactRegistry("registry", cfg, "model_dir", None)
+            >>> print(registry.stage_task(Path("out/D/unsupervised/train")))
+            None
+            >>> registry.stage_task(Path("out/D/t1/train")), registry.stage_task(Path("out/D/t2/train"), "t2")
+            ('t1', 't2')
+        """
+        if stage_kind(self.cfg, out_dir)[0] != DatasetType.SUPERVISED:
+            return None
+        return task_name if task_name is not None else self.cfg.get("task_name", None)
+
+    def stage_key(self, cmd: str, out_dir: Path, task_name: str | None = None) -> str:
+        """Returns the registry key of the stage running the (formatted) command `cmd` into `out_dir`.
+
+        Must be called in stage order, so that the keys of upstream stages are known. Unsupervised stages are
+        keyed without the task, so that they are shared across the tasks over a dataset.
+        """
+        replacements = {
+            str(out_dir): "{output_dir}",
+            str(self.cfg.dataset_dir): "{dataset_dir}",
+            str(self.model_dir): "{model_dir}",
+            sys.executable: "{meds_dev_python}",
+        }
+        if self.cfg.get("cache_dir", None):
+            replacements[str(self.cfg.cache_dir)] = "{cache_dir}"
+
+        inputs = {}
+        if labels_dir := self.cfg.get("labels_dir", None):
+            replacements[str(labels_dir)] = "{labels_dir}"
+            if str(labels_dir) in cmd and Path(labels_dir).is_dir():
+                inputs["labels"] = files_fingerprint(labels_dir)
+
+        init_dir = self.cfg.get("model_initialization_dir", None)
+        if init_dir and str(init_dir) not in self.produced and str(init_dir) in cmd:
+            init_dir = Path(init_dir)
+            if init_dir.parent == self.root:
+                inputs["model_initialization"] = f"artifact:{init_dir.name}"
+                self.initialized[str(out_dir)] = init_dir.name
+            else:
+                inputs["model_initialization"] = files_fingerprint(init_dir)
+            replacements[str(init_dir)] = "{model_initialization_dir}"
+
+        for produced_dir, key in list(self.produced.items()):
+            if produced_dir != str(out_dir):
+                replacements[produced_dir] = f"{{artifact:{key}}}"
+
+        # Longest paths first, so that nested paths are replaced before their parents.
+        paths = sorted(replacements, key=len, reverse=True)
+        pattern = re.compile(r"(?<![\w./-])(" + "|".join(map(re.escape, paths)) + r")(?![\w.-])")
+        normalized_cmd = pattern.sub(lambda m: replacements[m.group(1)], cmd)
+
+        key = fingerprint(
+            self.cfg.model,
+            self.requirements_hash,
+            self.dataset_fingerprint,
+            self.stage_task(out_dir, task_name),
+            normalized_cmd,
+            inputs,
+        )
+        self.produced[str(out_dir)] = key
+        return key
+
+    def restore(self, key: str, out_dir: Path) -> bool:
+        """Links a stored artifact into `out_dir`, unless it is already complete; returns if it was.
+
+        The restored files are read-only hard links to the artifact's files (or copies, across file systems).
+        """
+        out_dir = Path(out_dir)
+        if (out_dir / ".done").is_file():
+            return True
+        artifact_dir = self.artifact_dir(key)
+        if not is_built(artifact_dir):
+            return False
+        logger.info(f"Restoring {out_dir} from registry artifact {artifact_dir}.")
+        copy_tree(artifact_dir, out_dir, link=True)
+        (out_dir / MANIFEST).unlink(missing_ok=True)
+        return True
+
+    def store(self, key: str, out_dir: Path, task_name: str | None = None):
+        """Stores the completed output directory `out_dir` in the registry under `key`, if not yet stored."""
+        out_dir = Path(out_dir)
+        artifact_dir = self.artifact_dir(key)
+        if is_built(artifact_dir) or not (out_dir / ".done").is_file():
+            return
+
+        with file_lock(artifact_dir.with_name(f"{key}.lock")):
+            if is_built(artifact_dir):
+                return
+
+            tmp_dir = artifact_dir.with_name(f"{key}.tmp")
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            copy_tree(out_dir, tmp_dir, exclude=self.exclude)
+
+            dataset_type, run_mode = stage_kind(self.cfg, out_dir)
+            manifest = {
+                "model": self.cfg.model,
+                "requirements_hash": self.requirements_hash,
+                "dataset_fingerprint": self.dataset_fingerprint,
+                "dataset_bytes": dataset_size(self.cfg.dataset_dir),
+                "task_name": self.stage_task(out_dir, task_name),
+                "dataset_type": dataset_type,
+                "run_mode": run_mode,
+                "model_initialization": self.initialized.get(str(out_dir), None),
+                "source_dir": str(out_dir.resolve()),
+                "created": time.time(),
+            }
+            (tmp_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+            make_read_only(tmp_dir)
+            os.rename(tmp_dir, artifact_dir)
+            logger.info(f"Stored {out_dir} in the registry as {artifact_dir}.")
+
+    def record_initialization(self, out_dir: Path):
+        """Records the registry artifact the stage writing to `out_dir` is initialized from, if any, in it.
+
+        Completed stages are left as they are.
+        """
+        out_dir = Path(out_dir)
+        if (key := self.initialized.get(str(out_dir), None)) is None or (out_dir / ".done").is_file():
+            return
+        out_dir.mkdir(parents=True, exist_ok=True)
+        record = {"artifact": key, "model_initialization_dir": str(self.artifact_dir(key))}
+        (out_dir / INITIALIZATION_FILE).write_text(json.dumps(record, indent=2))
+
+    def candidates(self, dataset_type: str, run_mode: str) -> list[Path]:
+        """Returns the artifacts that can initialize the given stage of this model and dataset, newest first.
+
+        For supervised stages, only artifacts of the same task (`cfg.task_name`) are considered.
+        """
+        prior = prior_stage(dataset_type, run_mode)
+        if prior is None or not self.root.is_dir():
+            return []
+
+        task_name = self.cfg.get("task_name", None) if prior[0] == DatasetType.SUPERVISED else None
+        candidates = []
+        for manifest_fp in self.root.glob(f"*/{MANIFEST}"):
+            manifest = json.loads(manifest_fp.read_text())
+            if (
+                is_built(manifest_fp.parent)
+                and manifest["requirements_hash"] == self.requirements_hash
+                and manifest["dataset_fingerprint"] == self.dataset_fingerprint
+                and (manifest["dataset_type"], manifest["run_mode"]) == prior
+                and (prior[0] != DatasetType.SUPERVISED or manifest["task_name"] == task_name)
+            ):
+                candidates.append((manifest["created"], manifest_fp.parent))
+        return [artifact_dir for _, artifact_dir in sorted(candidates, reverse=True)]
+
+    def resolve(self, dataset_type: str, run_mode: str) -> Path | None:
+        """Returns the most recent artifact that can initialize the given stage, if any (see `candidates`)."""
+        candidates = self.candidates(dataset_type, run_mode)
+        return candidates[0] if candidates else None
+
+    def usage_history(self, dataset_type: str, run_mode: str) -> list[tuple[dict, int]]:
+        """Returns the recorded compute of every completed, stored stage of this model of the given kind.
+
+        Stages run over any dataset (and, for supervised stages, any task) are included, each as the
+        `.usage.json` record of the run that produced it and the size in bytes of the dataset it was run over,
+        so that they can be scaled to the size of another dataset (see `MEDS_DEV.plan.estimate_seconds`).
+        """
+        if not self.root.is_dir():
+            return []
+
+        history = []
+        for manifest_fp in sorted(self.root.glob(f"*/{MANIFEST}")):
+            usage_fp = manifest_fp.parent / USAGE_FILE
+            if not (is_built(manifest_fp.parent) and usage_fp.is_file()):
+                continue
+            manifest = json.loads(manifest_fp.read_text())
+            if (manifest["dataset_type"], manifest["run_mode"]) != (dataset_type, run_mode):
+                continue
+            usage = json.loads(usage_fp.read_text())
+            if usage.get("status", None) == "completed" and manifest.get("dataset_bytes", None):
+                history.append((usage, manifest["dataset_bytes"]))
+        return history
+
+
+def model_registry(
+    cfg: DictConfig, commands: dict[str, dict[str, str]], model_dir: Path, requirements: Path | None
+) -> ArtifactRegistry | None:
+    """Returns the artifact registry of a model run, or `None` if `cfg.registry_dir` is not set.
+
+    If `cfg.model_initialization_dir` is not set, it is set to the most recent registered output of the stage
+    preceding the first stage of the run, if there is one (see `ArtifactRegistry.resolve`). As this is a
+    guess, it is logged as a warning, and recorded in the output directory of each stage it initializes (see
+    `ArtifactRegistry.record_initialization`).
+    """
+    if not cfg.get("registry_dir", None):
+        return None
+
+    registry = ArtifactRegistry(cfg.registry_dir, cfg, model_dir, requirements)
+    stage = first_stage(cfg, commands)
+    if stage is not None and not cfg.get("model_initialization_dir", None):
+        if candidates := registry.candidates(*stage):
+            init_dir = candidates[0]
+            logger.warning(
+                f"model_initialization_dir is not set; using registry artifact {init_dir.name}, the most "
+                f"recent of {len(candidates)} matching ones. Set model_initialization_dir to use another."
+            )
+            cfg.model_initialization_dir = str(init_dir)
+    return registry
@@ -0,0 +1,254 @@
+"""Detection of the compute resources available to model commands, including container (cgroup) limits.
+
+Inside containers, the CPUs and memory a process may actually use are frequently limited by its cgroup (e.g.,
+a CPU quota of 2 CPUs on a 64-core host), which neither `os.cpu_count` nor CPU affinity reflect. The helpers
+here take both cgroup v1 and v2 limits into account, and split the resulting budget across the tasks a model
+run may execute concurrently, so that model commands neither oversubscribe small containers nor leave large
+hosts idle.
+"""
+
+import logging
+import math
+import os
+from pathlib import Path
+
+from omegaconf import DictConfig
+
+from .utils import available_cpu_count
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+RESOURCE_KEYS = ("num_threads", "num_workers", "memory_limit")
+
+# cgroup v1 reports "no limit" as a very large number (the max page-aligned int64) rather than as "max".
+_UNLIMITED_BYTES = 2**60
+
+
+def _own_cgroups(proc_cgroup_fp: Path = Path("/proc/self/cgroup")) -> dict[str, str]:
+    """Returns the cgroup path of this process for each cgroup v1 controller and for cgroup v2 (key `""`).
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     fp = Path(tmp_dir) / "cgroup"
+        ...     _ = fp.write_text("4:memory:/job/123\\n2:cpu,cpuacct:/job/123\\n0::/\\n")
+        ...     print(_own_cgroups(fp))
+        {'memory': 'job/123', 'cpu': 'job/123', 'cpuacct': 'job/123', '': ''}
+    """
+    cgroups = {}
+    for line in (_read(proc_cgroup_fp) or "").splitlines():
+        _, controllers, path = line.split(":", 2)
+        for controller in controllers.split(","):
+            cgroups[controller] = path.lstrip("/")
+    return cgroups
+
+
+def _read(fp: Path) -> str | None:
+    try:
+        return fp.read_text().strip()
+    except OSError:
+        return None
+
+
+def _read_cgroup(cgroup_root: Path, controller: str, name: str) -> str | None:
+    """Reads a cgroup file from this process's own cgroup, falling back to the root (e.g., in containers).
+
+    `controller` is the cgroup v1 controller directory, or `""` for cgroup v2.
+    """
+    base = cgroup_root / controller
+    own_path = _own_cgroups().get(controller, "")
+    for fp in (base / own_path / name, base / name):
+        if (content := _read(fp)) is not None:
+            return content
+    return None
+
+
+def cgroup_cpu_limit(cgroup_root: Path = CGROUP_ROOT) -> float | None:
+    """Returns the number of CPUs this process's cgroup may use, or `None` if it is not limited.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     print(cgroup_cpu_limit(root))
+        ...     _ = (root / "cpu.max").write_text("max 100000\\n")
+        ...     print(cgroup_cpu_limit(root))
+        ...     _ = (root / "cpu.max").write_text("250000 100000\\n")
+        ...     print(cgroup_cpu_limit(root))
+        None
+        None
+        2.5
+
+    cgroup v1 quotas are also supported:
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     cpu_dir = Path(tmp_dir) / "cpu"
+        ...     cpu_dir.mkdir()
+        ...     _ = (cpu_dir / "cpu.cfs_quota_us").write_text("200000")
+        ...     _ = (cpu_dir / "cpu.cfs_period_us").write_text("100000")
+        ...     print(cgroup_cpu_limit(Path(tmp_dir)))
+        ...     _ = (cpu_dir / "cpu.cfs_quota_us").write_text("-1")
+        ...     print(cgroup_cpu_limit(Path(tmp_dir)))
+        2.0
+        None
+    """
+    cgroup_root = Path(cgroup_root)
+
+    if (cpu_max := _read_cgroup(cgroup_root, "", "cpu.max")) is not None:
+        quota, period = cpu_max.split()
+        return None if quota == "max" else int(quota) / int(period)
+
+    quota = _read_cgroup(cgroup_root, "cpu", "cpu.cfs_quota_us")
+    period = _read_cgroup(cgroup_root, "cpu", "cpu.cfs_period_us")
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_memory_limit(cgroup_root: Path = CGROUP_ROOT) -> int | None:
+    """Returns the memory limit, in bytes, of this process's cgroup, or `None` if it is not limited.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     print(cgroup_memory_limit(root))
+        ...     _ = (root / "memory.max").write_text("max\\n")
+        ...     print(cgroup_memory_limit(root))
+        ...     _ = (root / "memory.max").write_text("4294967296\\n")
+        ...     print(cgroup_memory_limit(root))
+        None
+        None
+        4294967296
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     memory_dir = Path(tmp_dir) / "memory"
+        ...     memory_dir.mkdir()
+        ...     _ = (memory_dir / "memory.limit_in_bytes").write_text("9223372036854771712")
+        ...     print(cgroup_memory_limit(Path(tmp_dir)))
+        ...     _ = (memory_dir / "memory.limit_in_bytes").write_text("1073741824")
+        ...     print(cgroup_memory_limit(Path(tmp_dir)))
+        None
+        1073741824
+    """
+    cgroup_root = Path(cgroup_root)
+
+    limit = _read_cgroup(cgroup_root, "", "memory.max")
+    if limit is None:
+        limit = _read_cgroup(cgroup_root, "memory", "memory.limit_in_bytes")
+    if limit is None or limit == "max" or int(limit) >= _UNLIMITED_BYTES:
+        return None
+    return int(limit)
+
+
+def physical_memory() -> int | None:
+    """Returns the total physical memory of the host, in bytes, if it can be determined."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        return None
+
+
+def available_cpus(cgroup_root: Path = CGROUP_ROOT) -> int:
+    """Returns the number of CPUs this process can use, accounting for CPU affinity and cgroup quotas.
+
+    Fractional quotas are rounded up, as a process can still make use of a partial CPU.
+
+    Examples:
+        >>> import tempfile
+        >>> available_cpus() >= 1
+        True
+        >>> from unittest.mock import patch
+        >>> many_cpus = patch(f"{__name__}.available_cpu_count", lambda: 9)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir, many_cpus:
+        ...     _ = (Path(tmp_dir) / "cpu.max").write_text("150000 100000")
+        ...     print(available_cpus(Path(tmp_dir)))
+        2
+    """
+    cpus = available_cpu_count()
+    if (quota := cgroup_cpu_limit(cgroup_root)) is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def available_memory(cgroup_root: Path = CGROUP_ROOT) -> int | None:
+    """Returns the memory, in bytes, this process can use, or `None` if it can not be determined.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     _ = (Path(tmp_dir) / "memory.max").write_text("1048576")
+        ...     print(available_memory(Path(tmp_dir)))
+        1048576
+    """
+    limits = [m for m in (cgroup_memory_limit(cgroup_root), physical_memory()) if m is not None]
+    return min(limits) if limits else None
+
+
+def model_resources(
+    cfg: DictConfig, overrides: dict | None = None, cgroup_root: Path = CGROUP_ROOT
+) -> dict[str, int | None]:
+    """Returns the resources each model command should use, as available to model commands' templates.
+
+    The resources are:
+      - `num_workers`: The number of parallel worker processes the command should use.
+      - `num_threads`: The number of threads the command should use (e.g., for PyTorch or data loading).
+      - `memory_limit`: The memory, in MiB, the command should limit itself to, or `None` if unknown.
+
+    By default, each is the CPUs (or memory) available to this process, after accounting for cgroup limits,
+    split evenly across the `cfg.num_task_workers` tasks that may be running concurrently. A model may
+    override these defaults for all of its commands through the `resources` key of its `model.yaml` (passed
+    here as `overrides`), and values set explicitly in the run configuration take precedence over both.
+
+    Args:
+        cfg: The configuration for the model run.
+        overrides: The model's resource overrides, or `None`.
+        cgroup_root: The root of the cgroup file system, which is configurable for testing.
+
+    Returns:
+        A dictionary with the `num_workers`, `num_threads`, and `memory_limit` for each model command.
+
+    Raises:
+        ValueError: If the overrides contain unknown resources.
+
+    Examples:
+        >>> import tempfile
+        >>> from unittest.mock import patch
+        >>> many_cpus = patch(f"{__name__}.available_cpu_count", lambda: 9)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir, many_cpus:
+        ...     root = Path(tmp_dir)
+        ...     _ = (root / "cpu.max").write_text("200000 100000")
+        ...     _ = (root / "memory.max").write_text(str(1024**3))
+        ...     print(model_resources(DictConfig({}), cgroup_root=root))
+        ...     print(model_resources(DictConfig({"num_task_workers": 2}), cgroup_root=root))
+        ...     cfg = DictConfig({"num_task_workers": 4})
+        ...     print(model_resources(cfg, {"num_threads": 8}, cgroup_root=root))
+        ...     print(model_resources(DictConfig({"num_threads": 3}), {"num_threads": 8}, cgroup_root=root))
+        {'num_threads': 2, 'num_workers': 2, 'memory_limit': 1024}
+        {'num_threads': 1, 'num_workers': 1, 'memory_limit': 512}
+        {'num_threads': 8, 'num_workers': 1, 'memory_limit': 256}
+        {'num_threads': 3, 'num_workers': 2, 'memory_limit': 1024}
+        >>> model_resources(DictConfig({}), {"num_gpus": 1})
+        Traceback (most recent call last):
+            ...
+        ValueError: Unknown model resources: ['num_gpus']. Options are ('num_threads', ...)
+    """
+    overrides = overrides or {}
+    if unknown := sorted(set(overrides) - set(RESOURCE_KEYS)):
+        raise ValueError(f"Unknown model resources: {unknown}. Options are {RESOURCE_KEYS}")
+
+    n_tasks = max(1, cfg.get("num_task_workers", 1) or 1)
+    cpus = max(1, available_cpus(cgroup_root) // n_tasks)
+    memory = available_memory(cgroup_root)
+
+    resources = {
+        "num_threads": cpus,
+        "num_workers": cpus,
+        "memory_limit": None if memory is None else memory // n_tasks // 1024**2,
+    }
+    for key in RESOURCE_KEYS:
+        if cfg.get(key, None) is not None:
+            resources[key] = int(cfg[key])
+        elif overrides.get(key, None) is not None:
+            resources[key] = int(overrides[key])
+    return resources
@@ -0,0 +1,7 @@
+from importlib.resources import files
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).parent
+CFG_YAML = files("MEDS_DEV.configs") / "_results.yaml"
+
+__all__ = ["RESULTS_DIR", "CFG_YAML"]
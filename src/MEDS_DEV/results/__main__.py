@@ -0,0 +1,107 @@
+import logging
+from pathlib import Path
+
+import hydra
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from .. import __version__
+from ..plan import CACHED, STALE, TO_RUN, Plan, PlanNode
+from . import CFG_YAML, RESULTS_DIR
+from .warehouse import (
+    ID_COLS,
+    INDEX_FN,
+    discover_sources,
+    leaderboard,
+    load_index,
+    update_warehouse,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _sources_kwargs(cfg: DictConfig) -> dict:
+    results_dirs = cfg.results_dirs if cfg.results_dirs is not None else [RESULTS_DIR]
+    return {
+        "results_dirs": [Path(d) for d in results_dirs],
+        "evaluation_dirs": [Path(d) for d in cfg.evaluation_dirs],
+        "evaluation_pattern": cfg.evaluation_pattern,
+        "meds_dev_version": cfg.meds_dev_version or __version__,
+    }
+
+
+def plan(cfg: DictConfig) -> Plan:
+    """Returns the plan of a warehouse update: how many sources `run` would (re-)compile or drop.
+
+    Sources are counted as changed if their size or modification time differ from the index, as for the
+    first check of `update_warehouse`; some of these may turn out to have unchanged contents.
+    """
+    warehouse_dir = Path(cfg.warehouse_dir)
+    result = Plan(f"meds-dev-results {warehouse_dir}")
+    if not cfg.do_update:
+        return result
+
+    sources = discover_sources(**_sources_kwargs(cfg))
+    indexed = {row["source"]: row for row in load_index(warehouse_dir).iter_rows(named=True)}
+
+    n_changed = 0
+    for source, (fp, _, identity) in sources.items():
+        old = indexed.get(source, None)
+        stat = fp.stat()
+        if (
+            old is None
+            or (old["size"], old["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns)
+            or (identity is not None and identity != {col: old[col] for col in ID_COLS})
+        ):
+            n_changed += 1
+    n_removed = len(set(indexed) - set(sources))
+
+    if not (warehouse_dir / INDEX_FN).is_file():
+        status, reason = TO_RUN, f"{len(sources)} sources to compile into a new warehouse"
+    elif n_changed or n_removed:
+        status, reason = STALE, f"{n_changed} of {len(sources)} sources new or changed, {n_removed} removed"
+    else:
+        status, reason = CACHED, f"all {len(sources)} sources up to date"
+    result.nodes.append(PlanNode("update", None, warehouse_dir, status, reason))
+    return result
+
+
+def run(cfg: DictConfig) -> pl.DataFrame | Plan:
+    """Updates the results warehouse and queries its leaderboard, as configured by `_results.yaml`.
+
+    Returns:
+        The leaderboard, which is also written to `output_fp` if set, or the plan of the warehouse update (see
+        `plan`), rather than running it, if `cfg.plan` is set.
+    """
+    if cfg.get("plan", False):
+        return plan(cfg)
+
+    warehouse_dir = Path(cfg.warehouse_dir)
+
+    if cfg.do_update:
+        update_warehouse(warehouse_dir, **_sources_kwargs(cfg))
+
+    board = leaderboard(warehouse_dir, **OmegaConf.to_container(cfg.leaderboard, resolve=True))
+    if cfg.output_fp is None:
+        return board
+
+    output_fp = Path(cfg.output_fp)
+    output_fp.parent.mkdir(parents=True, exist_ok=True)
+    if output_fp.suffix == ".csv":
+        board.write_csv(output_fp)
+    elif output_fp.suffix == ".parquet":
+        board.write_parquet(output_fp)
+    else:
+        raise ValueError(f"Unsupported leaderboard output format {output_fp.suffix}; use .csv or .parquet.")
+    logger.info(f"Wrote the leaderboard of {len(board)} results to {output_fp}.")
+    return board
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    result = run(cfg)
+    if cfg.get("plan", False):
+        print(result)
+    elif cfg.output_fp is None:
+        with pl.Config(tbl_rows=-1, tbl_width_chars=200, fmt_str_lengths=80):
+            print(result)
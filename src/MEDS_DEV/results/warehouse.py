@@ -0,0 +1,520 @@
+"""A columnar warehouse of MEDS-DEV results, compiled from results files and evaluation outputs.
+
+Submitted results are individual YAML files, at `${meds_dev_version}/${task}/${dataset}/${model}.yaml`, and
+evaluation outputs are individual `results.json` files, so answering questions across them (e.g., "what is
+the best model per task on MIMIC-IV?") would otherwise mean walking and parsing all of them. Instead, they
+are compiled into one long table, with one row per (version, task, dataset, model, metric), stored as one
+parquet file per (version, dataset) partition under `data/`, sorted by task, model, and metric.
+
+The warehouse is updated incrementally: `index.parquet` records the size, modification time, and content hash
+of each compiled source file and the identity of its results, so only new or changed files are re-parsed, and
+only the partitions holding their (old or new) results are rewritten. Queries read only the partitions they
+filter on, so leaderboards are returned without parsing any results files.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+from collections.abc import Iterable
+from pathlib import Path
+from urllib.parse import quote
+
+import polars as pl
+import yaml
+
+from ..cache import file_lock
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+INDEX_FN = "index.parquet"
+PARTITION_COLS = ["meds_dev_version", "dataset"]
+ID_COLS = ["meds_dev_version", "task", "dataset", "model"]
+SCHEMA = {
+    "meds_dev_version": pl.String,
+    "task": pl.String,
+    "dataset": pl.String,
+    "model": pl.String,
+    "metric": pl.String,
+    "value": pl.Float64,
+    "source": pl.String,
+}
+INDEX_SCHEMA = {
+    "source": pl.String,
+    "size": pl.Int64,
+    "mtime_ns": pl.Int64,
+    "sha256": pl.String,
+    **{col: pl.String for col in ID_COLS},
+}
+DEFAULT_METRIC = "samples_equally_weighted/roc_auc_score"
+LOWER_IS_BETTER = {"brier_score_loss", "calibration_error"}
+EVALUATION_PATTERN = "{dataset}/{task}/{model}"
+
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def flatten_metrics(metrics: dict, prefix: str = "") -> dict[str, float]:
+    """Flattens nested metrics into `/`-joined names, keeping only numeric values.
+
+    Examples:
+        >>> flatten_metrics({
+        ...     "auc": 0.8,
+        ...     "samples_equally_weighted": {"roc_auc_score": 0.7, "calibration_curve": {"x": [0.1]}},
+        ...     "n": 10,
+        ...     "flag": True,
+        ...     "notes": "n/a",
+        ... })
+        {'auc': 0.8, 'samples_equally_weighted/roc_auc_score': 0.7, 'n': 10.0}
+    """
+    out = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten_metrics(value, prefix=f"{name}/"))
+        elif isinstance(value, int | float) and not isinstance(value, bool):
+            out[name] = float(value)
+    return out
+
+
+def result_file_identity(fp: Path, results_dir: Path, result: dict) -> dict[str, str]:
+    """Returns the (version, task, dataset, model) of a results file.
+
+    The identity is read from the file's `meds_dev_version`, `task_name`, `dataset`, and `model` fields, with
+    any missing fields taken from the file's path, `${meds_dev_version}/${task}/${dataset}/${model}.yaml`.
+
+    Examples:
+        >>> root = Path("results")
+        >>> result_file_identity(root / "v1/mortality/in_icu/MIMIC-IV/meds_tab.yaml", root, {})
+        {'meds_dev_version': 'v1', 'task': 'mortality/in_icu', 'dataset': 'MIMIC-IV', 'model': 'meds_tab'}
+        >>> result_file_identity(root / "v1/t/D/m.yaml", root, {"meds_dev_version": "v1.0.0", "model": "m2"})
+        {'meds_dev_version': 'v1.0.0', 'task': 't', 'dataset': 'D', 'model': 'm2'}
+        >>> result_file_identity(root / "m.yaml", root, {"model": "m"})
+        Traceback (most recent call last):
+            ...
+        ValueError: Results file results/m.yaml is missing meds_dev_version, task_name, dataset...
+    """
+    parts = Path(fp).relative_to(results_dir).with_suffix("").parts
+    from_path = {}
+    if len(parts) >= 4:
+        from_path = {
+            "meds_dev_version": parts[0],
+            "task": "/".join(parts[1:-2]),
+            "dataset": parts[-2],
+            "model": parts[-1],
+        }
+
+    fields = {
+        "meds_dev_version": "meds_dev_version",
+        "task": "task_name",
+        "dataset": "dataset",
+        "model": "model",
+    }
+    identity = {col: result.get(field, None) or from_path.get(col, None) for col, field in fields.items()}
+    missing = [fields[col] for col, value in identity.items() if not value]
+    if missing:
+        raise ValueError(
+            f"Results file {fp} is missing {', '.join(missing)}, and they can't be inferred from its path. "
+            "Results files should be stored at ${meds_dev_version}/${task}/${dataset}/${model}.yaml."
+        )
+    return {col: str(value) for col, value in identity.items()}
+
+
+def evaluation_identity(
+    rel_dir: Path, pattern: str = EVALUATION_PATTERN, **defaults
+) -> dict[str, str] | None:
+    """Returns the identity of an evaluation output directory, parsed from its path by `pattern`.
+
+    The pattern is a path with `{task}`, `{dataset}`, `{model}`, and optionally `{meds_dev_version}` fields;
+    tasks may span multiple path components, and any other field matches a single component. Fields not in
+    the pattern are taken from `defaults`. Returns `None` if the path does not match.
+
+    Raises:
+        ValueError: If the pattern and `defaults` do not provide every identity field.
+
+    Examples:
+        >>> evaluation_identity(Path("MIMIC-IV/mortality/in_icu/meds_tab"), meds_dev_version="v1")
+        {'meds_dev_version': 'v1', 'dataset': 'MIMIC-IV', 'task': 'mortality/in_icu', 'model': 'meds_tab'}
+        >>> print(evaluation_identity(Path("MIMIC-IV/meds_tab"), meds_dev_version="v1"))
+        None
+        >>> evaluation_identity(Path("v2/m/D/t/x/seed_0"), "{meds_dev_version}/{model}/{dataset}/{task}/*")
+        {'meds_dev_version': 'v2', 'model': 'm', 'dataset': 'D', 'task': 't/x'}
+        >>> evaluation_identity(Path("t/x"), "{task}", meds_dev_version="v1")
+        Traceback (most recent call last):
+            ...
+        ValueError: Evaluation pattern {task} is missing the dataset, model fields.
+    """
+    fields = set(re.findall(r"\{(\w+)\}", pattern)) | {k for k, v in defaults.items() if v is not None}
+    missing = [col for col in ID_COLS if col not in fields]
+    if missing:
+        raise ValueError(f"Evaluation pattern {pattern} is missing the {', '.join(missing)} fields.")
+
+    regex = ""
+    for piece in re.split(r"(\{\w+\}|\*)", pattern):
+        if piece == "{task}":
+            regex += "(?P<task>.+?)"
+        elif piece == "*":
+            regex += "[^/]+"
+        elif re.fullmatch(r"\{\w+\}", piece):
+            regex += f"(?P<{piece[1:-1]}>[^/]+)"
+        else:
+            regex += re.escape(piece)
+
+    match = re.fullmatch(regex, Path(rel_dir).as_posix())
+    if match is None:
+        return None
+    return {**defaults, **match.groupdict()}
+
+
+def parse_source(
+    fp: Path, identity: dict[str, str] | None, results_dir: Path | None = None
+) -> tuple[dict[str, str], pl.DataFrame]:
+    """Parses a results YAML file or an evaluation `results.json` file into its identity and warehouse rows.
+
+    Args:
+        fp: The file to parse.
+        identity: The (version, task, dataset, model) of an evaluation output; `None` for results files,
+            whose identity is read from the file (see `result_file_identity`).
+        results_dir: The root of the results files.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     fp = root / "v1" / "t" / "D" / "m.yaml"
+        ...     fp.parent.mkdir(parents=True)
+        ...     _ = fp.write_text("model: m\\nmetrics:\\n  auc: 0.75\\n  samples_equally_weighted:\\n"
+        ...                       "    roc_auc_score: 0.7\\n")
+        ...     identity, rows = parse_source(fp, None, root)
+        ...     print(identity)
+        ...     print(rows.drop("source"))
+        {'meds_dev_version': 'v1', 'task': 't', 'dataset': 'D', 'model': 'm'}
+        shape: (2, 6)
+        ┌──────────────────┬──────┬─────────┬───────┬─────────────────────────────────┬───────┐
+        │ meds_dev_version ┆ task ┆ dataset ┆ model ┆ metric                          ┆ value │
+        │ ---              ┆ ---  ┆ ---     ┆ ---   ┆ ---                             ┆ ---   │
+        │ str              ┆ str  ┆ str     ┆ str   ┆ str                             ┆ f64   │
+        ╞══════════════════╪══════╪═════════╪═══════╪═════════════════════════════════╪═══════╡
+        │ v1               ┆ t    ┆ D       ┆ m     ┆ auc                             ┆ 0.75  │
+        │ v1               ┆ t    ┆ D       ┆ m     ┆ samples_equally_weighted/roc_a… ┆ 0.7   │
+        └──────────────────┴──────┴─────────┴───────┴─────────────────────────────────┴───────┘
+    """
+    fp = Path(fp)
+    if identity is None:
+        with open(fp) as f:
+            result = yaml.load(f, Loader=_YAML_LOADER) or {}
+        identity = result_file_identity(fp, results_dir, result)
+        metrics = result.get("metrics", None) or {}
+    else:
+        metrics = json.loads(fp.read_text())
+
+    metrics = {k: v for k, v in flatten_metrics(metrics).items() if not math.isnan(v)}
+    return identity, pl.DataFrame(
+        {
+            **{col: [identity[col]] * len(metrics) for col in ID_COLS},
+            "metric": list(metrics),
+            "value": list(metrics.values()),
+            "source": [str(fp)] * len(metrics),
+        },
+        schema=SCHEMA,
+    )
+
+
+def partition_path(warehouse_dir: Path, meds_dev_version: str, dataset: str) -> Path:
+    """Returns the parquet file of a (version, dataset) partition.
+
+    Examples:
+        >>> partition_path(Path("wh"), "v1.0", "MIMIC-IV/demo")
+        PosixPath('wh/data/meds_dev_version=v1.0/dataset=MIMIC-IV%2Fdemo/0.parquet')
+    """
+    return (
+        Path(warehouse_dir)
+        / DATA_DIR
+        / f"meds_dev_version={quote(meds_dev_version, safe='')}"
+        / f"dataset={quote(dataset, safe='')}"
+        / "0.parquet"
+    )
+
+
+def _sha256(fp: Path) -> str:
+    return hashlib.sha256(Path(fp).read_bytes()).hexdigest()
+
+
+def _write_atomic(df: pl.DataFrame, fp: Path):
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = fp.with_name(f".{fp.name}.tmp")
+    df.write_parquet(tmp_fp, statistics=True)
+    os.replace(tmp_fp, fp)
+
+
+def discover_sources(
+    results_dirs: Iterable[Path] = (),
+    evaluation_dirs: Iterable[Path] = (),
+    evaluation_pattern: str = EVALUATION_PATTERN,
+    meds_dev_version: str | None = None,
+) -> dict[str, tuple[Path, Path | None, dict[str, str] | None]]:
+    """Finds all results files and evaluation outputs to compile, keyed by their path.
+
+    Returns a mapping from each file's path to the file, its results root (for results files), and its
+    identity (for evaluation outputs). Evaluation outputs whose directory does not match `evaluation_pattern`
+    are skipped with a warning.
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for fp in ("results/v1/t/D/m.yaml", "evals/D/t/x/m/results.json", "evals/bad/results.json"):
+        ...         (root / fp).parent.mkdir(parents=True, exist_ok=True)
+        ...         (root / fp).touch()
+        ...     sources = discover_sources([root / "results"], [root / "evals"], meds_dev_version="v2")
+        ...     for src, (fp, results_dir, identity) in sources.items():
+        ...         print(Path(src).relative_to(root), results_dir is not None)
+        ...         print(identity)
+        results/v1/t/D/m.yaml True
+        None
+        evals/D/t/x/m/results.json False
+        {'meds_dev_version': 'v2', 'dataset': 'D', 'task': 't/x', 'model': 'm'}
+    """
+    sources = {}
+    for results_dir in results_dirs:
+        results_dir = Path(results_dir)
+        for fp in sorted(results_dir.rglob("*.yaml")):
+            sources[str(fp)] = (fp, results_dir, None)
+
+    for evaluation_dir in evaluation_dirs:
+        evaluation_dir = Path(evaluation_dir)
+        for fp in sorted(evaluation_dir.rglob("results.json")):
+            rel_dir = fp.parent.relative_to(evaluation_dir)
+            identity = evaluation_identity(rel_dir, evaluation_pattern, meds_dev_version=meds_dev_version)
+            if identity is None:
+                logger.warning(f"Skipping {fp}: {rel_dir} does not match the pattern {evaluation_pattern}.")
+                continue
+            sources[str(fp)] = (fp, None, identity)
+    return sources
+
+
+def load_index(warehouse_dir: Path) -> pl.DataFrame:
+    """Returns the index of the sources compiled into the warehouse (empty if there is none)."""
+    index_fp = Path(warehouse_dir) / INDEX_FN
+    if not index_fp.is_file():
+        return pl.DataFrame(schema=INDEX_SCHEMA)
+    return pl.read_parquet(index_fp)
+
+
+def update_warehouse(
+    warehouse_dir: Path,
+    results_dirs: Iterable[Path] = (),
+    evaluation_dirs: Iterable[Path] = (),
+    evaluation_pattern: str = EVALUATION_PATTERN,
+    meds_dev_version: str | None = None,
+) -> dict[str, int]:
+    """Compiles new and changed results files and evaluation outputs into the warehouse.
+
+    Sources whose size and modification time (or, failing that, content hash) match the index are skipped.
+    The rows of changed and removed sources are dropped from the partitions that held them, the rows of new
+    and changed sources are added, and only those partitions are rewritten.
+
+    Args:
+        warehouse_dir: The warehouse directory.
+        results_dirs: Roots of results YAML files, under `${meds_dev_version}/${task}/${dataset}/${model}`.
+        evaluation_dirs: Roots of evaluation output directories, with `results.json` files.
+        evaluation_pattern: The path of evaluation output directories relative to their root; see
+            `evaluation_identity`.
+        meds_dev_version: The version of evaluation outputs whose pattern has no `{meds_dev_version}`.
+
+    Returns:
+        The number of sources parsed, unchanged, and removed, and of partitions rewritten.
+
+    Examples:
+        >>> import tempfile
+        >>> def write_result(root, rel_fp, auc):
+        ...     fp = root / "results" / rel_fp
+        ...     fp.parent.mkdir(parents=True, exist_ok=True)
+        ...     _ = fp.write_text(f"metrics:\\n  samples_equally_weighted:\\n    roc_auc_score: {auc}\\n")
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     write_result(root, "v1/t1/D1/m1.yaml", 0.7)
+        ...     write_result(root, "v1/t1/D1/m2.yaml", 0.8)
+        ...     write_result(root, "v1/t1/D2/m1.yaml", 0.6)
+        ...     wh = root / "warehouse"
+        ...     print(update_warehouse(wh, [root / "results"]))
+        ...     print(update_warehouse(wh, [root / "results"]))
+        ...     write_result(root, "v1/t1/D1/m2.yaml", 0.9)
+        ...     (root / "results" / "v1/t1/D2/m1.yaml").unlink()
+        ...     print(update_warehouse(wh, [root / "results"]))
+        ...     print(sorted(p.parent.name for p in (wh / "data").rglob("*.parquet")))
+        ...     print(leaderboard(wh)[["dataset", "model", "value"]].rows())
+        {'parsed': 3, 'unchanged': 0, 'removed': 0, 'partitions': 2}
+        {'parsed': 0, 'unchanged': 3, 'removed': 0, 'partitions': 0}
+        {'parsed': 1, 'unchanged': 1, 'removed': 1, 'partitions': 2}
+        ['dataset=D1']
+        [('D1', 'm2', 0.9), ('D1', 'm1', 0.7)]
+    """
+    warehouse_dir = Path(warehouse_dir)
+    sources = discover_sources(results_dirs, evaluation_dirs, evaluation_pattern, meds_dev_version)
+
+    with file_lock(warehouse_dir / ".lock"):
+        index = load_index(warehouse_dir)
+        indexed = {row["source"]: row for row in index.iter_rows(named=True)}
+
+        new_index, parsed, stale = [], [], set()
+        n_unchanged = 0
+        index_changed = False
+        for source, (fp, results_dir, identity) in sources.items():
+            stat = fp.stat()
+            entry = {"source": source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            old = indexed.get(source, None)
+            # Evaluation outputs are re-parsed if the pattern or version they were compiled with changed.
+            if old is not None and identity is not None and identity != {col: old[col] for col in ID_COLS}:
+                old = None
+
+            if old is not None and (old["size"], old["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                new_index.append(old)
+                n_unchanged += 1
+                continue
+
+            entry["sha256"] = _sha256(fp)
+            if old is not None and old["sha256"] == entry["sha256"]:
+                new_index.append({**old, **entry})
+                n_unchanged += 1
+                index_changed = True
+                continue
+
+            identity, rows = parse_source(fp, identity, results_dir)
+            new_index.append({**entry, **identity})
+            parsed.append(rows)
+            if source in indexed:
+                stale.add(source)
+
+        removed = set(indexed) - set(sources)
+        stale |= removed
+
+        new_rows = pl.concat(parsed) if parsed else pl.DataFrame(schema=SCHEMA)
+        partitions = set(new_rows.select(PARTITION_COLS).unique().rows()) | {
+            tuple(indexed[source][col] for col in PARTITION_COLS) for source in stale
+        }
+        for version, dataset in sorted(partitions):
+            fp = partition_path(warehouse_dir, version, dataset)
+            rows = pl.read_parquet(fp) if fp.is_file() else pl.DataFrame(schema=SCHEMA)
+            rows = pl.concat(
+                [
+                    rows.filter(~pl.col("source").is_in(list(stale))),
+                    new_rows.filter((pl.col("meds_dev_version") == version) & (pl.col("dataset") == dataset)),
+                ]
+            )
+            if len(rows):
+                _write_atomic(rows.sort("task", "model", "metric", "source"), fp)
+            else:
+                fp.unlink(missing_ok=True)
+
+        if parsed or removed or index_changed:
+            _write_atomic(pl.DataFrame(new_index, schema=INDEX_SCHEMA), warehouse_dir / INDEX_FN)
+
+    stats = {"parsed": len(parsed), "unchanged": n_unchanged, "removed": len(removed)}
+    stats["partitions"] = len(partitions)
+    logger.info(f"Updated the results warehouse {warehouse_dir}: {stats}")
+    return stats
+
+
+def scan_results(
+    warehouse_dir: Path, meds_dev_version: str | None = None, dataset: str | None = None
+) -> pl.LazyFrame:
+    """Lazily scans the warehouse, reading only the partitions of `meds_dev_version` and `dataset` (if set).
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     print(scan_results(Path(tmp_dir)).collect().shape)
+        (0, 7)
+    """
+    version_dir = f"meds_dev_version={quote(meds_dev_version, safe='') if meds_dev_version else '*'}"
+    dataset_dir = f"dataset={quote(dataset, safe='') if dataset else '*'}"
+    files = sorted((Path(warehouse_dir) / DATA_DIR).glob(f"{version_dir}/{dataset_dir}/*.parquet"))
+    if not files:
+        return pl.LazyFrame(schema=SCHEMA)
+    return pl.scan_parquet(files, hive_partitioning=False)
+
+
+def leaderboard(
+    warehouse_dir: Path,
+    metric: str = DEFAULT_METRIC,
+    task: str | None = None,
+    dataset: str | None = None,
+    model: str | None = None,
+    meds_dev_version: str | None = None,
+    top_k: int | None = None,
+) -> pl.DataFrame:
+    """Ranks the models of each (version, task, dataset) by `metric`.
+
+    Models are ranked in descending order of the metric, unless lower values are better (e.g., for the Brier
+    score or the calibration error). Ties share the best rank.
+
+    Args:
+        warehouse_dir: The warehouse directory.
+        metric: The metric to rank by, e.g., `samples_equally_weighted/roc_auc_score`.
+        task: Only rank models on this task.
+        dataset: Only rank models on this dataset.
+        model: Only return the ranks of this model.
+        meds_dev_version: Only rank models of this MEDS-DEV version.
+        top_k: Only return the `top_k` best models of each (version, task, dataset); e.g., 1 for the best.
+
+    Examples:
+        >>> import tempfile
+        >>> rows = [
+        ...     ("t1", "D1", "m1", 0.7, 0.2), ("t1", "D1", "m2", 0.8, 0.3), ("t1", "D1", "m3", 0.8, 0.1),
+        ...     ("t2", "D1", "m1", 0.6, 0.2), ("t1", "D2", "m1", 0.9, 0.2),
+        ... ]
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     root = Path(tmp_dir)
+        ...     for task, dataset, model, auc, brier in rows:
+        ...         fp = root / "results" / "v1" / task / dataset / f"{model}.yaml"
+        ...         fp.parent.mkdir(parents=True, exist_ok=True)
+        ...         _ = fp.write_text(f"metrics:\\n  auc: {auc}\\n  brier_score_loss: {brier}\\n")
+        ...     _ = update_warehouse(root / "warehouse", [root / "results"])
+        ...     print(leaderboard(root / "warehouse", "auc", dataset="D1").drop("source"))
+        ...     best = leaderboard(root / "warehouse", "brier_score_loss", top_k=1)
+        ...     print(best[["task", "dataset", "model"]])
+        shape: (4, 7)
+        ┌──────────────────┬──────┬─────────┬──────┬───────┬────────┬───────┐
+        │ meds_dev_version ┆ task ┆ dataset ┆ rank ┆ model ┆ metric ┆ value │
+        │ ---              ┆ ---  ┆ ---     ┆ ---  ┆ ---   ┆ ---    ┆ ---   │
+        │ str              ┆ str  ┆ str     ┆ u32  ┆ str   ┆ str    ┆ f64   │
+        ╞══════════════════╪══════╪═════════╪══════╪═══════╪════════╪═══════╡
+        │ v1               ┆ t1   ┆ D1      ┆ 1    ┆ m2    ┆ auc    ┆ 0.8   │
+        │ v1               ┆ t1   ┆ D1      ┆ 1    ┆ m3    ┆ auc    ┆ 0.8   │
+        │ v1               ┆ t1   ┆ D1      ┆ 3    ┆ m1    ┆ auc    ┆ 0.7   │
+        │ v1               ┆ t2   ┆ D1      ┆ 1    ┆ m1    ┆ auc    ┆ 0.6   │
+        └──────────────────┴──────┴─────────┴──────┴───────┴────────┴───────┘
+        shape: (3, 3)
+        ┌──────┬─────────┬───────┐
+        │ task ┆ dataset ┆ model │
+        │ ---  ┆ ---     ┆ ---   │
+        │ str  ┆ str     ┆ str   │
+        ╞══════╪═════════╪═══════╡
+        │ t1   ┆ D1      ┆ m3    │
+        │ t1   ┆ D2      ┆ m1    │
+        │ t2   ┆ D1      ┆ m1    │
+        └──────┴─────────┴───────┘
+    """
+    higher_is_better = metric.rsplit("/", 1)[-1] not in LOWER_IS_BETTER
+    group_cols = ["meds_dev_version", "task", "dataset"]
+
+    results = scan_results(warehouse_dir, meds_dev_version, dataset).filter(pl.col("metric") == metric)
+    if task is not None:
+        results = results.filter(pl.col("task") == task)
+
+    results = results.with_columns(
+        pl.col("value").rank("min", descending=higher_is_better).over(group_cols).alias("rank")
+    )
+    if model is not None:
+        results = results.filter(pl.col("model") == model)
+    if top_k is not None:
+        results = results.filter(pl.col("rank") <= top_k)
+
+    return (
+        results.select(*group_cols, "rank", "model", "metric", "value", "source")
+        .sort(*group_cols, "rank", "model")
+        .collect()
+    )
@@ -0,0 +1,149 @@
+"""A minimal protocol for long-lived local scoring workers, served over a Unix socket.
+
+A worker (started with `meds-dev-model mode=serve`) loads a model's predict path once and then scores
+labels directories on request, so repeated predictions do not pay for process startup, environment
+activation, imports, and model loading each time. Clients (e.g., `meds-dev-model mode=predict` with
+`serve_socket` set) send one JSON-encoded job per connection, as a single line, and receive a single JSON line
+in reply. Jobs are processed one at a time, in the order they are received.
+
+Jobs are dictionaries with the `model`, `labels_dir`, `dataset_dir`, `split`, and `output_dir` of the predict
+run (and the `model_initialization_dir` the client expects the worker to have loaded, if any); workers write
+predictions to `{output_dir}/predictions` as in `MEDS_DEV.predictions`, and reject jobs for another model. The
+special jobs `{"op": "ping"}` and `{"op": "shutdown"}` check that the worker is running (replying with the
+`model` it serves, so clients only send jobs to a worker for their model) and stop it, respectively.
+
+This module only depends on the standard library; model scripts that run in their own virtual environments,
+where `MEDS_DEV` can not be imported, can implement the same protocol themselves (see, e.g., the CEHR-BERT
+predictor).
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+from collections.abc import Callable
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+JOB_KEYS = ("labels_dir", "dataset_dir", "split", "output_dir")
+PING = {"op": "ping"}
+SHUTDOWN = {"op": "shutdown"}
+
+
+def send(socket_path: Path | str, job: dict, timeout: float | None = None) -> dict:
+    """Sends a job to the worker listening on `socket_path` and returns its reply.
+
+    Raises:
+        RuntimeError: If the worker failed to process the job.
+        OSError: If no worker is listening on the socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        with sock.makefile("rw") as f:
+            f.write(json.dumps(job) + "\n")
+            f.flush()
+            reply = json.loads(f.readline())
+
+    if reply.get("status") != "ok":
+        raise RuntimeError(f"Worker at {socket_path} failed on job {job}: {reply.get('error')}")
+    return reply
+
+
+def is_serving(socket_path: Path | str | None, model: str | None = None, timeout: float = 1.0) -> bool:
+    """Returns whether a worker is listening on `socket_path` (and, if `model` is set, serves that model).
+
+    Examples:
+        >>> is_serving(None), is_serving("/nonexistent.sock")
+        (False, False)
+    """
+    if not socket_path or not Path(socket_path).exists():
+        return False
+    try:
+        reply = send(socket_path, PING, timeout=timeout)
+    except (OSError, RuntimeError, ValueError):
+        return False
+    if model is not None and reply.get("model", None) != model:
+        logger.warning(f"The worker on {socket_path} serves {reply.get('model', None)}, not {model}")
+        return False
+    return True
+
+
+def serve(socket_path: Path | str, handle: Callable[[dict], dict | None], model: str | None = None):
+    """Serves scoring jobs on `socket_path` with `handle`, until a shutdown job is received.
+
+    Args:
+        socket_path: The path of the Unix socket to listen on. A stale socket file (e.g., from a worker that
+            was killed) is replaced.
+        handle: The function processing each job. Any dictionary it returns is merged into the reply, and any
+            exception it raises is reported to the client rather than stopping the worker.
+        model: The name of the model served, which is reported in reply to pings. Jobs for another model are
+            rejected.
+
+    Raises:
+        RuntimeError: If another worker is already listening on `socket_path`.
+
+    Examples:
+        >>> import tempfile, threading
+        >>> def handle(job):
+        ...     if job["labels_dir"] == "bad":
+        ...         raise ValueError("no labels")
+        ...     return {"n_predictions": len(job["labels_dir"])}
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     socket_path = Path(tmp_dir) / "worker.sock"
+        ...     worker = threading.Thread(target=serve, args=(socket_path, handle, "M"))
+        ...     worker.start()
+        ...     while not is_serving(socket_path):
+        ...         pass
+        ...     print(send(socket_path, PING), is_serving(socket_path, "M"), is_serving(socket_path, "other"))
+        ...     print(send(socket_path, {"model": "M", "labels_dir": "abc"}))
+        ...     for job in ({"labels_dir": "bad"}, {"model": "other", "labels_dir": "abc"}):
+        ...         try:
+        ...             send(socket_path, job)
+        ...         except RuntimeError as e:
+        ...             print(e)
+        ...     _ = send(socket_path, SHUTDOWN)
+        ...     worker.join()
+        ...     print(is_serving(socket_path), socket_path.exists())
+        {'status': 'ok', 'model': 'M'} True False
+        {'status': 'ok', 'n_predictions': 3}
+        Worker at ... failed on job {'labels_dir': 'bad'}: ValueError('no labels')
+        Worker at ... failed on job {'model': 'other', ...}: ValueError('This worker serves M, not other')
+        False False
+    """
+    socket_path = Path(socket_path)
+    if is_serving(socket_path):
+        raise RuntimeError(f"A worker is already serving on {socket_path}")
+    socket_path.unlink(missing_ok=True)
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            job = json.loads(self.rfile.readline())
+            reply = {"status": "ok"}
+            if job == SHUTDOWN:
+                self.server.do_shutdown = True
+            elif job == PING:
+                reply["model"] = model
+            else:
+                logger.info(f"Processing job {job}")
+                try:
+                    if job.get("model", model) != model:
+                        raise ValueError(f"This worker serves {model}, not {job['model']}")
+                    reply.update(handle(job) or {})
+                except Exception as e:
+                    logger.exception(f"Failed to process job {job}")
+                    reply = {"status": "error", "error": repr(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+    with socketserver.UnixStreamServer(str(socket_path), Handler) as server:
+        server.do_shutdown = False
+        logger.info(f"Serving on {socket_path}")
+        try:
+            while not server.do_shutdown:
+                server.handle_request()
+        finally:
+            os.unlink(socket_path)
+    logger.info(f"Stopped serving on {socket_path}")
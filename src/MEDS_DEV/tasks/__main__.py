@@ -5,31 +5,37 @@ import hydra
 from omegaconf import DictConfig
 
 from .. import DATASETS
+from ..budget import read_usage
+from ..cache import dataset_size
+from ..datasets.incremental import record_label_shard_versions, stale_label_shards
+from ..executors import make_executor, stage_requests
+from ..plan import CACHED, STALE, Plan, PlanNode, done_status
 from ..utils import run_in_env
 from . import CFG_YAML, TASKS
 
 logger = logging.getLogger(__name__)
 
 
-@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
-def main(cfg: DictConfig):
+def task_inputs(cfg: DictConfig) -> tuple[Path, Path]:
+    """Returns the ACES task configuration and dataset predicates files to extract the task's labels with."""
     if cfg.task not in TASKS:
         raise ValueError(f"Task {cfg.task} not currently configured. Configured tasks: {TASKS.keys()}")
 
     task_config_path = TASKS[cfg.task]["criteria_fp"]
     if cfg.get("dataset_predicates_path", None):
         logger.info(f"Using provided (local) predicates path: {cfg.dataset_predicates_path}")
-        dataset_predicates_path = Path(cfg.dataset_predicates_path)
-    else:
-        if cfg.dataset not in DATASETS:
-            raise ValueError(
-                f"Dataset {cfg.dataset} not currently configured! Available datasets: {DATASETS.keys()}"
-            )
-        dataset_predicates_path = DATASETS[cfg.dataset]["predicates"]
+        return task_config_path, Path(cfg.dataset_predicates_path)
 
-    logger.info(f"Running task {cfg.task} on dataset {cfg.dataset}")
+    if cfg.dataset not in DATASETS:
+        raise ValueError(
+            f"Dataset {cfg.dataset} not currently configured! Available datasets: {DATASETS.keys()}"
+        )
+    return task_config_path, DATASETS[cfg.dataset]["predicates"]
 
-    cmd = " ".join(
+
+def aces_command(cfg: DictConfig, task_config_path: Path, dataset_predicates_path: Path, shards: str) -> str:
+    """Returns the ACES command extracting the task's labels from the given data shards."""
+    return " ".join(
         [
             "aces-cli",
             "--multirun",
@@ -37,7 +43,7 @@ def main(cfg: DictConfig):
             "data=sharded",
             "data.standard=meds",
             f"data.root={cfg.dataset_dir}/data",
-            f"data.shard=$(expand_shards {cfg.dataset_dir}/data)",
+            f"data.shard={shards}",
             f"config_path={task_config_path}",
             f"predicates_path={dataset_predicates_path}",
             f"output_filepath={cfg.output_dir}" + r"/\$\{data._prefix\}.parquet",
@@ -45,6 +51,79 @@ def main(cfg: DictConfig):
         ]
     )
 
+
+def plan(cfg: DictConfig) -> Plan:
+    """Returns the plan of a task extraction: whether `run` would extract the labels, or only stale shards.
+
+    Labels whose data shards were changed by a refresh since they were extracted are stale, and their wall
+    time is estimated from the compute recorded for the labels so far, scaled by the fraction of the
+    dataset's bytes in the stale data shards.
+    """
+    task_config_path, dataset_predicates_path = task_inputs(cfg)
+    dataset_dir = Path(cfg.dataset_dir)
+    output_dir = Path(cfg.output_dir)
+    shards = f"$(expand_shards {cfg.dataset_dir}/data)"
+
+    status, reason = done_status(output_dir, cfg.do_overwrite)
+    estimate, n_samples = None, 0
+    if status == CACHED and (stale_shards := stale_label_shards(dataset_dir, output_dir)):
+        status, reason = STALE, f"{len(stale_shards)} label shards stale after a dataset refresh"
+        shards = ",".join(stale_shards)
+        usage = read_usage(output_dir)
+        if usage["n_runs"] and (total_bytes := dataset_size(dataset_dir)):
+            data_dir = dataset_dir / "data"
+            stale_bytes = sum((data_dir / f"{shard}.parquet").stat().st_size for shard in stale_shards)
+            estimate, n_samples = usage["wall_time"] * stale_bytes / total_bytes, 1
+
+    command = aces_command(cfg, task_config_path, dataset_predicates_path, shards)
+    node = PlanNode(f"labels/{cfg.task}", command, output_dir, status, reason, [], estimate, n_samples)
+    return Plan(f"meds-dev-task {cfg.task} on {cfg.dataset}", [node])
+
+
+def run(cfg: DictConfig) -> Plan | None:
+    """Extracts a task's labels from a dataset, as configured by `_extract_task.yaml`.
+
+    Returns:
+        The plan of the extraction (see `plan`), rather than running it, if `cfg.plan` is set.
+    """
+    if cfg.get("plan", False):
+        return plan(cfg)
+
+    task_config_path, dataset_predicates_path = task_inputs(cfg)
+
+    logger.info(f"Running task {cfg.task} on dataset {cfg.dataset}")
+
+    dataset_dir = Path(cfg.dataset_dir)
+    output_dir = Path(cfg.output_dir)
+    shards = f"$(expand_shards {cfg.dataset_dir}/data)"
+
+    done_fp = output_dir / ".done"
+    if done_fp.is_file() and not cfg.do_overwrite:
+        stale_shards = stale_label_shards(dataset_dir, output_dir)
+        if stale_shards:
+            logger.info(f"Re-extracting {len(stale_shards)} label shards stale after refresh: {stale_shards}")
+            for shard in stale_shards:
+                (output_dir / f"{shard}.parquet").unlink(missing_ok=True)
+            done_fp.unlink()
+            shards = ",".join(stale_shards)
+
+    cmd = aces_command(cfg, task_config_path, dataset_predicates_path, shards)
+
     logger.info(f"Running ACES: {cmd}")
-    run_in_env(cmd=cmd, output_dir=cfg.output_dir, do_overwrite=cfg.do_overwrite, run_as_script=False)
+    run_in_env(
+        cmd=cmd,
+        output_dir=cfg.output_dir,
+        do_overwrite=cfg.do_overwrite,
+        run_as_script=False,
+        executor=make_executor(cfg),
+        requests=stage_requests(cfg, None, "extract"),
+    )
+    record_label_shard_versions(dataset_dir, output_dir)
     logger.info(f"Extract {cfg.task} for {cfg.dataset} command {cmd} finished successfully.")
+
+
+@hydra.main(version_base=None, config_path=str(CFG_YAML.parent), config_name=CFG_YAML.stem)
+def main(cfg: DictConfig):
+    result = run(cfg)
+    if cfg.get("plan", False):
+        print(result)
@@ -6,10 +6,13 @@ import shutil
 import subprocess
 import sys
 import tempfile
+from collections.abc import Callable
 from pathlib import Path
 
 from omegaconf import DictConfig
 
+from .budget import run_with_budget
+
 logger = logging.getLogger(__name__)
 
 
@@ -34,6 +37,20 @@ def get_venv_bin_path(venv_dir: str | Path) -> Path:
         return Path(venv_dir) / "bin"
 
 
+def available_cpu_count() -> int:
+    """Returns the number of CPUs this process is allowed to run on.
+
+    Examples:
+        >>> available_cpu_count() >= 1
+        True
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        # Not all operating systems support CPU affinity.
+        return os.cpu_count() or 1
+
+
 @contextlib.contextmanager
 def tempdir_ctx(cfg: DictConfig) -> Path:
     """Provides a context manager that either yields a temporary directory or a specified directory.
@@ -146,6 +163,9 @@ def run_in_env(
     do_overwrite: bool = False,
     cwd: Path | str | None = None,
     run_as_script: bool = True,
+    budget: dict[str, float] | None = None,
+    executor: Callable[..., subprocess.CompletedProcess] | None = None,
+    requests: dict[str, int] | None = None,
 ) -> subprocess.CompletedProcess:
     if type(output_dir) is str:
         output_dir = Path(output_dir)
@@ -164,7 +184,7 @@ def run_in_env(
     if env is None:
         env = os.environ.copy()
 
-    runner_kwargs = {"env": env, "capture_output": True}
+    runner_kwargs = {"env": env}
 
     if run_as_script:
         script_file = output_dir / "cmd.sh"
@@ -204,7 +224,13 @@ def run_in_env(
     if cwd is not None:
         runner_kwargs["cwd"] = cwd
 
-    command_out = subprocess.run(cmd, **runner_kwargs)
+    # Records the command's compute in the output directory and stops it if it exceeds its budget, raising
+    # `MEDS_DEV.budget.BudgetExceeded` without marking the output as done. Executors (see
+    # `MEDS_DEV.executors`) may instead run the command elsewhere, e.g., as a batch job with its requests.
+    if executor is None:
+        command_out = run_with_budget(cmd, output_dir, budget, **runner_kwargs)
+    else:
+        command_out = executor(cmd, output_dir, budget, requests, **runner_kwargs)
 
     command_errored = command_out.returncode != 0
     if command_errored:
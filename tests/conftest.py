@@ -1,5 +1,6 @@
 import contextlib
 import logging
+from datetime import datetime
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -236,6 +237,57 @@ def pytest_generate_tests(metafunc):
         metafunc.parametrize("task_labels", get_opts(metafunc.config, "task"), indirect=True)
     if "unsupervised_model" in metafunc.fixturenames:
         metafunc.parametrize("unsupervised_model", get_opts(metafunc.config, "model"), indirect=True)
+    if "model_name" in metafunc.fixturenames:
+        metafunc.parametrize("model_name", get_opts(metafunc.config, "model"))
+
+
+@pytest.fixture
+def synthetic_dataset(tmp_path: Path) -> tuple[Path, Path]:
+    """A tiny MEDS dataset and task labels, for testing the CLIs without building a dataset."""
+    dataset_dir = tmp_path / "dataset"
+    labels_dir = tmp_path / "labels"
+
+    subject_ids = list(range(1, 9))
+    splits = ["train"] * 4 + ["held_out"] * 4
+    times = [datetime(2020, 1, subject_id) for subject_id in subject_ids]
+
+    (dataset_dir / "metadata").mkdir(parents=True)
+    pl.DataFrame({"subject_id": subject_ids, "split": splits}).write_parquet(
+        dataset_dir / "metadata" / "subject_splits.parquet"
+    )
+    for split in set(splits):
+        in_split = [i for i, s in enumerate(splits) if s == split]
+        (dataset_dir / "data" / split).mkdir(parents=True)
+        pl.DataFrame(
+            {
+                "subject_id": [subject_ids[i] for i in in_split],
+                "time": [times[i] for i in in_split],
+                "code": ["ADMISSION"] * len(in_split),
+                "numeric_value": [None] * len(in_split),
+            },
+            schema={
+                "subject_id": pl.Int64,
+                "time": pl.Datetime("us"),
+                "code": pl.Utf8,
+                "numeric_value": pl.Float32,
+            },
+        ).write_parquet(dataset_dir / "data" / split / "0.parquet")
+
+        (labels_dir / split).mkdir(parents=True)
+        pl.DataFrame(
+            {
+                "subject_id": [subject_ids[i] for i in in_split],
+                "prediction_time": [times[i] for i in in_split],
+                "boolean_value": [i % 2 == 0 for i in in_split],
+            },
+            schema={
+                "subject_id": pl.Int64,
+                "prediction_time": pl.Datetime("us"),
+                "boolean_value": pl.Boolean,
+            },
+        ).write_parquet(labels_dir / split / "0.parquet")
+
+    return dataset_dir, labels_dir
 
 
 @pytest.fixture(scope="session")
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import polars as pl
+
+from tests.utils import run_command
+
+
+def test_batch_evaluation(synthetic_dataset: tuple[Path, Path], tmp_path: Path):
+    dataset_dir, labels_dir = synthetic_dataset
+
+    predictions_dirs = [tmp_path / "models" / name / "predict" for name in ("A", "B")]
+    for predictions_dir in predictions_dirs:
+        run_command(
+            "meds-dev-model",
+            f"Predict into {predictions_dir}",
+            {
+                "model": "random_predictor",
+                "mode": "predict",
+                "dataset_type": "supervised",
+                "dataset_dir": str(dataset_dir.resolve()),
+                "labels_dir": str(labels_dir.resolve()),
+                "split": "held_out",
+                "output_dir": str(predictions_dir.resolve()),
+            },
+        )
+
+    output_dir = tmp_path / "evaluations"
+    run_command(
+        "meds-dev-evaluation",
+        "Evaluate a batch of prediction directories",
+        {
+            "predictions_dirs": [str(d.resolve()) for d in predictions_dirs],
+            "output_dir": str(output_dir.resolve()),
+            "num_workers": 2,
+        },
+    )
+
+    for name in ("A", "B"):
+        assert (output_dir / name / "predict" / "results.json").is_file(), list(output_dir.rglob("*"))
+    results = pl.read_parquet(output_dir / "results.parquet")
+    assert sorted(results["run"].unique()) == ["A/predict", "B/predict"], results
@@ -0,0 +1,41 @@
+import shutil
+from pathlib import Path
+
+from tests.utils import run_command
+
+DATASET = "MIMIC-IV"
+TASKS = ["mortality/in_icu/first_24h", "readmission/general_hospital/30d"]
+MODEL = "random_predictor"
+
+
+def test_grid(synthetic_dataset: tuple[Path, Path], tmp_path: Path):
+    dataset_dir, labels_dir = synthetic_dataset
+    grid_dir = tmp_path / "grid"
+
+    # Labels are extracted elsewhere, so the grid is run without its `dataset` and `task` stages.
+    for task in TASKS:
+        shutil.copytree(labels_dir, grid_dir / "labels" / DATASET / task)
+
+    run_command(
+        "meds-dev-grid",
+        "Initialize the grid",
+        {
+            "grid_dir": str(grid_dir.resolve()),
+            "action": "init",
+            "datasets": [DATASET],
+            "tasks": TASKS,
+            "models": [MODEL],
+            "stages": ["model", "evaluation"],
+            "+dataset_dirs": {DATASET: str(dataset_dir.resolve())},
+        },
+    )
+    _, stdout = run_command(
+        "meds-dev-grid",
+        "Work through the grid",
+        {"grid_dir": str(grid_dir.resolve()), "action": "work", "worker.poll_seconds": 1},
+    )
+    assert "[failed]" not in stdout, stdout
+
+    for task in TASKS:
+        assert (grid_dir / "models" / MODEL / DATASET / task / DATASET / task / "predict" / ".done").is_file()
+        assert (grid_dir / "evaluations" / DATASET / task / MODEL / "results.json").is_file()
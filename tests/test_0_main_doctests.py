@@ -0,0 +1,19 @@
+import doctest
+import importlib
+from pathlib import Path
+
+import pytest
+
+import MEDS_DEV
+
+# pytest does not collect doctests from `__main__.py` files, so those of the CLIs are run here.
+MAIN_MODULES = sorted(
+    ".".join(("MEDS_DEV", *fp.relative_to(Path(MEDS_DEV.__file__).parent).with_suffix("").parts))
+    for fp in Path(MEDS_DEV.__file__).parent.rglob("__main__.py")
+)
+
+
+@pytest.mark.parametrize("module", MAIN_MODULES)
+def test_main_doctests(module: str):
+    results = doctest.testmod(importlib.import_module(module), optionflags=doctest.ELLIPSIS, verbose=False)
+    assert results.failed == 0, f"{results.failed} of {results.attempted} doctests of {module} failed."
@@ -0,0 +1,57 @@
+from pathlib import Path
+
+from tests.utils import run_command
+
+
+def test_model_plan(synthetic_dataset: tuple[Path, Path], tmp_path: Path):
+    dataset_dir, labels_dir = synthetic_dataset
+    output_dir = tmp_path / "model"
+    kwargs = {
+        "model": "random_predictor",
+        "mode": "predict",
+        "dataset_type": "supervised",
+        "dataset_dir": str(dataset_dir.resolve()),
+        "labels_dir": str(labels_dir.resolve()),
+        "split": "held_out",
+        "output_dir": str(output_dir.resolve()),
+    }
+
+    _, stdout = run_command("meds-dev-model", "Plan random_predictor", {**kwargs, "plan": True})
+    assert "[to-run] supervised/predict: not yet run" in stdout, stdout
+    assert not (output_dir / "predictions").exists(), "Planning should not run the model."
+
+    run_command("meds-dev-model", "Run random_predictor", kwargs)
+    _, stdout = run_command("meds-dev-model", "Re-plan random_predictor", {**kwargs, "plan": True})
+    assert "[cached] supervised/predict: .done exists" in stdout, stdout
+
+
+def test_evaluation_plan(synthetic_dataset: tuple[Path, Path], tmp_path: Path):
+    dataset_dir, labels_dir = synthetic_dataset
+    predictions_dir = tmp_path / "model"
+    run_command(
+        "meds-dev-model",
+        "Run random_predictor",
+        {
+            "model": "random_predictor",
+            "mode": "predict",
+            "dataset_type": "supervised",
+            "dataset_dir": str(dataset_dir.resolve()),
+            "labels_dir": str(labels_dir.resolve()),
+            "split": "held_out",
+            "output_dir": str(predictions_dir.resolve()),
+        },
+    )
+
+    output_dir = tmp_path / "evaluation"
+    kwargs = {
+        "predictions_dir": str(predictions_dir.resolve()),
+        "output_dir": str(output_dir.resolve()),
+        "in_process": True,
+    }
+    _, stdout = run_command("meds-dev-evaluation", "Plan evaluation", {**kwargs, "plan": True})
+    assert "[to-run] evaluation: not yet evaluated" in stdout, stdout
+    assert not list(output_dir.glob("*.json")), "Planning should not evaluate the predictions."
+
+    run_command("meds-dev-evaluation", "Run evaluation", kwargs)
+    _, stdout = run_command("meds-dev-evaluation", "Re-plan evaluation", {**kwargs, "plan": True})
+    assert "[cached] evaluation:" in stdout, stdout
@@ -0,0 +1,56 @@
+import subprocess
+import time
+from pathlib import Path
+
+from MEDS_DEV.serving import SHUTDOWN, is_serving, send
+from tests.utils import dict_to_hydra_kwargs, run_command
+
+
+def test_serve_and_predict(synthetic_dataset: tuple[Path, Path], tmp_path: Path):
+    dataset_dir, labels_dir = synthetic_dataset
+    socket_path = tmp_path / "worker.sock"
+    kwargs = {
+        "model": "random_predictor",
+        "dataset_type": "supervised",
+        "dataset_dir": str(dataset_dir.resolve()),
+        "labels_dir": str(labels_dir.resolve()),
+        "split": "held_out",
+        "serve_socket": str(socket_path.resolve()),
+    }
+
+    serve_kwargs = {**kwargs, "mode": "serve", "output_dir": str((tmp_path / "worker").resolve())}
+    # The worker's output goes to files, as pipes that are never drained could fill and block the worker.
+    stdout_fp, stderr_fp = tmp_path / "worker.stdout", tmp_path / "worker.stderr"
+    with open(stdout_fp, "w") as stdout, open(stderr_fp, "w") as stderr:
+        worker = subprocess.Popen(
+            " ".join(["meds-dev-model", *dict_to_hydra_kwargs(serve_kwargs)]),
+            shell=True,
+            stdout=stdout,
+            stderr=stderr,
+        )
+    try:
+        deadline = time.time() + 120
+        while not is_serving(socket_path):
+            if worker.poll() is not None:
+                raise AssertionError(f"The worker exited before serving:\n{stderr_fp.read_text()}")
+            assert time.time() < deadline, "The worker did not start serving in time."
+            time.sleep(0.5)
+
+        assert is_serving(socket_path, "random_predictor")
+        assert not is_serving(socket_path, "cehrbert")
+
+        for job in ("job_1", "job_2"):
+            output_dir = tmp_path / job
+            stderr, stdout = run_command(
+                "meds-dev-model",
+                f"Predict {job} with the worker",
+                {**kwargs, "mode": "predict", "output_dir": str(output_dir.resolve())},
+            )
+            assert "Sending prediction job to the worker" in stderr + stdout
+            assert (output_dir / "predictions" / "held_out" / "0.parquet").is_file()
+    finally:
+        if is_serving(socket_path):
+            send(socket_path, SHUTDOWN)
+        worker.wait(timeout=60)
+
+    assert worker.returncode == 0, stderr_fp.read_text()
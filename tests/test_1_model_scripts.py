@@ -0,0 +1,45 @@
+import re
+import subprocess
+from pathlib import Path
+
+import pytest
+from omegaconf import DictConfig
+
+from MEDS_DEV import MODELS
+from MEDS_DEV.utils import temp_env
+
+# The python scripts (run by path, from the model directory) and modules (run with `-m`) of model commands.
+SCRIPT_RE = re.compile(r"python (?:-m ([\w.]+)|\{model_dir\}/([\w./]+\.py))")
+
+# Imports each given script or module without running it, as its `__main__` block is not executed.
+IMPORT_SCRIPTS = """
+import importlib
+import importlib.util
+import sys
+
+for i, script in enumerate(sys.argv[1:]):
+    if script.endswith(".py"):
+        spec = importlib.util.spec_from_file_location(f"_model_script_{i}", script)
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+    else:
+        importlib.import_module(script)
+"""
+
+
+def test_model_scripts_import(model_name: str, venv_cache: Path):
+    # Model scripts are excluded from the doctests, as they can only be imported in their model's environment.
+    model_dir = Path(MODELS[model_name]["model_dir"])
+    scripts = set()
+    for module, script in SCRIPT_RE.findall(str(MODELS[model_name]["commands"])):
+        scripts.add(module or str(model_dir / script))
+
+    if not scripts:
+        pytest.skip(f"Model {model_name} runs no python scripts of its own.")
+
+    cfg = DictConfig({"venv_dir": str((venv_cache / "models" / model_name).resolve()), "temp_dir": None})
+    with temp_env(cfg, MODELS[model_name]["requirements"]) as (_, env):
+        out = subprocess.run(["python", "-c", IMPORT_SCRIPTS, *sorted(scripts)], env=env, capture_output=True)
+
+    assert (
+        out.returncode == 0
+    ), f"Scripts of {model_name} failed to import in its environment:\n{out.stderr.decode()}"
@@ -1,4 +1,14 @@
-from tests.utils import NAME_AND_DIR
+import json
+import subprocess
+from pathlib import Path
+
+import polars as pl
+import pytest
+from omegaconf import DictConfig
+
+from MEDS_DEV import MODELS
+from MEDS_DEV.utils import temp_env
+from tests.utils import NAME_AND_DIR, dict_to_hydra_kwargs
 
 
 def test_supervised(supervised_model: NAME_AND_DIR, demo_dataset: NAME_AND_DIR, task_labels: NAME_AND_DIR):
@@ -21,3 +31,60 @@ def test_supervised(supervised_model: NAME_AND_DIR, demo_dataset: NAME_AND_DIR,
         raise AssertionError("\n".join(error_lines))
 
     assert len(list(final_out_dir.rglob("*.parquet"))) > 0, f"No predictions written for {setting}."
+
+
+def test_cehrbert_batched_predict(
+    supervised_model: NAME_AND_DIR,
+    demo_dataset: NAME_AND_DIR,
+    task_labels: NAME_AND_DIR,
+    venv_cache: Path,
+    tmp_path: Path,
+):
+    # The predict script can only be imported in the model's environment, so it is exercised here, on the
+    # fine-tuned demo model, rather than in the doctests.
+    model, final_out_dir = supervised_model
+    if model != "cehrbert":
+        pytest.skip("Only tests the batched predict script of cehrbert.")
+
+    _, dataset_dir = demo_dataset
+    _, labels_dir = task_labels
+    script = Path(MODELS[model]["model_dir"]) / "predict_cehrbert.py"
+    cfg = DictConfig({"venv_dir": str((venv_cache / "models" / model).resolve()), "temp_dir": None})
+
+    def predict(output_dir: Path, **kwargs) -> Path:
+        hydra_kwargs = {
+            "labels_dir": str(labels_dir.resolve()),
+            "dataset_dir": str(dataset_dir.resolve()),
+            "model_initialization_dir": str((final_out_dir.parent / "train").resolve()),
+            "output_dir": str(output_dir),
+            "split": "held_out",
+            "num_threads": 1,
+            "batch_size": 2,
+            **kwargs,
+        }
+        with temp_env(cfg, MODELS[model]["requirements"]) as (_, env):
+            out = subprocess.run(
+                ["python", str(script), *dict_to_hydra_kwargs(hydra_kwargs)], env=env, capture_output=True
+            )
+        assert out.returncode == 0, f"Batched {model} predictions failed:\n{out.stderr.decode()}"
+        return output_dir / "predictions"
+
+    # Scoring in small batches, one label shard at a time, matches the predictions of the full run.
+    predictions_dir = predict(tmp_path / "fp32")
+    want = pl.read_parquet(sorted((final_out_dir / "predictions").rglob("*.parquet")))
+    got = pl.read_parquet(sorted(predictions_dir.rglob("*.parquet")))
+    assert got.select("subject_id", "prediction_time").equals(want.select("subject_id", "prediction_time"))
+    assert (got["predicted_boolean_probability"] - want["predicted_boolean_probability"]).abs().max() < 1e-4
+
+    # Re-running resumes from the first label shard without predictions.
+    shards = sorted(predictions_dir.rglob("*.parquet"))
+    mtimes = [fp.stat().st_mtime_ns for fp in shards]
+    shards[-1].unlink()
+    predict(tmp_path / "fp32")
+    assert [fp.stat().st_mtime_ns for fp in shards[:-1]] == mtimes[:-1]
+    assert shards[-1].is_file()
+
+    # The int8 model is compared against the fp32 one.
+    predict(tmp_path / "int8", inference_precision="int8")
+    report = json.loads((tmp_path / "int8" / "inference_report.json").read_text())
+    assert report["n_predictions"] == len(want)